@@ -0,0 +1,385 @@
+"""ASGI entry point of the security proxy.
+
+Requests are received and forwarded without holding a thread: the body is
+read from the ASGI channel, the upstream call uses ``httpx.AsyncClient`` and
+the response is streamed back chunk by chunk. The analysis (models, log
+storage, events and firewall) is the same as in :mod:`app.wsgi` and runs in
+the default executor. The log streams ``/stream/logs`` and
+``/stream/blocked`` are served here as well, one coroutine per client.
+
+The Flask panel keeps running as the WSGI application ``app.wsgi``; see the
+README for a Unit configuration routing the panel and the proxy to each.
+"""
+import asyncio
+import json
+import logging
+import time
+from urllib.parse import parse_qs
+
+import httpx
+
+from . import config, events, wsgi
+from .blocklist import blocklist
+from .upstream import RETRY_STATUSES, NoUpstreamAvailable, _h2_available
+
+logger = logging.getLogger(__name__)
+
+_client = None
+
+
+def _new_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        http2=config.UPSTREAM_HTTP2 and _h2_available(),
+        limits=httpx.Limits(
+            max_connections=config.UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=config.UPSTREAM_MAX_KEEPALIVE,
+            keepalive_expiry=config.UPSTREAM_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(config.UPSTREAM_TIMEOUT, pool=None),
+        follow_redirects=False,
+    )
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = _new_client()
+    return _client
+
+
+async def _lifespan(receive, send) -> None:
+    global _client
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            _get_client()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if _client is not None:
+                await _client.aclose()
+                _client = None
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def _send_text(send, status: int, text: str) -> None:
+    body = text.encode()
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (b"content-type", b"text/plain; charset=utf-8"),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+class _Body:
+    """Request body read from the ASGI channel.
+
+    :meth:`prefix` reads up to ``ANALYSIS_BODY_LIMIT`` bytes for the
+    analysis; :meth:`read` and :meth:`stream` return those bytes followed by
+    the rest.
+    """
+
+    def __init__(self, receive):
+        self.receive = receive
+        self.chunks = []
+        self.more = True
+
+    async def prefix(self) -> bytes:
+        size = sum(len(c) for c in self.chunks)
+        while self.more and size < config.ANALYSIS_BODY_LIMIT:
+            message = await self.receive()
+            if message["type"] == "http.disconnect":
+                self.more = False
+                break
+            chunk = message.get("body", b"")
+            self.more = message.get("more_body", False)
+            if chunk:
+                self.chunks.append(chunk)
+                size += len(chunk)
+        return b"".join(self.chunks)[: config.ANALYSIS_BODY_LIMIT]
+
+    async def read(self) -> bytes:
+        return b"".join([chunk async for chunk in self._chunks()])
+
+    async def _chunks(self):
+        chunks, self.chunks = self.chunks, []
+        for chunk in chunks:
+            yield chunk
+        while self.more:
+            message = await self.receive()
+            if message["type"] == "http.disconnect":
+                return
+            self.more = message.get("more_body", False)
+            if message.get("body"):
+                yield message["body"]
+
+    async def stream(self, check):
+        """Yield the body, holding back its final chunk for ``check``.
+
+        For a body of at least ``ANALYSIS_BODY_LIMIT`` bytes, ``check`` is
+        awaited with its first and last ``ANALYSIS_BODY_LIMIT`` bytes before
+        the final chunk is yielded, as in :func:`app.wsgi._body_stream`.
+        """
+        limit = config.ANALYSIS_BODY_LIMIT
+        head, tail, held = bytearray(), bytearray(), None
+        async for chunk in self._chunks():
+            room = max(0, limit - len(head))
+            head += chunk[:room]
+            tail += chunk[room:]
+            del tail[:-limit]
+            if held is not None:
+                yield held
+            held = chunk
+        if held is None:
+            return
+        if len(head) >= limit:
+            await check(bytes(head + tail))
+        yield held
+
+
+async def _open_upstream(scope, body):
+    """Send the request to a backend of ``wsgi.upstream``, as the WSGI path.
+
+    The backend is picked by the same pool (balancer, health checks and
+    circuit breakers); idempotent requests whose ``body`` is bytes are
+    retried on another backend within the retry budget.
+    """
+    headers = [
+        (k.decode("latin-1"), v.decode("latin-1"))
+        for k, v in scope["headers"]
+        if k.decode("latin-1").lower() not in wsgi.HOP_BY_HOP | {"host"}
+    ]
+    query = scope.get("query_string", b"").decode("latin-1")
+    pool = wsgi.upstream
+    pool.budget.deposit()
+    retryable = pool.can_retry(scope["method"], body)
+    client = _get_client()
+    tried = []
+    while True:
+        member, probe = pool.select(tried)
+        tried.append(member)
+        # The path is sent as the client wrote it, percent-encoding included
+        url = member.base_url + _raw_path(scope)
+        if query:
+            url = f"{url}?{query}"
+        request = client.build_request(scope["method"], url, headers=headers, content=body)
+        start = time.perf_counter()
+        member.begin()
+        try:
+            try:
+                response = await client.send(request, stream=True)
+            except httpx.TransportError:
+                member.end()
+                member.count_error()
+                member.observe(False)
+                if pool.should_retry(retryable, tried):
+                    continue
+                raise
+            except BaseException:
+                # e.g. the body was rejected while it was being sent
+                member.end()
+                raise
+            failed = response.status_code in RETRY_STATUSES
+            if failed:
+                member.count_error()
+            member.observe(not failed, (time.perf_counter() - start) * 1000)
+        finally:
+            if probe:
+                member.breaker.release()
+        if failed and pool.should_retry(retryable, tried):
+            await response.aclose()
+            member.end()
+            continue
+        response.extensions["upstream"] = member
+        return response
+
+
+def _raw_path(scope) -> str:
+    raw = scope.get("raw_path")
+    if raw:
+        return raw.decode("latin-1").partition("?")[0]
+    return scope["path"]
+
+
+def _has_body(scope) -> bool:
+    for key, value in scope["headers"]:
+        key = key.lower()
+        if key == b"content-length" and value.strip() not in (b"", b"0"):
+            return True
+        if key == b"transfer-encoding" and b"chunked" in value.lower():
+            return True
+    return False
+
+
+async def _relay(send, response: httpx.Response) -> None:
+    try:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": [
+                    (k.encode("latin-1"), v.encode("latin-1"))
+                    for k, v in response.headers.multi_items()
+                    if k.lower() not in wsgi.HOP_BY_HOP
+                ],
+            }
+        )
+        async for chunk in response.aiter_raw(config.STREAM_CHUNK_SIZE):
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+    finally:
+        await _close(response)
+
+
+async def _close(response: httpx.Response) -> None:
+    await response.aclose()
+    member = response.extensions.get("upstream")
+    if member is not None:
+        member.end()
+
+
+async def _discard(task: asyncio.Task) -> None:
+    try:
+        response = await task
+    except Exception:
+        return
+    await _close(response)
+
+
+async def _proxy(scope, receive, send) -> None:
+    method = scope["method"]
+    path = scope["path"]
+    query = scope.get("query_string", b"").decode("latin-1")
+    client = scope.get("client")
+    ip = client[0] if client else None
+    if blocklist.check(ip):
+        await _send_text(send, 403, "Bloqueado")
+        return
+    limited = wsgi.rate_limiter.check(ip, path)
+    if limited:
+        # Blocking runs the firewall command and the database insert
+        status = await asyncio.to_thread(wsgi.flood_status, ip, limited)
+        if status is not None:
+            await _send_text(send, status, "Bloqueado" if status == 403 else "Muitas requisições")
+            return
+    body = _Body(receive)
+    prefix = await body.prefix()
+    payload = prefix.decode("utf-8", "replace")
+    # The rules match the decoded path; the analysis sees the raw one that
+    # is forwarded
+    full_path = f"{_raw_path(scope)}?{query}"
+    args = (method, path, full_path, payload, ip)
+    async_route = wsgi._is_async_route(method, path)
+
+    async def check_tail(data: bytes) -> None:
+        tail = data.decode("utf-8", "replace")
+        if async_route:
+            # Not analyzed before the body was complete, as in ``wsgi._analyze``
+            wsgi.analysis_queue.submit(method, path, full_path, tail, ip, True)
+            return
+        if len(data) <= config.ANALYSIS_BODY_LIMIT:
+            # Nothing past the prefix already analyzed
+            return
+        if await asyncio.to_thread(wsgi.recheck_body, result, method, full_path, tail, ip):
+            logger.warning("Corpo da requisicao de %s recusado apos o limite de analise", ip)
+            raise wsgi.BodyRejected()
+
+    pending = result = None
+    if async_route:
+        # A body that reaches the analysis limit is analyzed once, head and
+        # tail, by ``check_tail``
+        if len(prefix) < config.ANALYSIS_BODY_LIMIT:
+            wsgi.analysis_queue.submit(*args, True)
+    else:
+        if (
+            method in wsgi.SAFE_METHODS
+            and not _has_body(scope)
+            and any(path.startswith(p) for p in config.SPECULATIVE_PREFIXES)
+        ):
+            # Forwarded while analyzed; held until the verdict
+            pending = asyncio.ensure_future(_open_upstream(scope, await body.read()))
+        result = await asyncio.to_thread(wsgi.evaluate_request, *args)
+
+    if isinstance(result, dict) and result.get("blocked"):
+        if pending is not None:
+            asyncio.ensure_future(_discard(pending))
+        await _send_text(send, 403, "Bloqueado")
+        return
+    try:
+        if pending is not None:
+            response = await pending
+        elif _has_body(scope):
+            response = await _open_upstream(scope, body.stream(check_tail))
+        else:
+            response = await _open_upstream(scope, await body.read())
+    except wsgi.BodyRejected:
+        await _send_text(send, 403, "Bloqueado")
+        return
+    except NoUpstreamAvailable:
+        await _send_text(send, 503, "Nenhum backend disponível")
+        return
+    except Exception as exc:
+        await _send_text(send, 502, f"Erro ao encaminhar: {exc}")
+        return
+    await _relay(send, response)
+
+
+async def _event_stream(send, listener, unregister, accept=None) -> None:
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+            ],
+        }
+    )
+    try:
+        while True:
+            entry = await listener.get()
+            if accept is not None and not accept(entry):
+                continue
+            data = f"data: {json.dumps(entry)}\n\n".encode()
+            await send({"type": "http.response.body", "body": data, "more_body": True})
+    finally:
+        unregister(listener)
+
+
+def _log_filter(query: str):
+    log_type = parse_qs(query).get("type", [None])[0]
+    if log_type == "threat":
+        return lambda entry: entry.get("is_attack")
+    if log_type == "common":
+        return lambda entry: not entry.get("is_attack")
+    return None
+
+
+async def application(scope, receive, send) -> None:
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+    path = scope["path"]
+    if path == "/stream/logs":
+        query = scope.get("query_string", b"").decode("latin-1")
+        await _event_stream(
+            send,
+            events.register_async_log_listener(),
+            events.unregister_log_listener,
+            _log_filter(query),
+        )
+        return
+    if path == "/stream/blocked":
+        await _event_stream(
+            send, events.register_async_blocked_listener(), events.unregister_blocked_listener
+        )
+        return
+    await _proxy(scope, receive, send)
@@ -0,0 +1,221 @@
+import os
+import hashlib
+import logging
+
+import torch
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+BACKEND_EAGER = "eager"
+BACKEND_ONNX = "onnx"
+BACKEND_ONNX_INT8 = "onnx-int8"
+BACKEND_QUANTIZED = "quantized"
+BACKENDS = (BACKEND_EAGER, BACKEND_ONNX, BACKEND_ONNX_INT8, BACKEND_QUANTIZED)
+# Part of the cache key of the exported files, with the torch version
+ONNX_OPSET = 14
+
+# Requests used to compare an optimized backend with the eager model before
+# switching over.
+PARITY_SAMPLES = [
+    "GET /index.html?page=1\n",
+    "GET /static/app.js\n",
+    "POST /login\nuser=admin&password=secret",
+    "GET /search?q=<script>alert(1)</script>\n",
+    "GET /item?id=1' OR '1'='1 --\n",
+    "GET /../../../../etc/passwd\n",
+    "POST /upload\n; cat /etc/passwd",
+]
+
+
+class _Output:
+    __slots__ = ("logits",)
+
+    def __init__(self, logits):
+        self.logits = logits
+
+
+class _LogitsOnly(torch.nn.Module):
+    """Expose a classifier as ``forward(*tensors) -> logits`` for export."""
+
+    def __init__(self, model, input_names):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *tensors):
+        return self.model(**dict(zip(self.input_names, tensors))).logits
+
+
+class OnnxClassifier:
+    """ONNX Runtime session with the ``model(**inputs).logits`` interface."""
+
+    def __init__(self, session, model_config):
+        self.session = session
+        self.config = model_config
+        self.input_names = [i.name for i in session.get_inputs()]
+
+    def __call__(self, **inputs):
+        feeds = {
+            name: inputs[name].cpu().numpy()
+            for name in self.input_names
+            if name in inputs
+        }
+        logits = self.session.run(["logits"], feeds)[0]
+        return _Output(torch.from_numpy(logits))
+
+
+def _revision(model_name: str, model) -> str:
+    """Return an id of the weights of ``model``.
+
+    Checkpoints from the Hub carry the resolved commit; for a local
+    directory the size and modification time of its files are hashed, and
+    as a last resort the parameters themselves.
+    """
+    commit = getattr(model.config, "_commit_hash", None)
+    if commit:
+        return commit
+    digest = hashlib.sha256()
+    if os.path.isdir(model_name):
+        for name in sorted(os.listdir(model_name)):
+            stat = os.stat(os.path.join(model_name, name))
+            digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    else:
+        for name, tensor in model.state_dict().items():
+            digest.update(name.encode())
+            digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()[:16]
+
+
+def _cache_dir(model_name: str, model) -> str:
+    """Return the cache directory of the export of this revision and settings."""
+    base = config.ONNX_CACHE_DIR
+    if not base:
+        from huggingface_hub import constants
+
+        base = os.path.join(constants.HF_HOME, "onnx")
+    settings = f"opset{ONNX_OPSET}-torch{torch.__version__.split('+')[0]}"
+    return os.path.join(
+        base, model_name.replace("/", "--"), f"{_revision(model_name, model)}-{settings}"
+    )
+
+
+def export_onnx(model_name: str, model, tokenizer) -> str:
+    """Export ``model`` to ONNX once and return the cached file path.
+
+    The file is keyed by the revision of the weights and the export
+    settings, so an updated checkpoint or another opset is exported again.
+    """
+    path = os.path.join(_cache_dir(model_name, model), "model.onnx")
+    if os.path.exists(path):
+        return path
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    sample = tokenizer(PARITY_SAMPLES[:2], padding=True, return_tensors="pt")
+    names = list(sample.keys())
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    logger.info("Exportando %s para ONNX em %s", model_name, path)
+    torch.onnx.export(
+        _LogitsOnly(model.cpu(), names),
+        tuple(sample[k] for k in names),
+        tmp_path,
+        input_names=names,
+        output_names=["logits"],
+        dynamic_axes={
+            **{k: {0: "batch", 1: "sequence"} for k in names},
+            "logits": {0: "batch"},
+        },
+        opset_version=ONNX_OPSET,
+    )
+    os.replace(tmp_path, path)
+    return path
+
+
+def quantize_onnx(onnx_path: str) -> str:
+    """Apply dynamic int8 quantization to an exported model, cached on disk.
+
+    The result is kept next to ``onnx_path``, so it follows its cache key.
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    path = os.path.join(os.path.dirname(onnx_path), "model.int8.onnx")
+    if not os.path.exists(path):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        quantize_dynamic(onnx_path, tmp_path, weight_type=QuantType.QInt8)
+        os.replace(tmp_path, path)
+    return path
+
+
+def _build(kind: str, model_name: str, model, tokenizer):
+    if kind == BACKEND_QUANTIZED:
+        return torch.quantization.quantize_dynamic(
+            model.cpu(), {torch.nn.Linear}, dtype=torch.qint8
+        )
+    import onnxruntime
+
+    path = export_onnx(model_name, model, tokenizer)
+    if kind == BACKEND_ONNX_INT8:
+        path = quantize_onnx(path)
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    session = onnxruntime.InferenceSession(
+        path, options, providers=["CPUExecutionProvider"]
+    )
+    return OnnxClassifier(session, model.config)
+
+
+def check_parity(reference, candidate, tokenizer) -> bool:
+    """Return True if ``candidate`` agrees with ``reference`` on the samples."""
+    inputs = tokenizer(
+        PARITY_SAMPLES,
+        padding=True,
+        truncation=True,
+        max_length=min(tokenizer.model_max_length, 512),
+        return_tensors="pt",
+    )
+    with torch.no_grad():
+        expected = torch.softmax(reference(**inputs).logits, dim=-1)
+        got = torch.softmax(candidate(**inputs).logits.float(), dim=-1)
+    same_label = bool(torch.equal(expected.argmax(dim=-1), got.argmax(dim=-1)))
+    max_diff = float((expected - got).abs().max().item())
+    if not same_label or max_diff > config.BACKEND_PARITY_TOLERANCE:
+        logger.warning(
+            "Backend divergente (rotulos iguais: %s, diferenca maxima: %.4f)",
+            same_label,
+            max_diff,
+        )
+        return False
+    return True
+
+
+def load_backend(role: str, model_name: str, model, tokenizer, device):
+    """Return ``model`` converted to the backend configured for ``role``.
+
+    Falls back to the eager model when the backend is unknown, unavailable,
+    not supported on ``device`` or fails the parity check.
+    """
+    kind = config.INFERENCE_BACKENDS.get(role, BACKEND_EAGER)
+    if kind == BACKEND_EAGER:
+        return model
+    if kind not in BACKENDS:
+        logger.warning("Backend de inferencia desconhecido: %s", kind)
+        return model
+    if torch.device(device).type != "cpu":
+        logger.info("Backend %s disponivel apenas em CPU; usando eager para %s", kind, model_name)
+        return model
+    if hasattr(model, "peft_config"):
+        logger.info("Modelo %s usa adaptadores LoRA; mantendo eager", model_name)
+        return model
+    try:
+        candidate = _build(kind, model_name, model, tokenizer)
+    except ImportError as exc:
+        logger.warning("Backend %s indisponivel (%s); usando eager", kind, exc)
+        return model
+    except Exception as exc:
+        logger.error("Erro ao preparar backend %s para %s: %s", kind, model_name, exc)
+        return model
+    if not check_parity(model, candidate, tokenizer):
+        logger.warning("Backend %s reprovado para %s; usando eager", kind, model_name)
+        return model
+    logger.info("Modelo %s usando backend %s", model_name, kind)
+    return candidate
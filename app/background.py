@@ -0,0 +1,155 @@
+import os
+import queue
+import threading
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+
+class AnalysisQueue:
+    """Bounded queue of requests analyzed after they were forwarded.
+
+    ``handler`` is called with the positional arguments given to
+    :meth:`submit` by ``workers`` daemon threads. When the queue is full the
+    job is dropped and counted instead of delaying the request.
+    """
+
+    def __init__(self, handler, maxsize: int = None, workers: int = None):
+        self.handler = handler
+        self.maxsize = config.ASYNC_QUEUE_SIZE if maxsize is None else int(maxsize)
+        self.workers = max(1, config.ASYNC_WORKERS if workers is None else int(workers))
+        self._lock = threading.Lock()
+        self._queue = None
+        self._threads = []
+        self._pid = None
+        self.submitted = 0
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def _ensure_workers(self) -> queue.Queue:
+        # Threads do not survive ``fork``; each process starts its own.
+        if self._pid == os.getpid():
+            return self._queue
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue(maxsize=max(1, self.maxsize))
+                self._threads = [
+                    threading.Thread(
+                        target=self._run,
+                        args=(self._queue,),
+                        name=f"async-analysis-{i}",
+                        daemon=True,
+                    )
+                    for i in range(self.workers)
+                ]
+                for thread in self._threads:
+                    thread.start()
+                self._pid = os.getpid()
+            return self._queue
+
+    def _run(self, q: queue.Queue) -> None:
+        while True:
+            args = q.get()
+            failed = False
+            try:
+                self.handler(*args)
+            except Exception as exc:
+                failed = True
+                logger.error("Erro na analise em segundo plano: %s", exc)
+            finally:
+                with self._lock:
+                    self.processed += 1
+                    if failed:
+                        self.errors += 1
+                q.task_done()
+
+    def submit(self, *args) -> bool:
+        """Queue a job; return False if it was dropped because the queue is full."""
+        try:
+            self._ensure_workers().put_nowait(args)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            logger.warning("Fila de analise em segundo plano cheia; requisicao descartada")
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def join(self) -> None:
+        """Wait until every queued job was processed."""
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "pending": self._queue.qsize() if self._pid == os.getpid() else 0,
+                "maxsize": self.maxsize,
+                "submitted": self.submitted,
+                "processed": self.processed,
+                "dropped": self.dropped,
+                "errors": self.errors,
+            }
+
+
+class Speculation:
+    """Upstream calls started before the verdict of their request.
+
+    ``start`` runs the call on a small thread pool. The caller then either
+    releases the response (request allowed) or discards it (request
+    blocked), so the client never sees a response that was not approved.
+    """
+
+    def __init__(self, workers: int = None):
+        self.workers = max(1, config.SPECULATIVE_WORKERS if workers is None else int(workers))
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self.started = 0
+        self.released = 0
+        self.discarded = 0
+
+    def _pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="speculative"
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def start(self, call) -> Future:
+        future = self._pool().submit(call)
+        with self._lock:
+            self.started += 1
+        return future
+
+    def release(self, future: Future):
+        with self._lock:
+            self.released += 1
+        return future.result()
+
+    def discard(self, future: Future) -> None:
+        with self._lock:
+            self.discarded += 1
+        if not future.cancel():
+            future.add_done_callback(_close_response)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "started": self.started,
+                "released": self.released,
+                "discarded": self.discarded,
+            }
+
+
+def _close_response(future: Future) -> None:
+    # Free the connection of a response that will never be sent
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
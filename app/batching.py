@@ -0,0 +1,158 @@
+import os
+import queue
+import threading
+import time
+import logging
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+
+def group_by_length(lengths: list, max_ratio: float) -> list:
+    """Split indices into groups of similar length to limit padding.
+
+    Indices are sorted by length and a new group starts whenever an item is
+    longer than ``max_ratio`` times the shortest item of the current group.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    groups = []
+    current = []
+    for idx in order:
+        if current and lengths[idx] > max(1, lengths[current[0]]) * max_ratio:
+            groups.append(current)
+            current = []
+        current.append(idx)
+    if current:
+        groups.append(current)
+    return groups
+
+
+class _Pending:
+    __slots__ = ("text", "skip", "event", "result", "error")
+
+    def __init__(self, text: str, skip=frozenset()):
+        self.text = text
+        self.skip = frozenset(skip)
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class BatchScheduler:
+    """Gather concurrent ``analyze`` calls into batched detector passes.
+
+    Callers block until their result is available. The worker thread waits at
+    most ``max_wait_ms`` after the first queued request before running the
+    batch, which bounds the extra latency added to each request.
+    """
+
+    def __init__(self, detector, max_wait_ms: float = None, max_batch: int = None):
+        self.detector = detector
+        if max_wait_ms is None:
+            max_wait_ms = config.BATCH_MAX_WAIT_MS
+        if max_batch is None:
+            max_batch = config.BATCH_MAX_SIZE
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.max_batch = max(1, int(max_batch))
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self.batches = 0
+        self.requests = 0
+
+    def _worker_alive(self) -> bool:
+        return (
+            self._thread is not None
+            and self._thread.is_alive()
+            and self._pid == os.getpid()
+        )
+
+    def _ensure_worker(self) -> queue.Queue:
+        # The worker thread does not survive ``fork``; a child process gets a
+        # fresh queue and thread on its first call.
+        if self._worker_alive():
+            return self._queue
+        with self._lock:
+            if not self._worker_alive():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                self._thread = threading.Thread(
+                    target=self._run,
+                    args=(self._queue,),
+                    name="batch-scheduler",
+                    daemon=True,
+                )
+                self._thread.start()
+            return self._queue
+
+    def _run(self, q: queue.Queue) -> None:
+        while True:
+            batch = [q.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(q.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._dispatch(batch)
+
+    def _dispatch(self, batch: list) -> None:
+        # Requests shedding different stages cannot share a detector pass
+        groups = {}
+        for pending in batch:
+            groups.setdefault(pending.skip, []).append(pending)
+        for skip, group in groups.items():
+            self._dispatch_group(group, skip)
+
+    def _dispatch_group(self, batch: list, skip: frozenset) -> None:
+        try:
+            texts = [p.text for p in batch]
+            if skip:
+                results = self.detector.analyze_batch(texts, skip=skip)
+            else:
+                results = self.detector.analyze_batch(texts)
+            for pending, result in zip(batch, results):
+                pending.result = result
+        except Exception as exc:
+            logger.error("Erro na analise em lote: %s", exc)
+            for pending in batch:
+                pending.error = exc
+        finally:
+            self.batches += 1
+            self.requests += len(batch)
+            for pending in batch:
+                pending.event.set()
+
+    def submit(self, text: str, skip=frozenset()) -> _Pending:
+        """Queue ``text`` for analysis and return its pending handle."""
+        pending = _Pending(text, skip)
+        self._ensure_worker().put(pending)
+        return pending
+
+    def analyze_batch(self, texts: list, skip=frozenset()) -> list:
+        pendings = [self.submit(text, skip) for text in texts]
+        results = []
+        for pending in pendings:
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            results.append(pending.result)
+        return results
+
+    def analyze(self, text: str, skip=frozenset()) -> dict:
+        return self.analyze_batch([text], skip)[0]
+
+    def stats(self) -> dict:
+        """Return counters describing the batches processed so far."""
+        return {
+            "batches": self.batches,
+            "requests": self.requests,
+            "avg_batch_size": (
+                round(self.requests / self.batches, 2) if self.batches else 0.0
+            ),
+        }
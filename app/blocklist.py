@@ -0,0 +1,149 @@
+"""In-memory set of blocked IPs checked before any analysis.
+
+The UFW rules only cover the backend port, so requests from a blocked
+address still reach the proxy. The proxy rejects them with this set instead
+of running the models again. It is loaded from ``blocked_ips`` and kept up
+to date by :mod:`app.db` whenever an IP is blocked or unblocked; it is also
+reloaded every ``BLOCKLIST_REFRESH`` seconds to pick up changes made by
+other processes. With ``SHARED_STATE`` the set lives in a shared-memory
+table, so a block or unblock applies at once to every worker of the host.
+That table never evicts: a block that does not fit is logged instead of
+silently pushing out another one. Each entry holds the time it was added,
+and only one worker per refresh period reloads the table; the reload only
+removes entries older than its database snapshot, so a block recorded
+meanwhile by another worker is kept.
+"""
+import struct
+import threading
+import time
+import logging
+
+from . import config
+from .shm import open_table
+
+logger = logging.getLogger(__name__)
+
+_ADDED = struct.Struct("<d")
+# Time of the last reload of the shared table; not a valid IP address
+_RELOAD_KEY = "#reload"
+
+
+def _added(value: bytes) -> float:
+    return _ADDED.unpack(value)[0] if len(value) == _ADDED.size else 0.0
+
+
+class Blocklist:
+    def __init__(self, refresh: float = None, shared=None):
+        self.refresh = config.BLOCKLIST_REFRESH if refresh is None else float(refresh)
+        self.shared = shared
+        self._ips = frozenset()
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self.short_circuited = 0
+
+    def load(self) -> None:
+        """Replace the set with the IPs currently blocked in the database."""
+        from . import db
+
+        started = time.time()
+        try:
+            ips = db.get_active_blocked_ips()
+        except Exception as exc:
+            logger.error("Erro ao carregar IPs bloqueados: %s", exc)
+            return
+        if ips is None:
+            # No database: the set only holds the blocks seen by this process
+            self._loaded_at = time.monotonic()
+            return
+        ips = frozenset(ips)
+        with self._lock:
+            self._ips = ips
+            self._loaded_at = time.monotonic()
+        if self.shared is not None:
+            self._sync_shared(ips, started)
+
+    def _shared_ips(self) -> set:
+        return {key for key in self.shared.keys() if key != _RELOAD_KEY}
+
+    def _sync_shared(self, ips: frozenset, started: float) -> None:
+        current = self._shared_ips()
+        for ip in current - ips:
+            # Blocked after the snapshot was taken: the next reload sees it
+            self.shared.delete(ip, check=lambda value: _added(value) < started)
+        for ip in ips - current:
+            self._put_shared(ip, started)
+
+    def _put_shared(self, ip: str, added: float) -> None:
+        if not self.shared.put(ip, _ADDED.pack(added)):
+            logger.error(
+                "Tabela compartilhada de IPs bloqueados cheia; %s nao foi incluido "
+                "(aumente SHARED_BLOCKLIST_SLOTS)",
+                ip,
+            )
+
+    def _claim_reload(self) -> bool:
+        """Return True if this process takes the reload of the shared table."""
+        now = time.time()
+        claimed = []
+
+        def claim(old):
+            last = _added(old) if old else 0.0
+            claimed.append(now - last >= self.refresh)
+            return _ADDED.pack(now if claimed[0] else last)
+
+        self.shared.update(_RELOAD_KEY, claim)
+        return claimed[0]
+
+    def _maybe_reload(self) -> None:
+        loaded_at = self._loaded_at
+        if loaded_at is None or (
+            self.refresh > 0 and time.monotonic() - loaded_at >= self.refresh
+        ):
+            # Only one thread reloads; the others keep using the current set
+            if self._lock.acquire(blocking=False):
+                try:
+                    self._loaded_at = time.monotonic()
+                finally:
+                    self._lock.release()
+                if self.shared is None or self._claim_reload():
+                    self.load()
+
+    def add(self, ip: str) -> None:
+        with self._lock:
+            self._ips = self._ips | {ip}
+        if self.shared is not None:
+            self._put_shared(ip, time.time())
+
+    def discard(self, ip: str) -> None:
+        with self._lock:
+            self._ips = self._ips - {ip}
+        if self.shared is not None:
+            self.shared.delete(ip)
+
+    def __contains__(self, ip: str) -> bool:
+        if self.shared is not None:
+            return ip in self.shared
+        return ip in self._ips
+
+    def __len__(self) -> int:
+        if self.shared is not None:
+            return len(self._shared_ips())
+        return len(self._ips)
+
+    def check(self, ip: str) -> bool:
+        """Return True (and count it) if requests from ``ip`` must be rejected."""
+        if not ip:
+            return False
+        self._maybe_reload()
+        if ip in self:
+            self.short_circuited += 1
+            return True
+        return False
+
+    def stats(self) -> dict:
+        return {"size": len(self), "short_circuited": self.short_circuited}
+
+
+blocklist = Blocklist(
+    shared=open_table("blocked", config.SHARED_BLOCKLIST_SLOTS, evict=False)
+)
@@ -1,5 +1,5 @@
 import os
-from typing import Tuple
+from typing import List, Tuple
 
 # Reduce TensorFlow verbosity and avoid GPU initialization messages when
 # running on systems without the necessary CUDA libraries.  The environment
@@ -8,23 +8,50 @@ os.environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "2")
 os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
 
 from tensorflow.keras.models import load_model
-from sentence_transformers import SentenceTransformer
 from huggingface_hub import hf_hub_download
 import numpy as np
 
+from .encoders import get_sentence_encoder
+
+
 class CNNGRUModel:
     """Wrapper for the YangYang-Research/web-attack-detection model."""
 
-    def __init__(self, repo_id: str = "YangYang-Research/web-attack-detection", filename: str = "model.h5") -> None:
+    def __init__(
+        self,
+        repo_id: str = "YangYang-Research/web-attack-detection",
+        filename: str = "model.h5",
+        device: str = None,
+    ) -> None:
         local_model = hf_hub_download(repo_id=repo_id, filename=filename)
         self.model = load_model(local_model)
-        enc_name = os.environ.get("CNN_GRU_ENCODER", "sentence-transformers/all-MiniLM-L6-v2")
-        self.encoder = SentenceTransformer(enc_name)
+        self.encoder_name = os.environ.get("CNN_GRU_ENCODER", "sentence-transformers/all-MiniLM-L6-v2")
+        self.encoder = get_sentence_encoder(self.encoder_name, device)
         self.repo_id = repo_id
 
+    def predict_from_embeddings(self, embs) -> List[Tuple[str, list]]:
+        """Return label and probability for each pre-computed embedding.
+
+        The embeddings must come from ``self.encoder`` without normalization,
+        exactly as :meth:`predict_from_texts` would produce them.
+        """
+        embs = np.asarray(embs, dtype=np.float32)
+        probs = self.model.predict(embs, verbose=0)[:, 0]
+        results = []
+        for prob in probs:
+            prob = float(prob)
+            label = "webattack" if prob >= 0.5 else "normal"
+            results.append((label, [1 - prob, prob]))
+        return results
+
+    def predict_from_embedding(self, emb) -> Tuple[str, list]:
+        """Return label and probability for a single pre-computed embedding."""
+        return self.predict_from_embeddings(np.asarray(emb).reshape((1, -1)))[0]
+
     def predict_from_text(self, text: str) -> Tuple[str, list]:
         """Return label and probability for the given text."""
-        emb = self.encoder.encode(text).reshape((1, -1))
-        prob = float(self.model.predict(emb)[0][0])
-        label = "webattack" if prob >= 0.5 else "normal"
-        return label, [1 - prob, prob]
+        return self.predict_from_embedding(self.encoder.encode(text))
+
+    def predict_from_texts(self, texts: List[str]) -> List[Tuple[str, list]]:
+        """Return label and probability for each text using a single batch."""
+        return self.predict_from_embeddings(self.encoder.encode(list(texts)))
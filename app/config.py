@@ -46,6 +46,9 @@ NIDS_BASE_MODEL = os.getenv('NIDS_BASE_MODEL')
 
 
 SEMANTIC_THRESHOLD = float(os.getenv('SEMANTIC_THRESHOLD', '0.5'))
+# Number of recent embeddings compared against each request. The window is a
+# preallocated matrix, so large values (tens of thousands) only cost memory.
+SEMANTIC_WINDOW = int(os.getenv('SEMANTIC_WINDOW', '100'))
 BLOCK_SEVERITY_LEVELS = [s.strip().lower() for s in os.getenv('BLOCK_SEVERITY_LEVELS', 'error,high').split(',')]
 BLOCK_ANOMALY_THRESHOLD = float(os.getenv('BLOCK_ANOMALY_THRESHOLD', '0.5'))
 
@@ -55,10 +58,187 @@ ENSEMBLE_W_ATTACK = float(os.getenv('ENSEMBLE_W_ATTACK', '0.4'))
 ENSEMBLE_THRESHOLD = float(os.getenv('ENSEMBLE_THRESHOLD', '0.5'))
 ENSEMBLE_OVERRIDE_ANOMALY = os.getenv('ENSEMBLE_OVERRIDE_ANOMALY', 'true').lower() == 'true'
 
+# Cascade mode: the semantic encoder and the primary NIDS model run first and
+# requests whose attack probability is below ``CASCADE_LOW`` skip the
+# remaining models. Suspicious requests always get the full ensemble so the
+# severity verdict used for blocking is computed.
+CASCADE_MODE = os.getenv('CASCADE_MODE', 'false').lower() == 'true'
+CASCADE_LOW = float(os.getenv('CASCADE_LOW', '0.1'))
+
 DEVICE = os.getenv('DEVICE', 'cpu')
+
+# Inference backend per model role: ``eager`` (PyTorch), ``onnx`` (ONNX
+# Runtime), ``onnx-int8`` (ONNX Runtime with int8 weights) or ``quantized``
+# (PyTorch dynamic int8). ``INFERENCE_BACKEND`` is the default for every role
+# and ``INFERENCE_BACKEND_<ROLE>`` overrides it. Optimized backends are only
+# used on CPU and after matching the eager model on a sample set within
+# ``BACKEND_PARITY_TOLERANCE``. Exported ONNX files are cached in
+# ``ONNX_CACHE_DIR`` (default ``$HF_HOME/onnx``).
+INFERENCE_BACKEND = os.getenv('INFERENCE_BACKEND', 'eager').lower()
+INFERENCE_BACKENDS = {
+    role: os.getenv(f'INFERENCE_BACKEND_{role.upper()}', INFERENCE_BACKEND).lower()
+    for role in ('severity', 'anomaly', 'nids')
+}
+BACKEND_PARITY_TOLERANCE = float(os.getenv('BACKEND_PARITY_TOLERANCE', '0.05'))
+ONNX_CACHE_DIR = os.getenv('ONNX_CACHE_DIR')
+
+# Input shaping before tokenization: request texts are cut to
+# ``INPUT_MAX_CHARS`` characters (0 disables) keeping a head and a tail window
+# of the payload, ``INPUT_HEAD_RATIO`` being the share of the head. With
+# ``LENGTH_BUCKETS`` (e.g. ``64,128,256,512``) token sequences are padded to
+# the next bucket so optimized backends see a few fixed shapes.
+INPUT_MAX_CHARS = int(os.getenv('INPUT_MAX_CHARS', '4096'))
+INPUT_HEAD_RATIO = float(os.getenv('INPUT_HEAD_RATIO', '0.6'))
+LENGTH_BUCKETS = sorted(
+    int(s) for s in os.getenv('LENGTH_BUCKETS', '').split(',') if s.strip()
+)
+
+# Micro-batching: concurrent requests are grouped and each model runs once per
+# batch. ``BATCH_MAX_WAIT_MS`` bounds the extra latency added to a request and
+# ``BATCH_PAD_RATIO`` controls how different in length the texts padded
+# together in a single forward pass may be.
+BATCH_INFERENCE = os.getenv('BATCH_INFERENCE', 'false').lower() == 'true'
+BATCH_MAX_WAIT_MS = float(os.getenv('BATCH_MAX_WAIT_MS', '3'))
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', '16'))
+BATCH_PAD_RATIO = float(os.getenv('BATCH_PAD_RATIO', '1.5'))
+
+# Run the independent model stages of one analysis concurrently on a
+# dedicated pool. ``INTRA_OP_THREADS=0`` splits the CPU cores evenly among
+# the ``INFERENCE_WORKERS`` threads.
+PARALLEL_STAGES = os.getenv('PARALLEL_STAGES', 'false').lower() == 'true'
+INFERENCE_WORKERS = int(os.getenv('INFERENCE_WORKERS', '4'))
+INTRA_OP_THREADS = int(os.getenv('INTRA_OP_THREADS', '0'))
+
+# Optional inference daemon. When ``INFERENCE_SOCKET`` is set the proxy does
+# not load any model and sends analyses to ``python -m app.inference_server``
+# listening on that Unix socket path.
+INFERENCE_SOCKET = os.getenv('INFERENCE_SOCKET')
+INFERENCE_TIMEOUT = float(os.getenv('INFERENCE_TIMEOUT', '30'))
+INFERENCE_MAX_FRAME = int(os.getenv('INFERENCE_MAX_FRAME', str(64 * 1024 * 1024)))
+
+# Seconds between reloads of the in-memory blocklist from ``blocked_ips``
+# (``0`` loads it only once; blocks made by this process apply at once).
+BLOCKLIST_REFRESH = float(os.getenv('BLOCKLIST_REFRESH', '30'))
+
+# Token buckets checked before the analysis: ``RATE_LIMIT_IP`` requests per
+# ``RATE_LIMIT_WINDOW`` seconds for each client (over that the IP is blocked
+# as ``dos``), ``RATE_LIMIT_SUBNET`` per /24 (IPv4) or /64 (IPv6) network and
+# ``RATE_LIMIT_PATHS`` (``prefix=limit`` pairs) for all clients of a path
+# prefix; the last two answer 429. ``0`` disables a limit.
+RATE_LIMIT_WINDOW = float(os.getenv('RATE_LIMIT_WINDOW', '10'))
+RATE_LIMIT_IP = int(os.getenv('RATE_LIMIT_IP', '20'))
+RATE_LIMIT_SUBNET = int(os.getenv('RATE_LIMIT_SUBNET', '0'))
+RATE_LIMIT_SUBNET_V4 = int(os.getenv('RATE_LIMIT_SUBNET_V4', '24'))
+RATE_LIMIT_SUBNET_V6 = int(os.getenv('RATE_LIMIT_SUBNET_V6', '64'))
+RATE_LIMIT_PATHS = {
+    prefix.strip(): int(limit)
+    for prefix, _, limit in (
+        s.partition('=') for s in os.getenv('RATE_LIMIT_PATHS', '').split(',')
+    )
+    if prefix.strip() and limit.strip()
+}
+RATE_LIMIT_MAX_KEYS = int(os.getenv('RATE_LIMIT_MAX_KEYS', '100000'))
+
+# State shared by every proxy process of the host through memory-mapped
+# tables (``SHARED_STATE_PATH-<name>``, under ``/dev/shm`` by default): the
+# rate-limit buckets, the blocked IPs and the verdict cache. Each table has a
+# fixed number of slots; verdicts larger than a slot stay per process.
+SHARED_STATE = os.getenv('SHARED_STATE', 'false').lower() == 'true'
+SHARED_STATE_PATH = os.getenv('SHARED_STATE_PATH', '/dev/shm/nginx_unit_ia')
+SHARED_LOCK_STRIPES = int(os.getenv('SHARED_LOCK_STRIPES', '64'))
+SHARED_RATE_LIMIT_SLOTS = int(os.getenv('SHARED_RATE_LIMIT_SLOTS', '65536'))
+SHARED_BLOCKLIST_SLOTS = int(os.getenv('SHARED_BLOCKLIST_SLOTS', '16384'))
+SHARED_VERDICT_SLOTS = int(os.getenv('SHARED_VERDICT_SLOTS', '4096'))
+SHARED_VERDICT_SLOT_SIZE = int(os.getenv('SHARED_VERDICT_SLOT_SIZE', '8192'))
+
+# Verdict cache keyed by the normalized request text. ``VERDICT_CACHE_SIZE=0``
+# disables the cache; ``VERDICT_CACHE_TTL`` is given in seconds.
+VERDICT_CACHE_SIZE = int(os.getenv('VERDICT_CACHE_SIZE', '2048'))
+VERDICT_CACHE_TTL = float(os.getenv('VERDICT_CACHE_TTL', '300'))
+
+# Latency objective for the analysis. ``ANALYSIS_DEADLINE_MS=0`` disables it.
+# When the estimated latency exceeds ``SLO_TARGET_RATIO`` of the deadline the
+# stages listed in ``SHED_ORDER`` are skipped, first to last. ``SLO_FAIL_POLICY``
+# is ``open`` (forward the request unanalyzed) or ``closed`` (answer 403) when
+# the deadline expires; ``SLO_CONCURRENCY`` is the number of analyses run at
+# once and ``SLO_MAX_QUEUE`` how many more may wait for a slot before new
+# requests get the fail policy right away.
+ANALYSIS_DEADLINE_MS = float(os.getenv('ANALYSIS_DEADLINE_MS', '0'))
+SHED_ORDER = [
+    s.strip()
+    for s in os.getenv('SHED_ORDER', 'nids_secondary,semantic,severity').split(',')
+    if s.strip()
+]
+SLO_TARGET_RATIO = float(os.getenv('SLO_TARGET_RATIO', '0.8'))
+SLO_FAIL_POLICY = os.getenv('SLO_FAIL_POLICY', 'open').lower()
+SLO_CONCURRENCY = int(os.getenv('SLO_CONCURRENCY', '4'))
+SLO_MAX_QUEUE = int(os.getenv('SLO_MAX_QUEUE', '16'))
+
+# Detect-only routes: requests whose path starts with one of
+# ``ASYNC_ANALYSIS_PREFIXES`` or whose method is in ``ASYNC_ANALYSIS_METHODS``
+# are forwarded at once and analyzed afterwards by ``ASYNC_WORKERS`` threads.
+# Up to ``ASYNC_QUEUE_SIZE`` requests wait for analysis; extra ones are
+# dropped.
+ASYNC_ANALYSIS_PREFIXES = [
+    s.strip() for s in os.getenv('ASYNC_ANALYSIS_PREFIXES', '').split(',') if s.strip()
+]
+ASYNC_ANALYSIS_METHODS = [
+    s.strip().upper() for s in os.getenv('ASYNC_ANALYSIS_METHODS', '').split(',') if s.strip()
+]
+ASYNC_QUEUE_SIZE = int(os.getenv('ASYNC_QUEUE_SIZE', '1000'))
+ASYNC_WORKERS = int(os.getenv('ASYNC_WORKERS', '1'))
+
+# Speculative forwarding: GET/HEAD/OPTIONS requests on paths starting with one
+# of ``SPECULATIVE_PREFIXES`` are sent upstream while being analyzed; the
+# response is only released if the request is allowed. Other methods are
+# never forwarded before the verdict.
+SPECULATIVE_PREFIXES = [
+    s.strip() for s in os.getenv('SPECULATIVE_PREFIXES', '').split(',') if s.strip()
+]
+SPECULATIVE_WORKERS = int(os.getenv('SPECULATIVE_WORKERS', '16'))
+
 WEB_PANEL_PORT = int(os.getenv('WEB_PANEL_PORT', '8080'))
 UNIT_PORT = int(os.getenv('UNIT_PORT', '8090'))
+# Number of proxy processes forked by ``python -m app.main`` after loading the
+# models once (values above 1 enable the preload-then-fork mode).
+PROXY_WORKERS = int(os.getenv('PROXY_WORKERS', '1'))
 BACKEND_URL = os.getenv('BACKEND_URL', 'http://hello:8000')
+# Several replicas can be given in ``BACKEND_URLS`` (comma separated); it
+# defaults to ``BACKEND_URL``. ``UPSTREAM_BALANCER`` is ``least_conn`` or
+# ``ewma`` (latency weighted by open requests).
+BACKEND_URLS = [
+    s.strip().rstrip('/')
+    for s in os.getenv('BACKEND_URLS', BACKEND_URL).split(',')
+    if s.strip()
+]
+UPSTREAM_BALANCER = os.getenv('UPSTREAM_BALANCER', 'least_conn').lower()
+# Active health check of every backend (``HEALTH_CHECK_INTERVAL=0`` disables
+# it) and circuit breaker opened after ``CIRCUIT_FAILURES`` consecutive
+# failures for ``CIRCUIT_RESET`` seconds.
+HEALTH_CHECK_INTERVAL = float(os.getenv('HEALTH_CHECK_INTERVAL', '10'))
+HEALTH_CHECK_PATH = os.getenv('HEALTH_CHECK_PATH', '/')
+CIRCUIT_FAILURES = int(os.getenv('CIRCUIT_FAILURES', '5'))
+CIRCUIT_RESET = float(os.getenv('CIRCUIT_RESET', '30'))
+# Idempotent requests without a streamed body are retried on another backend
+# up to ``RETRY_ATTEMPTS`` times, for at most ``RETRY_BUDGET`` of the traffic.
+RETRY_ATTEMPTS = int(os.getenv('RETRY_ATTEMPTS', '1'))
+RETRY_BUDGET = float(os.getenv('RETRY_BUDGET', '0.2'))
+# Pooled upstream client: connections to ``BACKEND_URL`` are kept alive and
+# reused. ``UPSTREAM_HTTP2`` requires the ``h2`` package (``httpx[http2]``).
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv('UPSTREAM_MAX_CONNECTIONS', '100'))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv('UPSTREAM_MAX_KEEPALIVE', '20'))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv('UPSTREAM_KEEPALIVE_EXPIRY', '30'))
+UPSTREAM_HTTP2 = os.getenv('UPSTREAM_HTTP2', 'false').lower() == 'true'
+UPSTREAM_TIMEOUT = float(os.getenv('UPSTREAM_TIMEOUT', '5'))
+# Cache of upstream responses to benign GET requests, bounded by the total
+# size in bytes (``0`` disables it); larger responses are never stored.
+RESPONSE_CACHE_BYTES = int(os.getenv('RESPONSE_CACHE_BYTES', '0'))
+RESPONSE_CACHE_MAX_ENTRY = int(os.getenv('RESPONSE_CACHE_MAX_ENTRY', str(1024 * 1024)))
+# Bodies are streamed in both directions in ``STREAM_CHUNK_SIZE`` chunks; the
+# first and the last ``ANALYSIS_BODY_LIMIT`` bytes of a request body are
+# analyzed, the last ones before the final chunk is forwarded.
+ANALYSIS_BODY_LIMIT = int(os.getenv('ANALYSIS_BODY_LIMIT', '65536'))
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', '65536'))
 LOG_FILE = os.getenv('LOG_FILE', 'app.log')
 # Ipinfo configuration
 IPINFO_TOKEN = os.getenv('IPINFO_TOKEN')
@@ -76,3 +256,23 @@ if LOG_FILE and not os.path.isabs(LOG_FILE):
     BASE_DIR = os.path.dirname(os.path.abspath(__file__))
     LOG_FILE = os.path.join(BASE_DIR, LOG_FILE)
 UNIT_BACKEND_PORT = int(os.getenv('UNIT_BACKEND_PORT', '18080'))
+
+# Firewall used to block IPs on ``UNIT_BACKEND_PORT``: ``ufw`` (one rule per
+# IP), ``nftables`` or ``ipset`` (hash sets looked up in O(1) by the kernel).
+# Blocks are applied by a background thread in batches gathered over
+# ``FIREWALL_BATCH_INTERVAL`` seconds; a failed operation is retried with
+# exponential backoff up to ``FIREWALL_RETRY_MAX`` times.
+FIREWALL_BACKEND = os.getenv('FIREWALL_BACKEND', 'ufw').lower()
+FIREWALL_BATCH_INTERVAL = float(os.getenv('FIREWALL_BATCH_INTERVAL', '0.5'))
+FIREWALL_RETRY_MAX = int(os.getenv('FIREWALL_RETRY_MAX', '5'))
+NFT_TABLE = os.getenv('NFT_TABLE', 'nginx_unit_ia')
+IPSET_NAME = os.getenv('IPSET_NAME', 'nginx_unit_ia')
+# Seconds between comparisons of the firewall rules with ``blocked_ips``,
+# made by a background thread (``0`` disables them). Only the process holding
+# the ``FIREWALL_RECONCILE_LOCK`` file lock reconciles, and rows changed less
+# than ``FIREWALL_RECONCILE_GRACE`` seconds ago are left for a later pass.
+FIREWALL_RECONCILE_INTERVAL = float(os.getenv('FIREWALL_RECONCILE_INTERVAL', '60'))
+FIREWALL_RECONCILE_LOCK = os.getenv(
+    'FIREWALL_RECONCILE_LOCK', '/tmp/nginx_unit_ia-reconcile.lock'
+)
+FIREWALL_RECONCILE_GRACE = float(os.getenv('FIREWALL_RECONCILE_GRACE', '60'))
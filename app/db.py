@@ -4,6 +4,7 @@ from pathlib import Path
 import psycopg2
 from psycopg2.extras import RealDictCursor, Json
 from . import config
+from .blocklist import blocklist
 
 
 def _is_attack_label(label: str) -> bool:
@@ -17,9 +18,14 @@ def _is_attack_entry(nids: dict) -> bool:
 
 
 conn = None
-if config.POSTGRES_HOST:
+
+
+def open_connection():
+    """Return a new autocommit connection, or None without a database."""
+    if not config.POSTGRES_HOST:
+        return None
     try:
-        conn = psycopg2.connect(
+        connection = psycopg2.connect(
             dbname=config.POSTGRES_DB,
             user=config.POSTGRES_USER,
             password=config.POSTGRES_PASSWORD,
@@ -27,9 +33,19 @@ if config.POSTGRES_HOST:
             port=config.POSTGRES_PORT,
         )
     except Exception:
-        conn = None
-    if conn is not None:
-        conn.autocommit = True
+        return None
+    connection.autocommit = True
+    return connection
+
+
+def connect():
+    """Open the module connection, e.g. again in a forked worker."""
+    global conn
+    conn = open_connection()
+    return conn
+
+
+connect()
 
 SCHEMA_PATH = Path(__file__).resolve().parent.parent / "schema.sql"
 
@@ -53,12 +69,13 @@ def save_log(
     ip_info=None,
     *,
     is_attack=None,
+    pipeline=None,
 ):
     """Persist the log in the appropriate table based on attack classification.
 
     The ``is_attack`` flag can be provided directly. When omitted, the value is
     derived from the NIDS result as in previous versions for backward
-    compatibility.
+    compatibility. ``pipeline`` records which detector stages ran.
     """
     if conn is None:
         return None
@@ -68,8 +85,8 @@ def save_log(
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
         cur.execute(
             """
-            INSERT INTO logs (iface, log, ip, ip_info, severity, anomaly, nids, semantic, is_attack)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            INSERT INTO logs (iface, log, ip, ip_info, severity, anomaly, nids, semantic, is_attack, pipeline)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
             RETURNING id, created_at
             """,
             (
@@ -82,16 +99,44 @@ def save_log(
                 Json(nids),
                 Json(semantic) if semantic is not None else None,
                 is_attack,
+                Json(pipeline) if pipeline is not None else None,
             ),
         )
         row = cur.fetchone()
         return row["id"], row["created_at"]
 
 
-def save_blocked_ip(ip, reason, status="blocked", ip_info=None):
+def update_log(log_id, severity, anomaly, nids, semantic=None, *, is_attack, pipeline=None):
+    """Replace the verdict stored for the log ``log_id``."""
     if conn is None:
         return
-    with conn.cursor(cursor_factory=RealDictCursor) as cur:
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE logs SET severity=%s, anomaly=%s, nids=%s, semantic=%s,
+                is_attack=%s, pipeline=%s
+            WHERE id=%s
+            """,
+            (
+                Json(severity),
+                Json(anomaly),
+                Json(nids),
+                Json(semantic) if semantic is not None else None,
+                is_attack,
+                Json(pipeline) if pipeline is not None else None,
+                log_id,
+            ),
+        )
+
+
+def save_blocked_ip(ip, reason, status="blocked", ip_info=None, connection=None):
+    """Record a block; ``connection`` defaults to the module connection."""
+    if status == "blocked":
+        blocklist.add(ip)
+    connection = connection or conn
+    if connection is None:
+        return
+    with connection.cursor(cursor_factory=RealDictCursor) as cur:
         cur.execute(
             """
             INSERT INTO blocked_ips (ip, reason, ip_info, status)
@@ -101,6 +146,17 @@ def save_blocked_ip(ip, reason, status="blocked", ip_info=None):
         )
 
 
+def set_blocked_ip_info(ip, ip_info):
+    """Fill in ``ip_info`` of the blocks of ``ip`` recorded without it."""
+    if conn is None or ip_info is None:
+        return
+    with conn.cursor() as cur:
+        cur.execute(
+            "UPDATE blocked_ips SET ip_info=%s WHERE ip=%s AND ip_info IS NULL",
+            (Json(ip_info), ip),
+        )
+
+
 def get_logs(limit=100, offset=0):
     if conn is None:
         return []
@@ -183,17 +239,28 @@ def get_logs_by_ip(ip: str, limit: int = 20):
         return cur.fetchall()
 
 
+def get_active_blocked_ips():
+    if conn is None:
+        return None
+    with conn.cursor() as cur:
+        cur.execute("SELECT ip FROM blocked_ips WHERE status='blocked'")
+        return {row[0] for row in cur.fetchall()}
+
+
 def unblock_ip(ip: str):
+    blocklist.discard(ip)
     if conn is None:
         return
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
         cur.execute(
-            "UPDATE blocked_ips SET status='unblocked' WHERE ip=%s AND status='blocked'",
+            "UPDATE blocked_ips SET status='unblocked', updated_at=NOW() "
+            "WHERE ip=%s AND status='blocked'",
             (ip,),
         )
 
 
 def add_whitelist_ip(ip: str):
+    blocklist.discard(ip)
     if conn is None:
         return
     with conn.cursor(cursor_factory=RealDictCursor) as cur:
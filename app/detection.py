@@ -1,11 +1,23 @@
 from transformers import AutoTokenizer, AutoModelForSequenceClassification
 from peft import PeftModel
-from sentence_transformers import SentenceTransformer, util
 import torch
+import torch.nn.functional as F
+import gc
+import hashlib
 import logging
-from collections import deque
+import os
+import re
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
 
+from .backends import load_backend
+from .batching import group_by_length
+from .shaping import bucket_length, shape_input
 from .cnn_gru_model import CNNGRUModel
+from .encoders import get_sentence_encoder
+from .intensity import calculate_intensity
 
 from . import config
 
@@ -20,18 +32,162 @@ ANOMALY_LABELS = {
 # Manual label overrides for specific NIDS models lacking id2label metadata
 NIDS_LABEL_OVERRIDES = {}
 
+# Stage names recorded in the ``pipeline`` entry of each result
+STAGE_SEMANTIC = "semantic"
+STAGE_NIDS_PRIMARY = "nids_primary"
+STAGE_ANOMALY = "anomaly"
+STAGE_SEVERITY = "severity"
+STAGE_NIDS_SECONDARY = "nids_secondary"
+
+
+def _no_grad_call(fn, *args):
+    # ``torch.no_grad`` is thread-local, so pool threads enable it per call.
+    with torch.no_grad():
+        return fn(*args)
+
+
+def attack_probability(label: str, score: list) -> float:
+    """Return the attack probability of a NIDS ``(label, score)`` pair."""
+    if len(score) > 1:
+        return float(score[1])
+    return 0.0 if str(label).lower() in ("normal", "benign", "none") else 1.0
+
+
+class SemanticWindow:
+    """Ring buffer of recent normalized embeddings kept in one matrix.
+
+    The matrix is allocated once; new embeddings overwrite the oldest row and
+    the similarity against the whole window is a single matrix product into
+    a preallocated buffer.
+    """
+
+    def __init__(self, size: int, dim: int, device) -> None:
+        self.size = max(1, int(size))
+        self.matrix = torch.zeros((self.size, dim), device=device)
+        self._scores = torch.empty(self.size, device=device)
+        self.index = 0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.count
+
+    def observe(self, embedding) -> float:
+        """Return the highest similarity to the window, then add ``embedding``."""
+        embedding = embedding.to(self.matrix.device, self.matrix.dtype)
+        with self._lock:
+            similarity = 1.0
+            if self.count:
+                scores = self._scores[: self.count]
+                torch.matmul(self.matrix[: self.count], embedding, out=scores)
+                similarity = float(scores.max().item())
+            self.matrix[self.index].copy_(embedding)
+            self.index = (self.index + 1) % self.size
+            self.count = min(self.count + 1, self.size)
+        return similarity
+
+
+def tokenizer_key(tok) -> str:
+    """Return a hash identifying the vocabulary and settings of ``tok``."""
+    if getattr(tok, "is_fast", False):
+        vocab = tok.backend_tokenizer.to_str()
+    else:
+        vocab = repr(sorted(tok.get_vocab().items()))
+    settings = repr(
+        (
+            type(tok).__name__,
+            tok.model_max_length,
+            tok.padding_side,
+            getattr(tok, "truncation_side", None),
+            tok.model_input_names,
+        )
+    )
+    return hashlib.sha1((vocab + settings).encode("utf-8")).hexdigest()
+
+
+class _Encodings:
+    """Padded batches of one analysis, built once per distinct tokenizer."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._items = {}
+
+    def get(self, tok, texts: list, build) -> list:
+        key = (id(tok), tuple(texts))
+        with self._lock:
+            batches = self._items.get(key)
+            if batches is None:
+                batches = self._items[key] = list(build(tok, texts))
+        return batches
+
+
+class _Run:
+    """State shared by the stages of one ``analyze_batch`` call."""
+
+    def __init__(self, skip=None) -> None:
+        self.skip = frozenset(skip or ())
+        self.enc = _Encodings()
+        self.timings = {}
+
+
+def _timed(timings: dict, name: str, fn, *args):
+    # Accumulates the wall time of ``fn`` (ms) under ``name``
+    start = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        elapsed = (time.perf_counter() - start) * 1000
+        timings[name] = timings.get(name, 0.0) + elapsed
+
+
+def adapter_key(model_name: str, taken=()) -> str:
+    """Return a PEFT adapter name for the Hub repository ``model_name``.
+
+    PEFT keeps adapters in ``torch.nn.ModuleDict`` objects, whose keys
+    cannot hold ``.`` (and ``/`` breaks lookups), so every non-word
+    character is replaced; a suffix keeps the key out of ``taken``.
+    """
+    base = key = re.sub(r"\W", "_", model_name)
+    n = 1
+    while key in taken:
+        n += 1
+        key = f"{base}_{n}"
+    return key
+
+
+class LoraAdapter:
+    """One LoRA adapter of a PEFT model shared by several NIDS entries.
+
+    Calls activate the adapter under a lock shared by all adapters of the
+    same base model. ``adapter_name`` is the key given by :func:`adapter_key`,
+    not the repository id.
+    """
+
+    def __init__(self, model, adapter_name: str, lock) -> None:
+        self.model = model
+        self.adapter_name = adapter_name
+        self.lock = lock
+
+    @property
+    def config(self):
+        return self.model.config
+
+    def __call__(self, **inputs):
+        with self.lock:
+            self.model.set_adapter(self.adapter_name)
+            return self.model(**inputs)
+
+
+class _Selected:
+    """Future-like view of one key of a future that returns a dict."""
+
+    def __init__(self, future, key) -> None:
+        self.future = future
+        self.key = key
+
+    def result(self):
+        return self.future.result()[self.key]
 
-def calculate_intensity(sev_label: str, anomaly_scores: list, similarity: float) -> float:
-    """Return a numeric attack intensity based on model results."""
-    sev_weight = {
-        "low": 1,
-        "medium": 2,
-        "high": 3,
-        "error": 4,
-    }.get(str(sev_label).lower(), 1)
-    anomaly_prob = max(float(s) for s in anomaly_scores)
-    intensity = sev_weight * anomaly_prob * (1.0 - float(similarity))
-    return round(intensity * 100, 2)
 
 class Detector:
     def __init__(self):
@@ -41,27 +197,58 @@ class Detector:
             device = "cpu"
         logger.info("Carregando modelos em %s", device)
         self.device = torch.device(device)
+        # Tokenizers idênticos (mesmo vocabulário e configuração) são
+        # compartilhados, e cada análise tokeniza o texto uma vez por grupo.
+        self._tokenizers = {}
+        # Com ``PARALLEL_STAGES`` as etapas independentes rodam em um pool
+        # dedicado; o número de threads intra-op é dividido entre os workers
+        # para não disputar os mesmos núcleos.
+        self._executor = None
+        if config.PARALLEL_STAGES:
+            workers = max(1, config.INFERENCE_WORKERS)
+            threads = config.INTRA_OP_THREADS or max(1, (os.cpu_count() or 1) // workers)
+            torch.set_num_threads(threads)
+            self._executor = self._new_executor()
+            logger.info(
+                "Etapas em paralelo: %d workers, %d threads intra-op", workers, threads
+            )
+            # As threads do pool não sobrevivem a ``fork``
+            os.register_at_fork(after_in_child=self._reset_executor)
 
-        self.severity_tokenizer = AutoTokenizer.from_pretrained(
+        self.severity_tokenizer = self._load_tokenizer(config.SEVERITY_MODEL)
+        self.severity_model = load_backend(
+            "severity",
             config.SEVERITY_MODEL,
-            trust_remote_code=True,
+            AutoModelForSequenceClassification.from_pretrained(
+                config.SEVERITY_MODEL,
+                trust_remote_code=True,
+            ).to(self.device),
+            self.severity_tokenizer,
+            self.device,
         )
-        self.severity_model = AutoModelForSequenceClassification.from_pretrained(
-            config.SEVERITY_MODEL,
-            trust_remote_code=True,
-        ).to(self.device)
-        self.anomaly_tokenizer = AutoTokenizer.from_pretrained(
+        self.anomaly_tokenizer = self._load_tokenizer(config.ANOMALY_MODEL)
+        self.anomaly_model = load_backend(
+            "anomaly",
             config.ANOMALY_MODEL,
-            trust_remote_code=True,
+            AutoModelForSequenceClassification.from_pretrained(
+                config.ANOMALY_MODEL,
+                trust_remote_code=True,
+            ).to(self.device),
+            self.anomaly_tokenizer,
+            self.device,
         )
-        self.anomaly_model = AutoModelForSequenceClassification.from_pretrained(
-            config.ANOMALY_MODEL,
-            trust_remote_code=True,
-        ).to(self.device)
         # O primeiro item de ``NIDS_MODELS`` é tratado como modelo principal
         # para determinar o tipo de ataque das requisições. Ele pode ser qualquer
         # classificador compatível com Transformers.
         self.nids_models = []
+        # Adaptadores LoRA compartilham um único modelo base; cada entrada de
+        # ``NIDS_MODELS`` que for apenas um adaptador custa só os seus pesos.
+        self._lora_model = None
+        self._lora_tok = None
+        self._lora_lock = threading.Lock()
+        self._lora_mixed = True
+        # Repositório do adaptador -> nome usado dentro do PeftModel
+        self._lora_adapters = {}
         # Permite usar ``NIDS_MODEL`` para especificar o classificador principal.
         # Caso esteja vazio, recorre ao primeiro item de ``NIDS_MODELS`` ou a um
         # valor padrao. Isso evita que ``None`` seja passado para
@@ -75,182 +262,487 @@ class Detector:
         if not name:
             raise ValueError("Nenhum modelo NIDS configurado")
         self.primary_name = name
-        self.primary = None
-        self.primary_tok = None
-        if self.primary_name == "YangYang-Research/web-attack-detection":
-            self.primary = CNNGRUModel(self.primary_name)
-        else:
-            try:
-                self.primary_tok = AutoTokenizer.from_pretrained(
-                    self.primary_name,
-                    trust_remote_code=True,
-                )
-                self.primary = AutoModelForSequenceClassification.from_pretrained(
-                    self.primary_name,
-                    trust_remote_code=True,
-                ).to(self.device)
-            except (OSError, ValueError):
-                base_name = config.NIDS_BASE_MODEL or "distilbert-base-uncased"
-                logger.info(
-                    "Modelo %s parece ser apenas um adaptador LoRA; carregando base %s",
-                    self.primary_name,
-                    base_name,
-                )
-                self.primary_tok = AutoTokenizer.from_pretrained(
-                    base_name,
-                    trust_remote_code=True,
-                )
-                base = AutoModelForSequenceClassification.from_pretrained(
-                    base_name,
-                    trust_remote_code=True,
-                )
-                self.primary = PeftModel.from_pretrained(base, self.primary_name).to(self.device)
+        self.primary_tok, self.primary = self._load_nids(self.primary_name)
 
         for model_name in config.NIDS_MODELS[1:]:
-            if model_name == "YangYang-Research/web-attack-detection":
-                mdl = CNNGRUModel(model_name)
-                self.nids_models.append((model_name, None, mdl))
-                continue
-            try:
-                tok = AutoTokenizer.from_pretrained(
-                    model_name,
-                    trust_remote_code=True,
-                )
-                mdl = AutoModelForSequenceClassification.from_pretrained(
-                    model_name,
-                    trust_remote_code=True,
-                ).to(self.device)
-            except (OSError, ValueError):
-                base_name = config.NIDS_BASE_MODEL or "distilbert-base-uncased"
-                logger.info(
-                    "Modelo %s parece ser apenas um adaptador LoRA; carregando base %s",
-                    model_name,
-                    base_name,
-                )
-                tok = AutoTokenizer.from_pretrained(
-                    base_name,
-                    trust_remote_code=True,
-                )
-                base = AutoModelForSequenceClassification.from_pretrained(
-                    base_name,
-                    trust_remote_code=True,
-                )
-                mdl = PeftModel.from_pretrained(base, model_name).to(self.device)
+            tok, mdl = self._load_nids(model_name)
             self.nids_models.append((model_name, tok, mdl))
 
-        self.semantic_model = SentenceTransformer(config.SEMANTIC_MODEL, device=str(self.device))
-        self.recent_embeddings = deque(maxlen=100)
+        # Encoders são compartilhados: se o CNN-GRU usa o mesmo modelo que a
+        # etapa semântica, os pesos são carregados uma única vez e o embedding
+        # calculado em ``_semantic`` é reaproveitado como entrada do CNN-GRU.
+        self.semantic_model = get_sentence_encoder(config.SEMANTIC_MODEL, str(self.device))
+        self.semantic_window = SemanticWindow(
+            config.SEMANTIC_WINDOW,
+            self.semantic_model.get_sentence_embedding_dimension(),
+            self.device,
+        )
         self.semantic_threshold = float(getattr(config, 'SEMANTIC_THRESHOLD', 0.5))
         logger.info("Modelos carregados com sucesso")
 
-    def analyze(self, text: str):
-        logger.debug("Analise de texto")
-        embedding = self.semantic_model.encode(
-            text,
-            convert_to_tensor=True,
-            normalize_embeddings=True,
-        )
-        similarity = 1.0
-        if self.recent_embeddings:
-            sims = util.cos_sim(embedding, torch.stack(list(self.recent_embeddings)))[0]
-            similarity = float(torch.max(sims).item())
-        outlier = similarity < self.semantic_threshold
-        self.recent_embeddings.append(embedding.cpu())
-        inputs = self.anomaly_tokenizer(
-            text,
-            return_tensors="pt",
-            truncation=True,
-            max_length=self.anomaly_tokenizer.model_max_length,
+    def _load_tokenizer(self, name: str):
+        """Load a tokenizer, reusing an identical one loaded before."""
+        tok = AutoTokenizer.from_pretrained(
+            name,
+            trust_remote_code=True,
+            use_fast=True,
         )
-        inputs = {k: v.to(self.device) for k, v in inputs.items()}
-        anomaly_output = self.anomaly_model(**inputs)
-        anomaly_probs = torch.softmax(anomaly_output.logits, dim=-1)[0]
-        anomaly_score = anomaly_probs.tolist()
-        anomaly_label_idx = int(torch.argmax(anomaly_probs).item())
-        anomaly_label = self.anomaly_model.config.id2label.get(
-            anomaly_label_idx, str(anomaly_label_idx)
+        if not getattr(tok, "is_fast", False):
+            logger.warning(
+                "Tokenizer de %s nao e rapido (Rust); a tokenizacao sera mais lenta",
+                name,
+            )
+        key = tokenizer_key(tok)
+        shared = self._tokenizers.setdefault(key, tok)
+        if shared is not tok:
+            logger.info("Tokenizer de %s compartilhado com outro modelo", name)
+        return shared
+
+    def _load_nids(self, model_name: str):
+        """Return ``(tokenizer, model)`` for one entry of ``NIDS_MODELS``."""
+        if model_name == "YangYang-Research/web-attack-detection":
+            return None, CNNGRUModel(model_name, device=str(self.device))
+        try:
+            tok = self._load_tokenizer(model_name)
+            mdl = load_backend(
+                "nids",
+                model_name,
+                AutoModelForSequenceClassification.from_pretrained(
+                    model_name,
+                    trust_remote_code=True,
+                ).to(self.device),
+                tok,
+                self.device,
+            )
+            return tok, mdl
+        except (OSError, ValueError):
+            return self._load_lora(model_name)
+
+    def _load_lora(self, model_name: str):
+        """Load ``model_name`` as an adapter on the shared LoRA base model."""
+        key = self._lora_adapters.get(model_name)
+        if key is not None:
+            return self._lora_tok, LoraAdapter(self._lora_model, key, self._lora_lock)
+        key = adapter_key(model_name, set(self._lora_adapters.values()))
+        if self._lora_model is None:
+            base_name = config.NIDS_BASE_MODEL or "distilbert-base-uncased"
+            logger.info(
+                "Modelo %s parece ser apenas um adaptador LoRA; carregando base %s",
+                model_name,
+                base_name,
+            )
+            self._lora_tok = self._load_tokenizer(base_name)
+            base = AutoModelForSequenceClassification.from_pretrained(
+                base_name,
+                trust_remote_code=True,
+            )
+            self._lora_model = PeftModel.from_pretrained(
+                base, model_name, adapter_name=key
+            ).to(self.device)
+            self._lora_model.eval()
+        else:
+            logger.info("Adaptador LoRA %s carregado na base compartilhada", model_name)
+            self._lora_model.load_adapter(model_name, adapter_name=key)
+            self._lora_model.to(self.device)
+        self._lora_adapters[model_name] = key
+        return self._lora_tok, LoraAdapter(self._lora_model, key, self._lora_lock)
+
+    def _new_executor(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(
+            max_workers=max(1, config.INFERENCE_WORKERS),
+            thread_name_prefix="inference",
         )
-        if isinstance(anomaly_label, str) and anomaly_label.startswith("LABEL_"):
-            anomaly_label = ANOMALY_LABELS.get(anomaly_label_idx, anomaly_label)
 
-        sev_inputs = self.severity_tokenizer(
-            text,
-            return_tensors="pt",
+    def _reset_executor(self) -> None:
+        if self._executor is not None:
+            self._executor = self._new_executor()
+
+    def _torch_modules(self) -> list:
+        candidates = [
+            self.severity_model,
+            self.anomaly_model,
+            self.primary,
+            self.semantic_model,
+            self._lora_model,
+            *[mdl for _, _, mdl in self.nids_models],
+        ]
+        return [m for m in candidates if isinstance(m, torch.nn.Module)]
+
+    def freeze(self) -> None:
+        """Prepare the loaded weights to be shared copy-on-write after ``fork``.
+
+        Puts every model in eval mode without gradients and moves the
+        existing objects to the permanent GC generation so the collector in
+        the children does not write to the shared pages.
+        """
+        for module in self._torch_modules():
+            module.eval()
+            for param in module.parameters():
+                param.requires_grad_(False)
+        gc.collect()
+        gc.freeze()
+
+    def _batches(self, tok, texts: list, enc=None):
+        """Return ``(indices, inputs)`` padded batches of ``texts``.
+
+        With ``enc`` the batches are shared by every model of the analysis
+        that uses the same tokenizer.
+        """
+        if enc is None:
+            return self._tokenize(tok, texts)
+        return enc.get(tok, texts, self._tokenize)
+
+    def _tokenize(self, tok, texts: list):
+        """Yield ``(indices, inputs)`` of padded batches of ``texts``.
+
+        Texts are tokenized without padding and then grouped by length so
+        every forward pass pads only to the longest item of its group, or to
+        the next of ``LENGTH_BUCKETS`` when buckets are configured.
+        """
+        encoded = tok(
+            texts,
             truncation=True,
-            max_length=self.severity_tokenizer.model_max_length,
+            max_length=tok.model_max_length,
         )
-        sev_inputs = {k: v.to(self.device) for k, v in sev_inputs.items()}
-        sev_output = self.severity_model(**sev_inputs)
-        sev_probs = torch.softmax(sev_output.logits, dim=-1)[0]
-        severity_score = sev_probs.tolist()
-        severity_label_idx = int(torch.argmax(sev_probs).item())
-        severity_label = self.severity_model.config.id2label.get(severity_label_idx, str(severity_label_idx))
-
-        nids_details = []
-
-        primary_label, primary_score = "Normal", [1.0]
-        if hasattr(self.primary, "predict_from_text"):
-            result = self.primary.predict_from_text(text)
-            if isinstance(result, tuple):
-                primary_label, primary_score = result
+        lengths = [len(ids) for ids in encoded["input_ids"]]
+        for group in group_by_length(lengths, config.BATCH_PAD_RATIO):
+            features = {k: [encoded[k][i] for i in group] for k in encoded.keys()}
+            if config.LENGTH_BUCKETS:
+                # Fixed padded lengths keep the shapes seen by ONNX/compiled
+                # backends to a small set
+                longest = max(lengths[i] for i in group)
+                inputs = tok.pad(
+                    features,
+                    padding="max_length",
+                    max_length=min(bucket_length(longest), tok.model_max_length),
+                    return_tensors="pt",
+                )
             else:
-                primary_label = result
-        elif self.primary is not None and self.primary_tok is not None:
-            inputs = self.primary_tok(
-                text,
-                return_tensors="pt",
-                truncation=True,
-                max_length=self.primary_tok.model_max_length,
-            )
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
-            output = self.primary(**inputs)
-            probs = torch.softmax(output.logits, dim=-1)[0]
-            primary_score = probs.tolist()
-            label_idx = int(torch.argmax(probs).item())
-            primary_label = self.primary.config.id2label.get(label_idx, str(label_idx))
-            override = NIDS_LABEL_OVERRIDES.get(self.primary_name)
-            if override:
-                primary_label = override.get(label_idx, primary_label)
-        nids_details.append(
-            {
-                "label": primary_label,
-                "score": primary_score,
-                "model": self.primary_name,
-            }
-        )
+                inputs = tok.pad(features, return_tensors="pt")
+            yield group, {k: v.to(self.device) for k, v in inputs.items()}
 
-        for model_name, tok, mdl in self.nids_models:
-            if tok is None and hasattr(mdl, "predict_from_text"):
-                result = mdl.predict_from_text(text)
+    def _classify(self, tok, model, texts: list, enc=None) -> list:
+        """Return the softmax probabilities of ``model`` for each text."""
+        probs = [None] * len(texts)
+        for group, inputs in self._batches(tok, texts, enc):
+            output = model(**inputs)
+            group_probs = torch.softmax(output.logits, dim=-1)
+            for pos, idx in enumerate(group):
+                probs[idx] = group_probs[pos]
+        return probs
+
+    def _nids(self, model_name: str, tok, mdl, texts: list, raw_embeddings=None, enc=None) -> list:
+        """Return ``(label, score)`` pairs of one NIDS model for each text.
+
+        ``raw_embeddings`` are the unnormalized semantic embeddings of
+        ``texts``; they are reused by models sharing the semantic encoder.
+        """
+        if tok is None:
+            if raw_embeddings is not None and self._shares_encoder(mdl):
+                results = mdl.predict_from_embeddings(raw_embeddings.cpu().numpy())
+            elif hasattr(mdl, "predict_from_texts"):
+                results = mdl.predict_from_texts(texts)
+            else:
+                results = [mdl.predict_from_text(text) for text in texts]
+            pairs = []
+            for result in results:
                 if isinstance(result, tuple):
-                    label, score = result
+                    pairs.append(result)
                 else:
-                    label, score = result, [1.0]
-                nids_details.append(
-                    {"label": label, "score": score, "model": model_name}
-                )
-                continue
-            inputs = tok(
-                text,
-                return_tensors="pt",
-                truncation=True,
-                max_length=tok.model_max_length,
-            )
-            inputs = {k: v.to(self.device) for k, v in inputs.items()}
-            output = mdl(**inputs)
-            probs = torch.softmax(output.logits, dim=-1)[0]
-            score = probs.tolist()
+                    pairs.append((result, [1.0]))
+            return pairs
+        return self._label_pairs(model_name, mdl, self._classify(tok, mdl, texts, enc))
+
+    def _label_pairs(self, model_name: str, mdl, all_probs: list) -> list:
+        pairs = []
+        override = NIDS_LABEL_OVERRIDES.get(model_name)
+        for probs in all_probs:
             label_idx = int(torch.argmax(probs).item())
             label = mdl.config.id2label.get(label_idx, str(label_idx))
-            override = NIDS_LABEL_OVERRIDES.get(model_name)
             if override:
                 label = override.get(label_idx, label)
+            pairs.append((label, probs.tolist()))
+        return pairs
+
+    def _lora_nids(self, entries: list, texts: list, enc=None) -> dict:
+        """Run several LoRA adapters over ``texts`` in one mixed batch.
+
+        The inputs are repeated once per adapter and PEFT routes each row to
+        its adapter through ``adapter_names``. Older PEFT versions without
+        mixed-adapter batches fall back to one pass per adapter.
+        """
+        if self._lora_mixed:
+            names = [name for name, _, _ in entries]
+            keys = [mdl.adapter_name for _, _, mdl in entries]
+            all_probs = {name: [None] * len(texts) for name in names}
+            try:
+                for group, inputs in self._batches(self._lora_tok, texts, enc):
+                    size = len(group)
+                    repeated = {k: v.repeat(len(names), 1) for k, v in inputs.items()}
+                    adapter_names = [key for key in keys for _ in range(size)]
+                    with self._lora_lock:
+                        output = self._lora_model(**repeated, adapter_names=adapter_names)
+                    group_probs = torch.softmax(output.logits, dim=-1)
+                    for a, name in enumerate(names):
+                        for pos, idx in enumerate(group):
+                            all_probs[name][idx] = group_probs[a * size + pos]
+                return {
+                    name: self._label_pairs(name, mdl, all_probs[name])
+                    for name, _, mdl in entries
+                }
+            except (TypeError, ValueError) as exc:
+                logger.warning("Lote com varios adaptadores indisponivel: %s", exc)
+                self._lora_mixed = False
+        return {
+            name: self._nids(name, tok, mdl, texts, enc=enc)
+            for name, tok, mdl in entries
+        }
+
+    def _shares_encoder(self, mdl) -> bool:
+        """Return True if ``mdl`` can consume the semantic embeddings."""
+        return (
+            mdl is not None
+            and getattr(mdl, "encoder", None) is self.semantic_model
+            and hasattr(mdl, "predict_from_embeddings")
+        )
+
+    def _nids_stage(self, model_name: str, tok, mdl, texts: list, semantic_f, index=None, enc=None) -> list:
+        """Run :meth:`_nids`, waiting for the semantic stage only if needed."""
+        raw_embeddings = None
+        if tok is None and self._shares_encoder(mdl):
+            raw_embeddings = semantic_f.result()[0]
+            if index is not None:
+                raw_embeddings = raw_embeddings[index]
+        return self._nids(model_name, tok, mdl, texts, raw_embeddings, enc)
+
+    def _stage(self, fn, *args) -> Future:
+        """Run ``fn`` on the inference pool, or inline when it is disabled."""
+        if self._executor is not None:
+            return self._executor.submit(_no_grad_call, fn, *args)
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+    def _submit_full(self, texts: list, semantic_f, index, run):
+        """Start the anomaly, severity and secondary NIDS stages not shed."""
+        anomaly_f = severity_f = None
+        if STAGE_ANOMALY not in run.skip:
+            anomaly_f = self._stage(
+                _timed, run.timings, STAGE_ANOMALY, self._anomaly, texts, run.enc
+            )
+        if STAGE_SEVERITY not in run.skip:
+            severity_f = self._stage(
+                _timed, run.timings, STAGE_SEVERITY, self._severity, texts, run.enc
+            )
+        secondary_f = []
+        if STAGE_NIDS_SECONDARY in run.skip:
+            return anomaly_f, severity_f, secondary_f
+        lora = [e for e in self.nids_models if isinstance(e[2], LoraAdapter)]
+        lora_f = None
+        if len(lora) > 1:
+            lora_f = self._stage(
+                _timed, run.timings, STAGE_NIDS_SECONDARY, self._lora_nids, lora, texts, run.enc
+            )
+        for model_name, tok, mdl in self.nids_models:
+            if lora_f is not None and isinstance(mdl, LoraAdapter):
+                secondary_f.append((model_name, _Selected(lora_f, model_name)))
+            else:
+                secondary_f.append(
+                    (
+                        model_name,
+                        self._stage(
+                            _timed,
+                            run.timings,
+                            STAGE_NIDS_SECONDARY,
+                            self._nids_stage,
+                            model_name,
+                            tok,
+                            mdl,
+                            texts,
+                            semantic_f,
+                            index,
+                            run.enc,
+                        ),
+                    )
+                )
+        return anomaly_f, severity_f, secondary_f
+
+    def _semantic(self, texts: list, compare: bool = True, encode: bool = True):
+        """Encode ``texts`` and compare them with the recent window.
+
+        Returns the raw embeddings and a list of ``(embedding, similarity)``
+        with the normalized embedding of each text, in order. Each embedding
+        is compared with the window before being added to it, so items later
+        in a batch also see the earlier ones. When the semantic stage is shed,
+        ``compare`` is False and the texts are only encoded if another model
+        needs the embeddings.
+        """
+        if not encode:
+            return None, [(None, 1.0)] * len(texts)
+        raw = self.semantic_model.encode(texts, convert_to_tensor=True)
+        embeddings = F.normalize(raw, p=2, dim=-1)
+        return raw, [
+            (embedding, self.semantic_window.observe(embedding) if compare else 1.0)
+            for embedding in embeddings
+        ]
+
+    def _anomaly(self, texts: list, enc=None) -> list:
+        results = []
+        for probs in self._classify(self.anomaly_tokenizer, self.anomaly_model, texts, enc):
+            label_idx = int(torch.argmax(probs).item())
+            label = self.anomaly_model.config.id2label.get(label_idx, str(label_idx))
+            if isinstance(label, str) and label.startswith("LABEL_"):
+                label = ANOMALY_LABELS.get(label_idx, label)
+            results.append((label, probs.tolist()))
+        return results
+
+    def _severity(self, texts: list, enc=None) -> list:
+        results = []
+        for probs in self._classify(self.severity_tokenizer, self.severity_model, texts, enc):
+            label_idx = int(torch.argmax(probs).item())
+            label = self.severity_model.config.id2label.get(label_idx, str(label_idx))
+            results.append((label, probs.tolist()))
+        return results
+
+    def analyze(self, text: str, skip=None):
+        return self.analyze_batch([text], skip=skip)[0]
+
+    @torch.no_grad()
+    def analyze_batch(self, texts: list, skip=None) -> list:
+        """Analyze several texts running each model once for the whole batch.
+
+        With ``CASCADE_MODE`` the semantic encoder and the primary NIDS model
+        run first; texts whose attack probability is below ``CASCADE_LOW``
+        exit as benign and all the others go through the full ensemble. With
+        ``PARALLEL_STAGES`` the independent stages run concurrently on the
+        inference pool and are joined before the ensemble. Stage names in
+        ``skip`` are not run (load shedding); the primary NIDS model always
+        runs.
+        """
+        logger.debug("Analise de %d texto(s)", len(texts))
+        texts = [shape_input(text) for text in texts]
+        if not texts:
+            return []
+        run = _Run(skip)
+        compare = STAGE_SEMANTIC not in run.skip
+        encode = compare or self._shares_encoder(self.primary) or any(
+            self._shares_encoder(mdl) for _, _, mdl in self.nids_models
+        )
+        semantic_f = self._stage(
+            _timed, run.timings, STAGE_SEMANTIC, self._semantic, texts, compare, encode
+        )
+        if self.primary is not None:
+            primary_f = self._stage(
+                _timed,
+                run.timings,
+                STAGE_NIDS_PRIMARY,
+                self._nids_stage,
+                self.primary_name,
+                self.primary_tok,
+                self.primary,
+                texts,
+                semantic_f,
+                None,
+                run.enc,
+            )
+        else:
+            primary_f = self._stage(lambda: [("Normal", [1.0])] * len(texts))
+        full = list(range(len(texts)))
+        stage2 = None
+        if not config.CASCADE_MODE:
+            stage2 = self._submit_full(texts, semantic_f, None, run)
+
+        _, semantic = semantic_f.result()
+        primary = primary_f.result()
+        exits = [None] * len(texts)
+        if config.CASCADE_MODE:
+            for i, (label, score) in enumerate(primary):
+                prob = attack_probability(label, score)
+                if prob < config.CASCADE_LOW:
+                    exits[i] = "benign"
+            full = [i for i, exit_ in enumerate(exits) if exit_ is None]
+            if full:
+                index = full if len(full) < len(texts) else None
+                stage2 = self._submit_full([texts[i] for i in full], semantic_f, index, run)
+
+        anomaly, severity, secondary = {}, {}, []
+        if stage2 is not None:
+            anomaly_f, severity_f, secondary_f = stage2
+            if anomaly_f is not None:
+                anomaly = dict(zip(full, anomaly_f.result()))
+            if severity_f is not None:
+                severity = dict(zip(full, severity_f.result()))
+            secondary = [
+                (model_name, dict(zip(full, future.result())))
+                for model_name, future in secondary_f
+            ]
+
+        timings = {name: round(ms, 2) for name, ms in run.timings.items()}
+        results = []
+        for i in range(len(texts)):
+            embedding, similarity = semantic[i]
+            stages = [STAGE_SEMANTIC] if compare else []
+            stages.append(STAGE_NIDS_PRIMARY)
+            if exits[i] is None:
+                if i in anomaly:
+                    stages.append(STAGE_ANOMALY)
+                if i in severity:
+                    stages.append(STAGE_SEVERITY)
+                if secondary:
+                    stages.append(STAGE_NIDS_SECONDARY)
+            result = self._build_result(
+                anomaly.get(i),
+                severity.get(i),
+                primary[i],
+                [(name, pairs[i]) for name, pairs in secondary if i in pairs],
+                embedding,
+                similarity,
+            )
+            result["pipeline"] = {
+                "mode": "cascade" if config.CASCADE_MODE else "full",
+                "stages": stages,
+                "exit": exits[i],
+                "timings": timings,
+            }
+            results.append(result)
+        return results
+
+    def _build_result(self, anomaly, severity, primary, secondary, embedding, similarity) -> dict:
+        """Combine the per-model outputs of one text into the result dict.
+
+        ``anomaly`` and ``severity`` are ``None`` when the stage was skipped
+        by the cascade; the anomaly verdict is then derived from the primary
+        NIDS model.
+        """
+        primary_label, primary_score = primary
+        anomaly_model = config.ANOMALY_MODEL
+        if anomaly is None:
+            prob = attack_probability(primary_label, primary_score)
+            anomaly = ("anomaly" if prob >= 0.5 else "normal", [1 - prob, prob])
+            anomaly_model = self.primary_name
+        severity_model = config.SEVERITY_MODEL
+        if severity is None:
+            severity = ("skipped", [])
+            severity_model = None
+        anomaly_label, anomaly_score = anomaly
+        severity_label, severity_score = severity
+        outlier = similarity < self.semantic_threshold
+
+        nids_details = [
+            {
+                "label": primary_label,
+                "score": primary_score,
+                "model": self.primary_name,
+            }
+        ]
+        for model_name, (label, score) in secondary:
             nids_details.append(
                 {"label": label, "score": score, "model": model_name}
             )
 
-        from collections import Counter
-
         if nids_details:
             label_counts = Counter(d["label"] for d in nids_details)
             majority_label = label_counts.most_common(1)[0][0]
@@ -264,11 +756,7 @@ class Detector:
         anomaly_prob = float(anomaly_score[1]) if len(anomaly_score) > 1 else (
             0.0 if str(anomaly_label).lower() in ("normal", "none") else 1.0
         )
-        attack_prob = 0.0
-        if len(primary_score) > 1:
-            attack_prob = float(primary_score[1])
-        elif str(primary_label).lower() not in ("normal", "benign", "none"):
-            attack_prob = 1.0
+        attack_prob = attack_probability(primary_label, primary_score)
         ensemble_score = (
             config.ENSEMBLE_W_ROBERTA * anomaly_prob
             + config.ENSEMBLE_W_ATTACK * attack_prob
@@ -292,12 +780,12 @@ class Detector:
             'anomaly': {
                 'label': anomaly_label,
                 'score': anomaly_score,
-                'model': config.ANOMALY_MODEL,
+                'model': anomaly_model,
             },
             'severity': {
                 'label': severity_label,
                 'score': severity_score,
-                'model': config.SEVERITY_MODEL,
+                'model': severity_model,
             },
             'nids': {
                 'label': primary_label,
@@ -308,7 +796,7 @@ class Detector:
                 'details': nids_details,
             },
             'semantic': {
-                'embedding': embedding.cpu().tolist(),
+                'embedding': embedding.cpu().tolist() if embedding is not None else [],
                 'similarity': similarity,
                 'outlier': outlier,
                 'model': config.SEMANTIC_MODEL,
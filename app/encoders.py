@@ -0,0 +1,28 @@
+import threading
+import logging
+
+from sentence_transformers import SentenceTransformer
+
+logger = logging.getLogger(__name__)
+
+_encoders = {}
+_lock = threading.Lock()
+
+
+def get_sentence_encoder(name: str, device: str = None) -> SentenceTransformer:
+    """Return a shared ``SentenceTransformer`` for ``name`` on ``device``.
+
+    Components asking for the same encoder receive the same instance, so the
+    weights are loaded only once per process.
+    """
+    key = (name, str(device) if device is not None else None)
+    encoder = _encoders.get(key)
+    if encoder is not None:
+        return encoder
+    with _lock:
+        encoder = _encoders.get(key)
+        if encoder is None:
+            logger.info("Carregando encoder %s", name)
+            encoder = SentenceTransformer(name, device=key[1])
+            _encoders[key] = encoder
+    return encoder
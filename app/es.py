@@ -7,11 +7,20 @@ from . import config
 
 client: Optional[OpenSearch] = None
 
-if config.ES_HOST:
-    es_kwargs = {"hosts": [config.ES_HOST]}
-    if config.ES_USER and config.ES_PASSWORD:
-        es_kwargs["basic_auth"] = (config.ES_USER, config.ES_PASSWORD)
-    client = OpenSearch(**es_kwargs)
+
+def connect() -> Optional[OpenSearch]:
+    """Create the module client, e.g. again in a forked worker."""
+    global client
+    client = None
+    if config.ES_HOST:
+        es_kwargs = {"hosts": [config.ES_HOST]}
+        if config.ES_USER and config.ES_PASSWORD:
+            es_kwargs["basic_auth"] = (config.ES_USER, config.ES_PASSWORD)
+        client = OpenSearch(**es_kwargs)
+    return client
+
+
+connect()
 
 
 def index_log(doc: dict) -> None:
@@ -1,15 +1,40 @@
+import asyncio
 import queue
 
 log_listeners = []
 blocked_listeners = []
 
 
+class AsyncListener:
+    """Listener delivering notifications to an ``asyncio.Queue``.
+
+    Notifications come from worker threads, so entries are handed to the
+    event loop that registered the listener.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.queue = asyncio.Queue()
+
+    def put_nowait(self, entry):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, entry)
+
+    async def get(self):
+        return await self.queue.get()
+
+
 def register_log_listener():
     q = queue.Queue()
     log_listeners.append(q)
     return q
 
 
+def register_async_log_listener():
+    listener = AsyncListener(asyncio.get_running_loop())
+    log_listeners.append(listener)
+    return listener
+
+
 def unregister_log_listener(q):
     try:
         log_listeners.remove(q)
@@ -31,6 +56,12 @@ def register_blocked_listener():
     return q
 
 
+def register_async_blocked_listener():
+    listener = AsyncListener(asyncio.get_running_loop())
+    blocked_listeners.append(listener)
+    return listener
+
+
 def unregister_blocked_listener(q):
     try:
         blocked_listeners.remove(q)
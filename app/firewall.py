@@ -1,11 +1,19 @@
+import abc
+import fcntl
+import hashlib
+import ipaddress
+import json
+import os
 import re
 import subprocess
+import threading
 import logging
 import time
 
 logger = logging.getLogger(__name__)
 
 from . import db, events, config
+from .blocklist import blocklist
 
 
 def is_whitelisted(ip: str) -> bool:
@@ -13,125 +21,534 @@ def is_whitelisted(ip: str) -> bool:
     return db.is_ip_whitelisted(ip)
 
 
-def is_ip_blocked(ip: str) -> bool:
-    """Check if the IP already appears in UFW rules."""
+class FirewallBackend(abc.ABC):
+    """Applies batches of blocks and unblocks to the host firewall.
+
+    Rules only cover ``UNIT_BACKEND_PORT``. Commands run through ``sudo``;
+    ``block``/``unblock`` return False if any command failed and must be
+    safe to repeat, since failed batches are retried.
+    """
+
+    name = ""
+
+    @abc.abstractmethod
+    def block(self, ips: list) -> bool:
+        """Add rules for ``ips``."""
+
+    @abc.abstractmethod
+    def unblock(self, ips: list) -> bool:
+        """Remove the rules of ``ips``."""
+
+    @abc.abstractmethod
+    def blocked(self) -> set:
+        """Return the IPs currently blocked by the firewall."""
+
+
+def _family(ip: str):
     try:
-        result = subprocess.run(
-            ["sudo", "ufw", "status"],
-            capture_output=True,
-            text=True,
-            check=True,
+        return ipaddress.ip_address(ip).version
+    except ValueError:
+        logger.error("IP invalido ignorado pelo firewall: %s", ip)
+        return None
+
+
+class UfwBackend(FirewallBackend):
+    """One ``ufw`` command per IP; rules are kept in UFW's linear chain."""
+
+    name = "ufw"
+
+    def _rule(self, ip: str, action: list, done: str) -> bool:
+        try:
+            subprocess.run(
+                ["sudo", "ufw", *action, "deny", "from", ip, "to", "any", "port",
+                 str(config.UNIT_BACKEND_PORT)],
+                check=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            logger.info(done, ip)
+            return True
+        except Exception as exc:
+            logger.error("Erro ao aplicar regra UFW para %s: %s", ip, exc)
+            return False
+
+    def block(self, ips: list) -> bool:
+        return all([self._rule(ip, ["insert", "1"], "UFW rule added for %s") for ip in ips])
+
+    def unblock(self, ips: list) -> bool:
+        return all([self._rule(ip, ["delete"], "UFW rule removed for %s") for ip in ips])
+
+    def blocked(self) -> set:
+        try:
+            result = subprocess.run(
+                ["sudo", "ufw", "status", "numbered"],
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+        except Exception as exc:
+            logger.error("Erro ao obter IPs do UFW: %s", exc)
+            return set()
+
+        ips = set()
+        for line in result.stdout.splitlines():
+            if "DENY" in line:
+                match = re.search(r"from\s+(\S+)", line)
+                if match:
+                    ips.add(match.group(1))
+                else:
+                    parts = line.split()
+                    for part in parts:
+                        if re.match(r"\d+\.\d+\.\d+\.\d+", part):
+                            ips.add(part)
+                            break
+        return ips
+
+
+class NftablesBackend(FirewallBackend):
+    """IPs kept in nftables sets, matched by a hash lookup in the kernel.
+
+    The table ``NFT_TABLE`` (family ``inet``) holds the sets ``blocked4`` and
+    ``blocked6`` and an input chain dropping their addresses on
+    ``UNIT_BACKEND_PORT``. Each batch is applied as one ``nft -f``
+    transaction.
+    """
+
+    name = "nftables"
+    _SETS = {4: "blocked4", 6: "blocked6"}
+
+    def __init__(self, table: str = None):
+        self.table = table or config.NFT_TABLE
+        self._ready = False
+
+    def _apply(self, script: str) -> bool:
+        try:
+            subprocess.run(
+                ["sudo", "nft", "-f", "-"],
+                input=script,
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            return True
+        except Exception as exc:
+            logger.error("Erro ao aplicar transacao nftables: %s", exc)
+            return False
+
+    def setup(self) -> bool:
+        """Create the table, sets and chain (idempotent)."""
+        if self._ready:
+            return True
+        t = f"inet {self.table}"
+        port = config.UNIT_BACKEND_PORT
+        self._ready = self._apply(
+            f"add table {t}\n"
+            f"add set {t} blocked4 {{ type ipv4_addr; }}\n"
+            f"add set {t} blocked6 {{ type ipv6_addr; }}\n"
+            f"add chain {t} input {{ type filter hook input priority -10; policy accept; }}\n"
+            f"flush chain {t} input\n"
+            f"add rule {t} input tcp dport {port} ip saddr @blocked4 drop\n"
+            f"add rule {t} input tcp dport {port} ip6 saddr @blocked6 drop\n"
         )
-        return ip in result.stdout
-    except Exception:
+        return self._ready
+
+    def _elements(self, ips: list) -> dict:
+        groups = {}
+        for ip in ips:
+            family = _family(ip)
+            if family is not None:
+                groups.setdefault(self._SETS[family], []).append(ip)
+        return groups
+
+    def block(self, ips: list) -> bool:
+        if not self.setup():
+            return False
+        lines = [
+            f"add element inet {self.table} {name} {{ {', '.join(members)} }}"
+            for name, members in self._elements(ips).items()
+        ]
+        return not lines or self._apply("\n".join(lines) + "\n")
+
+    def unblock(self, ips: list) -> bool:
+        if not self.setup():
+            return False
+        lines = []
+        for name, members in self._elements(ips).items():
+            # Adding first makes the delete valid for absent elements
+            elements = f"{{ {', '.join(members)} }}"
+            lines.append(f"add element inet {self.table} {name} {elements}")
+            lines.append(f"delete element inet {self.table} {name} {elements}")
+        return not lines or self._apply("\n".join(lines) + "\n")
+
+    def blocked(self) -> set:
+        ips = set()
+        for name in self._SETS.values():
+            try:
+                result = subprocess.run(
+                    ["sudo", "nft", "-j", "list", "set", "inet", self.table, name],
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                )
+                data = json.loads(result.stdout)
+            except Exception as exc:
+                logger.error("Erro ao listar conjunto nftables %s: %s", name, exc)
+                continue
+            for item in data.get("nftables", []):
+                for elem in item.get("set", {}).get("elem", []):
+                    if isinstance(elem, str):
+                        ips.add(elem)
+        return ips
+
+
+class IpsetBackend(FirewallBackend):
+    """IPs kept in ipset ``hash:ip`` sets matched by one iptables rule each.
+
+    For hosts still using iptables; the sets ``<IPSET_NAME>4`` and
+    ``<IPSET_NAME>6`` are updated by one ``ipset restore`` per batch.
+    """
+
+    name = "ipset"
+
+    def __init__(self, name: str = None):
+        base = name or config.IPSET_NAME
+        self.sets = {4: f"{base}4", 6: f"{base}6"}
+        self._ready = False
+
+    def _restore(self, script: str) -> bool:
+        try:
+            subprocess.run(
+                ["sudo", "ipset", "restore", "-exist"],
+                input=script,
+                capture_output=True,
+                text=True,
+                check=True,
+            )
+            return True
+        except Exception as exc:
+            logger.error("Erro ao aplicar lote ipset: %s", exc)
+            return False
+
+    def setup(self) -> bool:
+        if self._ready:
+            return True
+        if not self._restore(
+            f"create {self.sets[4]} hash:ip family inet\n"
+            f"create {self.sets[6]} hash:ip family inet6\n"
+        ):
+            return False
+        for family, command in ((4, "iptables"), (6, "ip6tables")):
+            rule = ["INPUT", "-p", "tcp", "--dport", str(config.UNIT_BACKEND_PORT),
+                    "-m", "set", "--match-set", self.sets[family], "src", "-j", "DROP"]
+            check = subprocess.run(["sudo", command, "-C", *rule], capture_output=True)
+            if check.returncode != 0:
+                try:
+                    subprocess.run(["sudo", command, "-I", *rule], capture_output=True, check=True)
+                except Exception as exc:
+                    logger.error("Erro ao criar regra %s: %s", command, exc)
+                    return False
+        self._ready = True
+        return True
+
+    def _batch(self, action: str, ips: list) -> bool:
+        if not self.setup():
+            return False
+        lines = [
+            f"{action} {self.sets[family]} {ip}"
+            for ip, family in ((ip, _family(ip)) for ip in ips)
+            if family is not None
+        ]
+        return not lines or self._restore("\n".join(lines) + "\n")
+
+    def block(self, ips: list) -> bool:
+        return self._batch("add", ips)
+
+    def unblock(self, ips: list) -> bool:
+        return self._batch("del", ips)
+
+    def blocked(self) -> set:
+        ips = set()
+        for name in self.sets.values():
+            try:
+                result = subprocess.run(
+                    ["sudo", "ipset", "save", name],
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                )
+            except Exception as exc:
+                logger.error("Erro ao listar ipset %s: %s", name, exc)
+                continue
+            for line in result.stdout.splitlines():
+                parts = line.split()
+                if len(parts) >= 3 and parts[0] == "add":
+                    ips.add(parts[2])
+        return ips
+
+
+BACKENDS = {
+    UfwBackend.name: UfwBackend,
+    NftablesBackend.name: NftablesBackend,
+    IpsetBackend.name: IpsetBackend,
+}
+_backend = None
+
+
+def get_backend() -> FirewallBackend:
+    """Return the backend selected by ``FIREWALL_BACKEND``."""
+    global _backend
+    if _backend is None:
+        cls = BACKENDS.get(config.FIREWALL_BACKEND)
+        if cls is None:
+            logger.error(
+                "FIREWALL_BACKEND desconhecido: %s; usando ufw", config.FIREWALL_BACKEND
+            )
+            cls = UfwBackend
+        _backend = cls()
+    return _backend
+
+
+class FirewallQueue:
+    """Blocks and unblocks applied by a background thread in batches.
+
+    Operations scheduled within ``FIREWALL_BATCH_INTERVAL`` seconds are
+    applied together, one backend call (one ``nft -f`` transaction) per
+    kind; for an IP scheduled twice only the last operation is kept. The
+    operations of a failed call are retried after 1, 2, 4... seconds, up to
+    ``FIREWALL_RETRY_MAX`` times, unless a newer operation replaced them;
+    every failure is logged and the ones given up are counted as ``failed``.
+    """
+
+    def __init__(self, backend=None, interval: float = None, max_retries: int = None):
+        self._backend = backend
+        self.interval = config.FIREWALL_BATCH_INTERVAL if interval is None else float(interval)
+        self.max_retries = config.FIREWALL_RETRY_MAX if max_retries is None else int(max_retries)
+        self._lock = threading.Lock()
+        self._apply_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pending = {}
+        # ip -> (block, attempts, monotonic time of the next attempt)
+        self._retries = {}
+        self._pid = None
+        self.batches = 0
+        self.applied = 0
+        self.errors = 0
+        self.retried = 0
+        self.failed = 0
+
+    @property
+    def backend(self) -> FirewallBackend:
+        return self._backend or get_backend()
+
+    def _ensure_worker(self) -> None:
+        # The thread does not survive ``fork``; each process starts its own.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._wake = threading.Event()
+                threading.Thread(target=self._run, name="firewall-batch", daemon=True).start()
+                self._pid = os.getpid()
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self._retry_delay())
+            time.sleep(self.interval)
+            self.flush()
+
+    def _retry_delay(self):
+        with self._lock:
+            if not self._retries:
+                return None
+            due = min(when for _, _, when in self._retries.values())
+        return max(0.0, due - time.monotonic())
+
+    def schedule(self, ip: str, block: bool) -> None:
+        with self._lock:
+            self._pending[ip] = block
+        self._ensure_worker()
+        self._wake.set()
+
+    def _apply(self, call, ips: list) -> bool:
+        if not ips:
+            return True
+        try:
+            return call(ips)
+        except Exception as exc:
+            logger.error("Erro ao aplicar lote do firewall: %s", exc)
+            return False
+
+    def flush(self) -> None:
+        """Apply every pending operation, and the retries that are due, now."""
+        with self._apply_lock:
+            now = time.monotonic()
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                attempts = {}
+                for ip, (block, tries, due) in list(self._retries.items()):
+                    if ip in batch:
+                        # Replaced by a newer operation
+                        del self._retries[ip]
+                    elif due <= now:
+                        batch[ip] = block
+                        attempts[ip] = tries
+                        del self._retries[ip]
+                self._wake.clear()
+            if not batch:
+                return
+            blocks = [ip for ip, block in batch.items() if block]
+            unblocks = [ip for ip, block in batch.items() if not block]
+            backend = self.backend
+            failed = []
+            if not self._apply(backend.block, blocks):
+                failed.extend(blocks)
+            if not self._apply(backend.unblock, unblocks):
+                failed.extend(unblocks)
+            with self._lock:
+                self.batches += 1
+                self.applied += len(batch) - len(failed)
+                if failed:
+                    self.errors += 1
+            if failed:
+                self._retry(failed, batch, attempts)
+
+    def _retry(self, ips: list, batch: dict, attempts: dict) -> None:
+        now = time.monotonic()
+        with self._lock:
+            for ip in ips:
+                if ip in self._pending:
+                    continue
+                block = batch[ip]
+                action = "bloquear" if block else "desbloquear"
+                tries = attempts.get(ip, 0) + 1
+                if tries > self.max_retries:
+                    self.failed += 1
+                    logger.error(
+                        "Firewall: desistindo de %s %s apos %d tentativas", action, ip, tries
+                    )
+                    continue
+                delay = 2.0 ** (tries - 1)
+                self._retries[ip] = (block, tries, now + delay)
+                self.retried += 1
+                logger.warning(
+                    "Firewall: falha ao %s %s; nova tentativa em %.0f s", action, ip, delay
+                )
+        # Let the worker recompute its timeout for the new retries
+        self._wake.set()
+
+    def pending(self) -> set:
+        """Return the IPs with an operation not applied yet (retries included)."""
+        with self._lock:
+            return set(self._pending) | set(self._retries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "backend": self.backend.name,
+                "pending": len(self._pending),
+                "retrying": len(self._retries),
+                "batches": self.batches,
+                "applied": self.applied,
+                "errors": self.errors,
+                "retried": self.retried,
+                "failed": self.failed,
+            }
+
+
+batcher = FirewallQueue()
+
+
+def schedule_block(ip: str) -> bool:
+    """Queue a block of ``ip`` without waiting for the firewall.
+
+    Returns False if the IP is whitelisted or already blocked; the caller
+    records the block at once and the rule follows within one batch.
+    """
+    if ip in blocklist or is_whitelisted(ip):
         return False
+    batcher.schedule(ip, True)
+    return True
+
+
+def schedule_unblock(ip: str) -> bool:
+    """Queue the removal of the rule of ``ip``; False if no block was found.
+
+    The removal is always queued: another worker may have blocked ``ip``
+    without this process knowing, and removing a missing rule is a no-op
+    for every backend. Only when neither this process, the database nor the
+    firewall know of a block is False returned.
+    """
+    known = ip in blocklist or ip in batcher.pending()
+    batcher.schedule(ip, False)
+    if known:
+        return True
+    row = db.get_blocked_ip(ip)
+    if row is not None and row.get("status") == "blocked":
+        return True
+    return ip in get_backend().blocked()
+
+
+def stats() -> dict:
+    return {**batcher.stats(), "reconciler": reconciler.stats()}
+
+
+def is_ip_blocked(ip: str) -> bool:
+    """Check if the IP is blocked by the firewall backend."""
+    return ip in get_backend().blocked()
 
 
 def block_ip(ip: str) -> bool:
-    """Block the given IP using UFW. Returns True if command succeeds."""
+    """Block the given IP at once. Returns True if the command succeeds."""
     if is_whitelisted(ip):
         logger.info("IP %s is whitelisted; skipping block", ip)
         return False
     if is_ip_blocked(ip):
         return False
-    try:
-        subprocess.run(
-            [
-                "sudo",
-                "ufw",
-                "insert",
-                "1",
-                "deny",
-                "from",
-                ip,
-                "to",
-                "any",
-                "port",
-                str(config.UNIT_BACKEND_PORT),
-            ],
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        logger.info("UFW rule added for %s", ip)
-        return True
-    except Exception as exc:
-        logging.error("Erro ao bloquear IP %s: %s", ip, exc)
-        return False
+    return get_backend().block([ip])
 
 
 def unblock_ip(ip: str) -> bool:
-    """Remove UFW rule for the given IP."""
+    """Remove the firewall rule for the given IP at once."""
     if not is_ip_blocked(ip):
         return False
-    try:
-        subprocess.run(
-            [
-                "sudo",
-                "ufw",
-                "delete",
-                "deny",
-                "from",
-                ip,
-                "to",
-                "any",
-                "port",
-                str(config.UNIT_BACKEND_PORT),
-            ],
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        logger.info("UFW rule removed for %s", ip)
-        return True
-    except Exception as exc:
-        logging.error("Erro ao desbloquear IP %s: %s", ip, exc)
-        return False
+    return get_backend().unblock([ip])
 
 
 def get_ufw_blocked_ips() -> set:
-    """Return the current set of blocked IPs from UFW rules."""
-    try:
-        result = subprocess.run(
-            ["sudo", "ufw", "status", "numbered"],
-            capture_output=True,
-            text=True,
-            check=True,
-        )
-    except Exception as exc:
-        logging.error("Erro ao obter IPs do UFW: %s", exc)
-        return set()
-
-    ips = set()
-    for line in result.stdout.splitlines():
-        if "DENY" in line:
-            match = re.search(r"from\s+(\S+)", line)
-            if match:
-                ips.add(match.group(1))
-            else:
-                parts = line.split()
-                for part in parts:
-                    if re.match(r"\d+\.\d+\.\d+\.\d+", part):
-                        ips.add(part)
-                        break
-    return ips
+    """Return the current set of blocked IPs from the firewall backend."""
+    return get_backend().blocked()
+
 
+def sync_blocked_ips_with_ufw(ufw_ips: set = None, conn=None) -> set:
+    """Synchronize database entries with actual firewall rules.
 
-def sync_blocked_ips_with_ufw() -> set:
-    """Synchronize database entries with actual UFW rules."""
-    ufw_ips = get_ufw_blocked_ips()
-    if db.conn is None:
+    IPs with an operation still queued in :data:`batcher`, or whose row
+    changed less than ``FIREWALL_RECONCILE_GRACE`` seconds ago (their
+    operation may be queued in another worker), are left alone. ``conn``
+    defaults to the module connection of :mod:`app.db`.
+    """
+    if ufw_ips is None:
+        ufw_ips = get_ufw_blocked_ips()
+    conn = conn or db.conn
+    if conn is None:
         return ufw_ips
 
-    with db.conn.cursor() as cur:
+    with conn.cursor() as cur:
         cur.execute("SELECT ip FROM blocked_ips WHERE status = 'blocked'")
         current_blocked = {row[0] for row in cur.fetchall()}
+        cur.execute(
+            "SELECT DISTINCT ip FROM blocked_ips "
+            "WHERE updated_at > NOW() - make_interval(secs => %s)",
+            (config.FIREWALL_RECONCILE_GRACE,),
+        )
+        recent = {row[0] for row in cur.fetchall()}
+    pending = batcher.pending() | recent
 
     # insert new blocked IPs
-    for ip in ufw_ips - current_blocked:
+    for ip in ufw_ips - current_blocked - pending:
         from .ipinfo import fetch_ip_info
         ip_info = fetch_ip_info(ip)
-        db.save_blocked_ip(ip, "ufw", "blocked", ip_info=ip_info)
+        db.save_blocked_ip(ip, "ufw", "blocked", ip_info=ip_info, connection=conn)
         events.notify_blocked({
             'ip': ip,
             'reason': 'ufw',
@@ -150,8 +567,9 @@ def sync_blocked_ips_with_ufw() -> set:
         logger.info("Recorded blocked IP from UFW: %s", ip)
 
     # remove IPs no longer blocked
-    for ip in current_blocked - ufw_ips:
-        with db.conn.cursor() as cur:
+    for ip in current_blocked - ufw_ips - pending:
+        blocklist.discard(ip)
+        with conn.cursor() as cur:
             cur.execute(
                 "DELETE FROM blocked_ips WHERE ip=%s AND status='blocked'",
                 (ip,),
@@ -172,3 +590,159 @@ def sync_blocked_ips_with_ufw() -> set:
         logger.info("Removed IP from blocked list: %s", ip)
 
     return ufw_ips
+
+
+class Reconciler:
+    """Keeps ``blocked_ips`` in line with the firewall from a background thread.
+
+    Every ``FIREWALL_RECONCILE_INTERVAL`` seconds the rules and the state of
+    ``blocked_ips`` (row count and last change) are read and hashed; the
+    rules are only compared with the table (and the differences published
+    through :mod:`app.events`) when the hash changed. The panel pages read
+    the reconciled table instead of querying the firewall themselves.
+
+    Every process starts the thread, but only the one holding an ``flock``
+    on ``FIREWALL_RECONCILE_LOCK`` reconciles; the others take over if it
+    exits. The reconciler uses its own database connection.
+    """
+
+    def __init__(self, interval: float = None, lock_path: str = None):
+        self.interval = (
+            config.FIREWALL_RECONCILE_INTERVAL if interval is None else float(interval)
+        )
+        self.lock_path = lock_path or config.FIREWALL_RECONCILE_LOCK
+        self._lock = threading.Lock()
+        self._pid = None
+        self._lock_fd = None
+        self._lock_pid = None
+        self._conn = None
+        self._conn_pid = None
+        self._digest = None
+        self.rules = frozenset()
+        self.checked_at = None
+        self.runs = 0
+        self.changes = 0
+        self.errors = 0
+        # A forked child must not believe it holds the parent's lock
+        os.register_at_fork(after_in_child=self._forget_lock)
+
+    def _forget_lock(self) -> None:
+        if self._lock_fd is not None:
+            try:
+                os.close(self._lock_fd)
+            except OSError:
+                pass
+        self._lock_fd = None
+        self._lock_pid = None
+
+    def leader(self) -> bool:
+        """Take the reconciler lock of the host if it is free; True if held."""
+        if self._lock_fd is not None and self._lock_pid == os.getpid():
+            return True
+        try:
+            fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError as exc:
+            logger.error("Erro ao abrir trava %s: %s", self.lock_path, exc)
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        self._lock_pid = os.getpid()
+        logger.info("Processo %s assumiu a reconciliacao do firewall", os.getpid())
+        return True
+
+    def _connection(self):
+        conn = self._conn
+        if conn is None or self._conn_pid != os.getpid() or getattr(conn, "closed", 0):
+            conn = self._conn = db.open_connection()
+            self._conn_pid = os.getpid()
+        return conn
+
+    def start(self) -> None:
+        """Start the thread (once per process); ``interval=0`` disables it."""
+        if self.interval <= 0 or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self._run, name="firewall-reconcile", daemon=True).start()
+                self._pid = os.getpid()
+
+    def _run(self) -> None:
+        while True:
+            if self.leader():
+                try:
+                    self.run_once()
+                except Exception as exc:
+                    self.errors += 1
+                    # Reconnect on the next pass
+                    self._conn = None
+                    logger.error("Erro ao reconciliar firewall: %s", exc)
+            time.sleep(self.interval)
+
+    @staticmethod
+    def _table_state(conn):
+        """Return ``(rows, last change, rows in the grace period)`` or None."""
+        if conn is None:
+            return None
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT count(*), max(updated_at), "
+                "count(*) FILTER (WHERE updated_at > NOW() - make_interval(secs => %s)) "
+                "FROM blocked_ips",
+                (config.FIREWALL_RECONCILE_GRACE,),
+            )
+            return cur.fetchone()
+
+    @staticmethod
+    def _digest_of(rules: frozenset, state) -> str:
+        snapshot = "" if state is None else f"{state[0]}|{state[1]}"
+        return hashlib.sha256(
+            ("\n".join(sorted(rules)) + "\n#" + snapshot).encode()
+        ).hexdigest()
+
+    def run_once(self) -> bool:
+        """Reconcile now; return True if the rules or the table had changed."""
+        # Queued operations are applied first so they are not undone
+        batcher.flush()
+        conn = self._connection()
+        if conn is None and db.conn is not None:
+            logger.error("Reconciliacao do firewall sem conexao propria com o banco")
+            return False
+        rules = frozenset(get_ufw_blocked_ips())
+        digest = self._digest_of(rules, self._table_state(conn))
+        self.runs += 1
+        self.checked_at = time.time()
+        if digest == self._digest:
+            return False
+        sync_blocked_ips_with_ufw(set(rules), conn=conn)
+        self.rules = rules
+        self.changes += 1
+        # Hash the table as the sync left it; IPs skipped because they were
+        # queued or changed recently are compared again on the next pass
+        state = self._table_state(conn)
+        if batcher.pending() or (state is not None and state[2]):
+            self._digest = None
+        else:
+            self._digest = self._digest_of(rules, state)
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "interval": self.interval,
+            "leader": self._lock_fd is not None and self._lock_pid == os.getpid(),
+            "rules": len(self.rules),
+            "runs": self.runs,
+            "changes": self.changes,
+            "errors": self.errors,
+            "checked_at": self.checked_at,
+        }
+
+
+reconciler = Reconciler()
+
+
+def start_reconciler() -> None:
+    reconciler.start()
@@ -0,0 +1,261 @@
+"""Local inference daemon shared by the proxy worker processes.
+
+The server owns the models and answers analysis requests over a Unix domain
+socket. Each frame has a fixed header (magic, version, type, request id and
+payload length) followed by the payload:
+
+* requests carry the list of stages to skip followed by the list of UTF-8
+  texts;
+* responses carry, for each result, the JSON of the result without the
+  semantic embedding plus the embedding as little-endian float32 values;
+* errors carry a UTF-8 message.
+
+Run with ``python -m app.inference_server`` and point the proxy to the same
+path through ``INFERENCE_SOCKET``.
+"""
+import itertools
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import threading
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"NU"
+VERSION = 2
+MSG_REQUEST = 1
+MSG_RESPONSE = 2
+MSG_ERROR = 3
+
+_HEADER = struct.Struct("!2sBBII")
+_U32 = struct.Struct("!I")
+_RESULT_HEADER = struct.Struct("!II")
+
+
+class ProtocolError(Exception):
+    """Raised when a peer sends a malformed frame."""
+
+
+def _recv_exact(sock, size: int) -> bytes:
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError("conexao encerrada")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def send_frame(sock, kind: int, request_id: int, payload: bytes) -> None:
+    sock.sendall(_HEADER.pack(MAGIC, VERSION, kind, request_id, len(payload)) + payload)
+
+
+def recv_frame(sock):
+    """Return ``(kind, request_id, payload)`` of the next frame."""
+    magic, version, kind, request_id, length = _HEADER.unpack(
+        _recv_exact(sock, _HEADER.size)
+    )
+    if magic != MAGIC or version != VERSION:
+        raise ProtocolError("frame invalido")
+    if length > config.INFERENCE_MAX_FRAME:
+        raise ProtocolError("frame muito grande")
+    return kind, request_id, _recv_exact(sock, length)
+
+
+def encode_texts(texts: list) -> bytes:
+    parts = [_U32.pack(len(texts))]
+    for text in texts:
+        data = text.encode("utf-8", "surrogateescape")
+        parts.append(_U32.pack(len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def _decode_list(payload: bytes, offset: int = 0):
+    (count,) = _U32.unpack_from(payload, offset)
+    offset += _U32.size
+    texts = []
+    for _ in range(count):
+        (size,) = _U32.unpack_from(payload, offset)
+        offset += _U32.size
+        texts.append(payload[offset:offset + size].decode("utf-8", "surrogateescape"))
+        offset += size
+    return texts, offset
+
+
+def decode_texts(payload: bytes) -> list:
+    return _decode_list(payload)[0]
+
+
+def encode_request(texts: list, skip=()) -> bytes:
+    return encode_texts(sorted(skip)) + encode_texts(texts)
+
+
+def decode_request(payload: bytes):
+    """Return ``(texts, skip)`` of a request payload."""
+    skip, offset = _decode_list(payload)
+    texts, _ = _decode_list(payload, offset)
+    return texts, frozenset(skip)
+
+
+def encode_results(results: list) -> bytes:
+    parts = [_U32.pack(len(results))]
+    for result in results:
+        semantic = dict(result.get("semantic") or {})
+        embedding = semantic.pop("embedding", None) or []
+        body = json.dumps({**result, "semantic": semantic}, separators=(",", ":")).encode()
+        parts.append(_RESULT_HEADER.pack(len(body), len(embedding)))
+        parts.append(body)
+        parts.append(struct.pack(f"<{len(embedding)}f", *embedding))
+    return b"".join(parts)
+
+
+def decode_results(payload: bytes) -> list:
+    (count,) = _U32.unpack_from(payload, 0)
+    offset = _U32.size
+    results = []
+    for _ in range(count):
+        body_len, dim = _RESULT_HEADER.unpack_from(payload, offset)
+        offset += _RESULT_HEADER.size
+        result = json.loads(payload[offset:offset + body_len])
+        offset += body_len
+        embedding = list(struct.unpack_from(f"<{dim}f", payload, offset))
+        offset += 4 * dim
+        result.setdefault("semantic", {})["embedding"] = embedding
+        results.append(result)
+    return results
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        detector = self.server.detector
+        while True:
+            try:
+                kind, request_id, payload = recv_frame(self.request)
+            except (ConnectionError, OSError):
+                return
+            except ProtocolError as exc:
+                logger.warning("Requisicao invalida no servidor de inferencia: %s", exc)
+                return
+            if kind != MSG_REQUEST:
+                send_frame(self.request, MSG_ERROR, request_id, b"tipo de mensagem invalido")
+                continue
+            try:
+                texts, skip = decode_request(payload)
+                if skip:
+                    results = detector.analyze_batch(texts, skip=skip)
+                else:
+                    results = detector.analyze_batch(texts)
+                send_frame(self.request, MSG_RESPONSE, request_id, encode_results(results))
+            except OSError:
+                return
+            except Exception as exc:
+                logger.error("Erro na analise remota: %s", exc)
+                send_frame(self.request, MSG_ERROR, request_id, str(exc).encode())
+
+
+class InferenceServer(socketserver.ThreadingUnixStreamServer):
+    """Serve ``detector.analyze_batch`` over a Unix domain socket."""
+
+    daemon_threads = True
+
+    def __init__(self, path: str, detector):
+        if os.path.exists(path):
+            os.unlink(path)
+        self.detector = detector
+        super().__init__(path, _Handler)
+        os.chmod(path, 0o660)
+
+
+class RemoteDetector:
+    """Client with the same ``analyze`` contract as :class:`Detector`.
+
+    Each thread keeps its own connection. A request is resent on a new
+    connection only if connecting or sending failed; once it was sent, a
+    failed or timed-out reply is an error, so the daemon never runs the same
+    batch twice.
+    """
+
+    def __init__(self, path: str, timeout: float = None):
+        self.path = path
+        self.timeout = config.INFERENCE_TIMEOUT if timeout is None else timeout
+        self._local = threading.local()
+        self._ids = itertools.count(1)
+
+    def _connection(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is None or getattr(self._local, "pid", None) != os.getpid():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            self._local.sock = sock
+            self._local.pid = os.getpid()
+        return sock
+
+    def _close(self) -> None:
+        sock = getattr(self._local, "sock", None)
+        self._local.sock = None
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def analyze_batch(self, texts: list, skip=()) -> list:
+        request_id = next(self._ids) & 0xFFFFFFFF
+        payload = encode_request(list(texts), skip)
+        for attempt in range(2):
+            try:
+                sock = self._connection()
+                send_frame(sock, MSG_REQUEST, request_id, payload)
+                break
+            except OSError:
+                # Stale connection (e.g. daemon restarted): reconnect once
+                self._close()
+                if attempt:
+                    raise
+        try:
+            kind, reply_id, body = recv_frame(sock)
+        except (OSError, ProtocolError):
+            # The reply may still arrive later; drop the connection so it is
+            # never read as the answer to another request
+            self._close()
+            raise
+        if reply_id != request_id:
+            self._close()
+            raise ProtocolError("resposta fora de ordem")
+        if kind == MSG_ERROR:
+            raise RuntimeError(body.decode("utf-8", "replace"))
+        return decode_results(body)
+
+    def analyze(self, text: str, skip=()) -> dict:
+        return self.analyze_batch([text], skip)[0]
+
+
+def main() -> None:
+    from .logging_setup import configure_logging
+    from .batching import BatchScheduler
+    from .detection import Detector
+
+    configure_logging()
+    path = config.INFERENCE_SOCKET or "/tmp/nginx_unit_ia.sock"
+    server = InferenceServer(path, BatchScheduler(Detector()))
+    logger.info("Servidor de inferencia escutando em %s", path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,14 @@
+"""Attack intensity score, importable without the model dependencies."""
+
+
+def calculate_intensity(sev_label: str, anomaly_scores: list, similarity: float) -> float:
+    """Return a numeric attack intensity based on model results."""
+    sev_weight = {
+        "low": 1,
+        "medium": 2,
+        "high": 3,
+        "error": 4,
+    }.get(str(sev_label).lower(), 1)
+    anomaly_prob = max(float(s) for s in anomaly_scores)
+    intensity = sev_weight * anomaly_prob * (1.0 - float(similarity))
+    return round(intensity * 100, 2)
@@ -1,4 +1,8 @@
+import os
+import signal
+import socket
 import threading
+import time
 from werkzeug.serving import make_server
 import logging
 from . import config, wsgi
@@ -31,9 +35,107 @@ def stop():
         logger.info("Proxy parado")
 
 
+def _freeze_detector() -> None:
+    # ``wsgi.detector`` may be wrapped by the batching scheduler or the
+    # verdict cache; follow ``.detector`` until the object that owns the models.
+    obj = wsgi.detector
+    while obj is not None and not hasattr(obj, "freeze"):
+        obj = getattr(obj, "detector", None)
+    if obj is not None:
+        obj.freeze()
+
+
+def _run_worker(sock: socket.socket) -> None:
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    # Connections opened by the parent must not be shared between processes
+    from . import db, es
+
+    db.connect()
+    es.connect()
+    server = make_server(
+        "0.0.0.0", sock.getsockname()[1], wsgi.app, threaded=True, fd=sock.fileno()
+    )
+    logger.info("Worker %s atendendo na porta %s", os.getpid(), sock.getsockname()[1])
+    server.serve_forever()
+
+
+def serve_prefork(port: int = None, workers: int = None) -> None:
+    """Load the models once and fork ``workers`` proxy processes.
+
+    The workers share the model weights copy-on-write and accept connections
+    from a listening socket created by the parent, which restarts any worker
+    that exits until it receives SIGTERM or SIGINT.
+    """
+    if port is None:
+        port = config.UNIT_PORT
+    if workers is None:
+        workers = config.PROXY_WORKERS
+    _freeze_detector()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+
+    children = {}
+    stopping = False
+
+    def spawn() -> None:
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _run_worker(sock)
+            except BaseException as exc:
+                logger.error("Worker %s encerrado com erro: %s", os.getpid(), exc)
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = time.monotonic()
+
+    def shutdown(signum, frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    for _ in range(max(1, workers)):
+        spawn()
+    logger.info("Proxy iniciado na porta %s com %d workers", port, len(children))
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        started = children.pop(pid, None)
+        if started is None or stopping:
+            continue
+        logger.warning(
+            "Worker %s terminou (status %s); reiniciando",
+            pid,
+            os.waitstatus_to_exitcode(status),
+        )
+        # Avoid a tight restart loop when workers die right after starting
+        if time.monotonic() - started < 1:
+            time.sleep(1)
+        spawn()
+    sock.close()
+    logger.info("Proxy parado")
+
+
 if __name__ == "__main__":
-    start()
-    try:
-        _thread.join()
-    except KeyboardInterrupt:
-        stop()
+    if config.PROXY_WORKERS > 1:
+        serve_prefork()
+    else:
+        start()
+        try:
+            _thread.join()
+        except KeyboardInterrupt:
+            stop()
@@ -0,0 +1,163 @@
+"""Token-bucket rate limiter checked before any analysis.
+
+Each key (client IP, client subnet or path prefix) owns a bucket of fixed
+size holding at most ``limit`` tokens and refilled at ``limit / window``
+tokens per second, so a client may send ``limit`` requests in a burst and
+then one every ``window / limit`` seconds. Buckets live in an LRU bounded by
+``RATE_LIMIT_MAX_KEYS``: idle keys are evicted first, and an evicted key
+simply starts again with a full bucket. With ``SHARED_STATE`` the buckets
+live in a :class:`~app.shm.SharedTable` instead, so the limits apply to all
+worker processes of the host together.
+"""
+import ipaddress
+import threading
+import time
+import struct
+import logging
+from collections import OrderedDict
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+IP = "ip"
+SUBNET = "subnet"
+PATH = "path"
+_STATE = struct.Struct("<dd")
+
+
+class _Bucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+
+def subnet(ip: str, v4_prefix: int = None, v6_prefix: int = None):
+    """Return the ``/24`` (IPv4) or ``/64`` (IPv6) network of ``ip``."""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return None
+    if address.version == 4:
+        prefix = config.RATE_LIMIT_SUBNET_V4 if v4_prefix is None else v4_prefix
+    else:
+        prefix = config.RATE_LIMIT_SUBNET_V6 if v6_prefix is None else v6_prefix
+    return str(ipaddress.ip_network(f"{address}/{prefix}", strict=False))
+
+
+class RateLimiter:
+    """Per-IP, per-subnet and per-path-prefix token buckets.
+
+    A limit of ``0`` disables the corresponding key. ``paths`` maps a path
+    prefix to the number of requests allowed per window for all clients
+    together. ``shared`` is an optional shared table holding the buckets.
+    """
+
+    def __init__(
+        self,
+        window: float = None,
+        per_ip: int = None,
+        per_subnet: int = None,
+        paths: dict = None,
+        max_keys: int = None,
+        clock=None,
+        shared=None,
+    ):
+        self.window = max(
+            0.001, config.RATE_LIMIT_WINDOW if window is None else float(window)
+        )
+        self.per_ip = config.RATE_LIMIT_IP if per_ip is None else int(per_ip)
+        self.per_subnet = config.RATE_LIMIT_SUBNET if per_subnet is None else int(per_subnet)
+        self.paths = dict(config.RATE_LIMIT_PATHS if paths is None else paths)
+        self.max_keys = max(
+            1, config.RATE_LIMIT_MAX_KEYS if max_keys is None else int(max_keys)
+        )
+        self.shared = shared
+        if clock is None:
+            # Shared buckets are compared between processes
+            clock = time.time if shared is not None else time.monotonic
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.limited = {IP: 0, SUBNET: 0, PATH: 0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.per_ip > 0 or self.per_subnet > 0 or self.paths)
+
+    def _refill(self, tokens: float, updated: float, limit: int, now: float) -> float:
+        return min(float(limit), tokens + max(0.0, now - updated) * limit / self.window)
+
+    def _take_shared(self, key: tuple, limit: int, now: float) -> bool:
+        taken = []
+
+        def take(old):
+            tokens = float(limit)
+            if old is not None:
+                tokens = self._refill(*_STATE.unpack(old), limit, now)
+            taken.append(tokens >= 1)
+            return _STATE.pack(tokens - 1 if tokens >= 1 else tokens, now)
+
+        # Idle buckets are full again after one window
+        self.shared.update(f"{key[0]}:{key[1]}", take, ttl=self.window)
+        return taken[0]
+
+    def _take(self, key: tuple, limit: int, now: float) -> bool:
+        # Called with the lock held
+        if self.shared is not None:
+            return self._take_shared(key, limit, now)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _Bucket(float(limit), now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+                self.evictions += 1
+        else:
+            self._buckets.move_to_end(key)
+            bucket.tokens = self._refill(bucket.tokens, bucket.updated, limit, now)
+            bucket.updated = now
+        if bucket.tokens < 1:
+            return False
+        bucket.tokens -= 1
+        return True
+
+    def _keys(self, ip: str, path: str):
+        if ip and self.per_ip > 0:
+            yield IP, (IP, ip), self.per_ip
+        if ip and self.per_subnet > 0:
+            network = subnet(ip)
+            if network is not None:
+                yield SUBNET, (SUBNET, network), self.per_subnet
+        for prefix, limit in self.paths.items():
+            if limit > 0 and path.startswith(prefix):
+                yield PATH, (PATH, prefix), limit
+
+    def check(self, ip: str, path: str = ""):
+        """Take a token for the request; return the exceeded scope or None.
+
+        The scope is ``"ip"``, ``"subnet"`` or ``"path"``. Keys are checked
+        in that order and the first empty bucket stops the check.
+        """
+        if not self.enabled:
+            return None
+        now = self.clock()
+        with self._lock:
+            for scope, key, limit in self._keys(ip, path or ""):
+                if not self._take(key, limit, now):
+                    self.limited[scope] += 1
+                    return scope
+        return None
+
+    def stats(self) -> dict:
+        if self.shared is not None:
+            return {**self.shared.stats(), "limited": dict(self.limited)}
+        with self._lock:
+            return {
+                "keys": len(self._buckets),
+                "max_keys": self.max_keys,
+                "evictions": self.evictions,
+                "limited": dict(self.limited),
+            }
@@ -0,0 +1,260 @@
+"""In-memory cache of upstream responses for idempotent requests.
+
+Only ``GET`` responses are stored (``HEAD`` is answered from them) and only
+when the analysis judged the request benign. Freshness follows the
+``Cache-Control`` (``s-maxage``/``max-age``) or ``Expires`` headers of the
+response; ``no-store``, ``private``, ``Set-Cookie`` and ``Vary: *`` make a
+response uncacheable. Stale entries carrying an ``ETag`` or
+``Last-Modified`` are revalidated with a conditional request. The cache is
+bounded by the total size of the stored bodies.
+"""
+import threading
+import time
+import logging
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+CACHEABLE_STATUSES = {200, 203, 301, 404, 410}
+HIT = "HIT"
+MISS = "MISS"
+REVALIDATED = "REVALIDATED"
+BYPASS = "BYPASS"
+
+
+def _directives(value: str) -> dict:
+    """Parse a ``Cache-Control`` header into ``{directive: value}``."""
+    result = {}
+    for part in (value or "").split(","):
+        name, _, arg = part.strip().partition("=")
+        if name:
+            result[name.lower()] = arg.strip('"')
+    return result
+
+
+def _seconds(value) -> float:
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def freshness(headers) -> float:
+    """Return how many seconds a response stays fresh (0 if unknown).
+
+    ``no-cache``, ``no-store`` and ``private`` win over any lifetime given
+    with them (RFC 9111): such a response is never served without a
+    successful revalidation.
+    """
+    cc = _directives(headers.get("cache-control", ""))
+    if "no-cache" in cc or "no-store" in cc or "private" in cc:
+        return 0.0
+    if "s-maxage" in cc:
+        return _seconds(cc["s-maxage"])
+    if "max-age" in cc:
+        return _seconds(cc["max-age"])
+    expires = headers.get("expires")
+    if expires:
+        try:
+            expires_at = parsedate_to_datetime(expires).timestamp()
+            date = headers.get("date")
+            now = parsedate_to_datetime(date).timestamp() if date else time.time()
+        except (TypeError, ValueError):
+            return 0.0
+        return max(0.0, expires_at - now)
+    return 0.0
+
+
+class CachedResponse:
+    """Stored response; ``headers`` excludes the hop-by-hop headers."""
+
+    __slots__ = ("status_code", "headers", "body", "vary", "stored_at", "ttl", "size")
+
+    def __init__(self, status_code: int, headers: list, body: bytes, vary: dict, ttl: float):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        self.vary = vary
+        self.stored_at = time.monotonic()
+        self.ttl = ttl
+        self.size = len(body) + sum(len(k) + len(v) for k, v in headers)
+
+    def header(self, name: str):
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return None
+
+    def age(self) -> float:
+        return time.monotonic() - self.stored_at
+
+    def fresh(self) -> bool:
+        return self.age() < self.ttl
+
+
+class ResponseCache:
+    """Byte-bounded LRU of upstream responses keyed by method, path and query."""
+
+    def __init__(self, max_bytes: int = None, max_entry: int = None, excluded=()):
+        self.max_bytes = config.RESPONSE_CACHE_BYTES if max_bytes is None else int(max_bytes)
+        self.max_entry = config.RESPONSE_CACHE_MAX_ENTRY if max_entry is None else int(max_entry)
+        self.excluded = {h.lower() for h in excluded}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.stored = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(path: str, params) -> str:
+        """Return the cache key; query parameters are sorted."""
+        items = params.items(multi=True) if hasattr(params, "items") else params or []
+        query = "&".join(f"{k}={v}" for k, v in sorted(items))
+        return f"{path}?{query}"
+
+    def _lookup(self, key: str, headers: dict):
+        with self._lock:
+            for entry in self._entries.get(key, ()):
+                if all(headers.get(name, "") == value for name, value in entry.vary.items()):
+                    self._entries.move_to_end(key)
+                    return entry
+        return None
+
+    def _store(self, key: str, entry: CachedResponse) -> None:
+        with self._lock:
+            variants = self._entries.setdefault(key, [])
+            for old in [v for v in variants if v.vary == entry.vary]:
+                variants.remove(old)
+                self.size -= old.size
+            variants.append(entry)
+            self._entries.move_to_end(key)
+            self.size += entry.size
+            self.stored += 1
+            while self.size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= sum(v.size for v in evicted)
+                self.evictions += len(evicted)
+
+    def _cacheable(self, response, vary: list) -> float:
+        """Return the TTL of ``response`` or ``None`` if it must not be stored."""
+        headers = response.headers
+        cc = _directives(headers.get("cache-control", ""))
+        if (
+            response.status_code not in CACHEABLE_STATUSES
+            or "no-store" in cc
+            or "private" in cc
+            or "set-cookie" in headers
+            or "*" in vary
+        ):
+            return None
+        length = headers.get("content-length")
+        if length is None or not length.isdigit() or int(length) > self.max_entry:
+            return None
+        ttl = freshness(headers)
+        if ttl <= 0 and not (headers.get("etag") or headers.get("last-modified")):
+            return None
+        return ttl
+
+    def fetch(self, send, method: str, path: str, headers: dict, params, benign: bool):
+        """Answer a request from the cache or through ``send``.
+
+        ``send(headers)`` forwards the request with the given headers and
+        returns a streamed upstream response. The result is ``(response,
+        state)`` where ``response`` is either a :class:`CachedResponse` or the
+        upstream response and ``state`` one of ``HIT``, ``REVALIDATED``,
+        ``MISS`` or ``BYPASS``.
+        """
+        lowered = {k.lower(): v for k, v in headers.items()}
+        request_cc = _directives(lowered.get("cache-control", ""))
+        if (
+            method not in ("GET", "HEAD")
+            or "no-store" in request_cc
+            or "authorization" in lowered
+        ):
+            return send(headers), BYPASS
+        key = self.key(path, params)
+        entry = self._lookup(key, lowered)
+        if entry is not None and entry.fresh() and "no-cache" not in request_cc:
+            with self._lock:
+                self.hits += 1
+            return entry, HIT
+
+        forward = dict(headers)
+        if entry is not None:
+            etag = entry.header("etag")
+            modified = entry.header("last-modified")
+            if etag:
+                forward["If-None-Match"] = etag
+            if modified:
+                forward["If-Modified-Since"] = modified
+        response = send(forward)
+        if entry is not None and response.status_code == 304:
+            response.close()
+            with self._lock:
+                self.revalidated += 1
+            return self._refresh(key, entry, response.headers), REVALIDATED
+
+        with self._lock:
+            self.misses += 1
+        vary = [v.strip().lower() for v in response.headers.get("vary", "").split(",") if v.strip()]
+        ttl = self._cacheable(response, vary) if benign and method == "GET" else None
+        if ttl is None:
+            return response, MISS
+        body = response.read()
+        entry = CachedResponse(
+            response.status_code,
+            [
+                (k, v)
+                for k, v in response.headers.multi_items()
+                if k.lower() not in self.excluded
+            ],
+            body,
+            {name: lowered.get(name, "") for name in vary},
+            ttl,
+        )
+        self._store(key, entry)
+        return entry, MISS
+
+    def _refresh(self, key: str, entry: CachedResponse, headers) -> CachedResponse:
+        # A 304 carries the current validators and freshness of the entry;
+        # the headers describing the stored body are kept.
+        updated = [
+            (k, v)
+            for k, v in headers.multi_items()
+            if k.lower() not in self.excluded | {"content-length", "content-encoding"}
+        ]
+        names = {k.lower() for k, _ in updated}
+        refreshed = CachedResponse(
+            entry.status_code,
+            [(k, v) for k, v in entry.headers if k.lower() not in names] + updated,
+            entry.body,
+            entry.vary,
+            freshness(headers) if "cache-control" in names or "expires" in names else entry.ttl,
+        )
+        self._store(key, refreshed)
+        return refreshed
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "keys": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "revalidated": self.revalidated,
+                "stored": self.stored,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,64 @@
+import re
+
+from . import config
+
+# Marker inserted where the middle of a long payload was removed
+GAP_MARKER = " [...] "
+
+# A character or short token repeated many times in a row ("AAAA...",
+# "%00%00...") is reduced to a few copies.
+_REPEATS = re.compile(r"(.{1,8}?)\1{7,}", re.DOTALL)
+_SPACES = re.compile(r"[ \t]{2,}")
+_BLANK_LINES = re.compile(r"\n{3,}")
+
+
+def collapse_filler(text: str) -> str:
+    """Collapse repeated tokens, runs of spaces and blank lines."""
+    text = _REPEATS.sub(lambda m: m.group(1) * 4, text)
+    text = _SPACES.sub(" ", text)
+    return _BLANK_LINES.sub("\n\n", text)
+
+
+def head_tail(text: str, budget: int, head_ratio: float) -> str:
+    """Keep the start and the end of ``text`` within ``budget`` characters."""
+    if len(text) <= budget:
+        return text
+    if budget <= len(GAP_MARKER):
+        return text[:budget]
+    keep = budget - len(GAP_MARKER)
+    head = int(keep * head_ratio)
+    tail = keep - head
+    return text[:head] + GAP_MARKER + (text[-tail:] if tail else "")
+
+
+def shape_input(text: str, max_chars: int = None, head_ratio: float = None) -> str:
+    """Return the request text bounded for the models.
+
+    Filler in the request line and in the payload is collapsed and, if the
+    payload is still over the budget, only a head and a tail window are kept
+    so attack markers at the end of large bodies are still seen.
+    ``max_chars <= 0`` disables shaping.
+    """
+    if max_chars is None:
+        max_chars = config.INPUT_MAX_CHARS
+    if head_ratio is None:
+        head_ratio = config.INPUT_HEAD_RATIO
+    if max_chars <= 0:
+        return text
+    line, sep, payload = text.partition("\n")
+    # Bound the regex work on huge inputs before collapsing the filler
+    line = collapse_filler(head_tail(line, max_chars * 8, head_ratio))
+    line = head_tail(line, max_chars, head_ratio)
+    payload = collapse_filler(head_tail(payload, max_chars * 8, head_ratio))
+    budget = max(0, max_chars - len(line) - len(sep))
+    return line + sep + head_tail(payload, budget, head_ratio)
+
+
+def bucket_length(length: int, buckets: list = None) -> int:
+    """Return the smallest configured bucket that fits ``length``."""
+    if buckets is None:
+        buckets = config.LENGTH_BUCKETS
+    for bucket in buckets:
+        if length <= bucket:
+            return bucket
+    return length
@@ -0,0 +1,294 @@
+"""Fixed-size key/value table in shared memory.
+
+All proxy processes of a host map the same file (by default under
+``/dev/shm``) so the rate-limit buckets, the blocked IPs and the cached
+verdicts are shared instead of kept once per worker. The file holds a
+header followed by ``slots`` slots of ``slot_size`` bytes::
+
+    hash (u64) | expires (f64) | touched (f64) | key length (u16) |
+    value length (u32) | key (KEY_SIZE bytes) | value
+
+The slots are split into ``stripes`` contiguous groups, each guarded by an
+``fcntl`` lock on one byte of the header (between processes) and a thread
+lock (within a process). A key is hashed to one stripe and to a probe window
+of ``window`` slots inside it, so every operation takes a single lock and
+reads at most ``window`` slots. When the window is full the least recently
+touched slot is evicted, unless the table was opened with ``evict=False``.
+Times are wall-clock (``time.time``) since ``time.monotonic`` is not
+comparable between processes. A file left by another layout (other
+``slots``, ``slot_size`` or ``stripes``) is never reused or cleared: the
+table refuses to attach and its callers keep per-process state.
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"NUIASHM1"
+HEADER_SIZE = 4096
+KEY_SIZE = 64
+_HEADER = struct.Struct("<8sIII")
+_SLOT = struct.Struct("<QddHxxI")
+_VALUE_OFFSET = _SLOT.size + KEY_SIZE
+_LOCK_OFFSET = 64
+
+
+class LayoutMismatch(Exception):
+    """Raised when the file was created with another table layout."""
+
+
+def _hash(key: bytes) -> int:
+    # 0 marks an empty slot
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") | 1
+
+
+class SharedTable:
+    """Key/value table mapped from ``path`` and shared between processes.
+
+    Keys longer than ``KEY_SIZE`` UTF-8 bytes are stored as their SHA-256
+    digest; values are bytes of at most ``slot_size - 96``. A ``ttl`` of 0
+    keeps an entry until it is deleted or evicted. With ``evict=False`` a
+    full probe window makes :meth:`put` fail instead of dropping an entry.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        slots: int,
+        slot_size: int = 128,
+        stripes: int = None,
+        window: int = 8,
+        evict: bool = True,
+    ):
+        self.path = path
+        self.evict = evict
+        stripes = config.SHARED_LOCK_STRIPES if stripes is None else int(stripes)
+        self.stripes = max(1, min(stripes, HEADER_SIZE - _LOCK_OFFSET, int(slots)))
+        self.per_stripe = max(1, int(slots) // self.stripes)
+        self.slots = self.per_stripe * self.stripes
+        self.slot_size = max(int(slot_size), _VALUE_OFFSET + 8)
+        self.window = max(1, min(int(window), self.per_stripe))
+        self.max_value = self.slot_size - _VALUE_OFFSET
+        self.evictions = 0
+        self.full = 0
+        self._pid = None
+        self._locks = []
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = HEADER_SIZE + self.slots * self.slot_size
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, 0)
+        try:
+            expected = _HEADER.pack(MAGIC, self.slots, self.slot_size, self.stripes)
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, expected, 0)
+            header = os.pread(self._fd, _HEADER.size, 0)
+            matches = header == expected and os.fstat(self._fd).st_size == size
+            if matches:
+                self._map = mmap.mmap(self._fd, size)
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, 0)
+        if not matches:
+            # Processes still mapping the file would read garbage if it were
+            # reinitialized under them
+            os.close(self._fd)
+            raise LayoutMismatch(f"{path} foi criado com outro layout")
+
+    def _thread_lock(self, stripe: int) -> threading.Lock:
+        # ``fcntl`` locks belong to the process; threads of one process are
+        # serialized by these locks, recreated after ``fork``.
+        if self._pid != os.getpid():
+            self._locks = [threading.Lock() for _ in range(self.stripes)]
+            self._pid = os.getpid()
+        return self._locks[stripe]
+
+    def _locate(self, key: str):
+        data = key.encode("utf-8")
+        if len(data) > KEY_SIZE:
+            data = hashlib.sha256(data).hexdigest().encode()
+        h = _hash(data)
+        stripe = h % self.stripes
+        start = (h // self.stripes) % self.per_stripe
+        base = stripe * self.per_stripe
+        offsets = [
+            HEADER_SIZE + (base + (start + i) % self.per_stripe) * self.slot_size
+            for i in range(self.window)
+        ]
+        return data, h, stripe, offsets
+
+    @contextmanager
+    def _locked(self, stripe: int):
+        lock = self._thread_lock(stripe)
+        with lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, _LOCK_OFFSET + stripe)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, _LOCK_OFFSET + stripe)
+
+    def _find(self, data: bytes, h: int, offsets: list, now: float):
+        """Return the offset holding ``data`` or None; called with the lock held."""
+        for offset in offsets:
+            slot_hash, expires, _, klen, _ = _SLOT.unpack_from(self._map, offset)
+            if slot_hash != h:
+                continue
+            key_start = offset + _SLOT.size
+            if self._map[key_start:key_start + klen] != data:
+                continue
+            if expires and expires <= now:
+                return None
+            return offset
+        return None
+
+    def _read(self, offset: int) -> bytes:
+        _, _, _, _, vlen = _SLOT.unpack_from(self._map, offset)
+        start = offset + _VALUE_OFFSET
+        return bytes(self._map[start:start + vlen])
+
+    def _write(self, offsets, found, data, h, value, ttl, now) -> bool:
+        offset = found
+        if offset is None:
+            victim = None
+            for candidate in offsets:
+                slot_hash, expires, touched, _, _ = _SLOT.unpack_from(self._map, candidate)
+                if slot_hash == 0 or (expires and expires <= now):
+                    victim = (float("-inf"), candidate)
+                    break
+                if victim is None or touched < victim[0]:
+                    victim = (touched, candidate)
+            offset = victim[1]
+            if victim[0] != float("-inf"):
+                if not self.evict:
+                    self.full += 1
+                    return False
+                self.evictions += 1
+        _SLOT.pack_into(
+            self._map, offset, h, now + ttl if ttl > 0 else 0.0, now, len(data), len(value)
+        )
+        key_start = offset + _SLOT.size
+        self._map[key_start:key_start + len(data)] = data
+        self._map[offset + _VALUE_OFFSET:offset + _VALUE_OFFSET + len(value)] = value
+        return True
+
+    def get(self, key: str):
+        """Return the value stored for ``key`` or None."""
+        data, h, stripe, offsets = self._locate(key)
+        now = time.time()
+        with self._locked(stripe):
+            offset = self._find(data, h, offsets, now)
+            if offset is None:
+                return None
+            struct.pack_into("<d", self._map, offset + 16, now)
+            return self._read(offset)
+
+    def put(self, key: str, value: bytes, ttl: float = 0) -> bool:
+        """Store ``value``; return False if it does not fit in a slot.
+
+        Without eviction it also returns False when the probe window of the
+        key is full.
+        """
+        if len(value) > self.max_value:
+            return False
+        data, h, stripe, offsets = self._locate(key)
+        now = time.time()
+        with self._locked(stripe):
+            found = self._find(data, h, offsets, now)
+            return self._write(offsets, found, data, h, value, ttl, now)
+
+    def update(self, key: str, fn, ttl: float = 0) -> bytes:
+        """Replace the value of ``key`` by ``fn(old)`` atomically.
+
+        ``old`` is None when the key is absent. The new value is returned;
+        it is not stored if it does not fit in a slot (or, without eviction,
+        if the probe window is full).
+        """
+        data, h, stripe, offsets = self._locate(key)
+        now = time.time()
+        with self._locked(stripe):
+            found = self._find(data, h, offsets, now)
+            value = fn(None if found is None else self._read(found))
+            if len(value) <= self.max_value:
+                self._write(offsets, found, data, h, value, ttl, now)
+        return value
+
+    def delete(self, key: str, check=None) -> bool:
+        """Remove ``key``; with ``check``, only if ``check(value)`` is true."""
+        data, h, stripe, offsets = self._locate(key)
+        with self._locked(stripe):
+            offset = self._find(data, h, offsets, time.time())
+            if offset is None:
+                return False
+            if check is not None and not check(self._read(offset)):
+                return False
+            _SLOT.pack_into(self._map, offset, 0, 0.0, 0.0, 0, 0)
+        return True
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def keys(self) -> list:
+        """Return the live keys (one stripe locked at a time)."""
+        now = time.time()
+        result = []
+        for stripe in range(self.stripes):
+            with self._locked(stripe):
+                for i in range(self.per_stripe):
+                    offset = HEADER_SIZE + (stripe * self.per_stripe + i) * self.slot_size
+                    slot_hash, expires, _, klen, _ = _SLOT.unpack_from(self._map, offset)
+                    if slot_hash and not (expires and expires <= now):
+                        key_start = offset + _SLOT.size
+                        result.append(self._map[key_start:key_start + klen].decode("utf-8"))
+        return result
+
+    def clear(self) -> None:
+        for stripe in range(self.stripes):
+            with self._locked(stripe):
+                start = HEADER_SIZE + stripe * self.per_stripe * self.slot_size
+                self._map[start:start + self.per_stripe * self.slot_size] = bytes(
+                    self.per_stripe * self.slot_size
+                )
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "slots": self.slots,
+            "slot_size": self.slot_size,
+            "evictions": self.evictions,
+            "full": self.full,
+        }
+
+    def close(self) -> None:
+        self._map.close()
+        os.close(self._fd)
+
+
+def open_table(name: str, slots: int, slot_size: int = 128, evict: bool = True):
+    """Open the shared table ``name`` or return None if it is disabled.
+
+    Tables are only used with ``SHARED_STATE=true``; a table that cannot be
+    mapped is logged and the caller keeps its per-process state.
+    """
+    if not config.SHARED_STATE:
+        return None
+    path = f"{config.SHARED_STATE_PATH}-{name}"
+    try:
+        return SharedTable(path, slots, slot_size, evict=evict)
+    except LayoutMismatch as exc:
+        logger.error(
+            "Memoria compartilhada %s ignorada: %s; remova o arquivo quando "
+            "nenhum processo antigo estiver em execucao",
+            path,
+            exc,
+        )
+        return None
+    except OSError as exc:
+        logger.error("Erro ao abrir memoria compartilhada %s: %s", path, exc)
+        return None
@@ -0,0 +1,208 @@
+"""Latency objective for the request analysis with adaptive load shedding.
+
+Each analysis gets ``ANALYSIS_DEADLINE_MS`` to produce a verdict. The
+controller keeps moving averages of the analysis time and of every model
+stage, watches how many analyses are waiting for a slot and, before each
+request, picks the lowest degradation level whose estimated latency still
+fits in the deadline. Level ``n`` skips the first ``n`` stages of
+``SHED_ORDER``. When the deadline expires anyway, or more than
+``SLO_MAX_QUEUE`` analyses are already waiting for a slot,
+``SLO_FAIL_POLICY`` decides whether the request is let through (``open``) or
+refused (``closed``).
+"""
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+FAIL_OPEN = "open"
+FAIL_CLOSED = "closed"
+
+
+class DeadlineExceeded(Exception):
+    """Raised when an analysis does not finish within the deadline."""
+
+
+class Overloaded(DeadlineExceeded):
+    """Raised instead of queueing an analysis when the queue is full."""
+
+
+class SLOController:
+    """Run analyses under a deadline, shedding stages when running late."""
+
+    def __init__(
+        self,
+        deadline_ms: float = None,
+        shed_order: list = None,
+        concurrency: int = None,
+        fail_policy: str = None,
+        target_ratio: float = None,
+        alpha: float = 0.2,
+        max_queue: int = None,
+    ):
+        if deadline_ms is None:
+            deadline_ms = config.ANALYSIS_DEADLINE_MS
+        if shed_order is None:
+            shed_order = config.SHED_ORDER
+        if concurrency is None:
+            concurrency = config.SLO_CONCURRENCY
+        if fail_policy is None:
+            fail_policy = config.SLO_FAIL_POLICY
+        if target_ratio is None:
+            target_ratio = config.SLO_TARGET_RATIO
+        if max_queue is None:
+            max_queue = config.SLO_MAX_QUEUE
+        self.deadline_ms = max(0.0, float(deadline_ms))
+        self.shed_order = list(shed_order)
+        self.concurrency = max(1, int(concurrency))
+        self.fail_policy = FAIL_CLOSED if fail_policy == FAIL_CLOSED else FAIL_OPEN
+        self.target_ratio = float(target_ratio)
+        self.alpha = float(alpha)
+        self.max_queue = max(0, int(max_queue))
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self.inflight = 0
+        self.total_ms = None
+        self.stage_ms = {}
+        self.levels = Counter()
+        self.timeouts = 0
+        self.cancelled = 0
+        self.rejected = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.deadline_ms > 0
+
+    def _pool(self):
+        """Reserve a slot and return the executor, or None if the queue is full."""
+        # Created on first use so processes forked by ``app.main`` get their
+        # own threads instead of the (missing) ones of the parent.
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.concurrency, thread_name_prefix="analysis"
+                )
+                self._pid = os.getpid()
+                self.inflight = 0
+            if self.inflight >= self.concurrency + self.max_queue:
+                self.rejected += 1
+                return None
+            self.inflight += 1
+            return self._executor
+
+    def _waiting(self) -> int:
+        return max(0, self.inflight - self.concurrency)
+
+    def estimate(self, level: int) -> float:
+        """Return the expected latency (ms) of a new analysis at ``level``."""
+        if self.total_ms is None:
+            return 0.0
+        shed = set(self.shed_order[:level])
+        all_stages = sum(self.stage_ms.values())
+        kept = sum(ms for name, ms in self.stage_ms.items() if name not in shed)
+        cost = self.total_ms * (kept / all_stages if all_stages else 1.0)
+        return cost * (1 + self._waiting() / self.concurrency)
+
+    def plan(self):
+        """Return ``(level, skip)`` for the next analysis."""
+        if not self.enabled:
+            return 0, frozenset()
+        budget = self.deadline_ms * self.target_ratio
+        with self._lock:
+            level = len(self.shed_order)
+            for candidate in range(len(self.shed_order) + 1):
+                if self.estimate(candidate) <= budget:
+                    level = candidate
+                    break
+            self.levels[level] += 1
+        return level, frozenset(self.shed_order[:level])
+
+    def _ewma(self, previous, value: float) -> float:
+        if previous is None:
+            return value
+        return previous + self.alpha * (value - previous)
+
+    def _observe(self, result, elapsed_ms: float, skip: frozenset) -> None:
+        pipeline = result.get("pipeline") if isinstance(result, dict) else None
+        if isinstance(pipeline, dict) and pipeline.get("cached"):
+            return
+        timings = (pipeline or {}).get("timings") or {}
+        with self._lock:
+            # Shed stages did not run, so the time observed only covers the
+            # remaining ones; scale it back to the full pipeline.
+            all_stages = sum(self.stage_ms.values())
+            kept = sum(ms for name, ms in self.stage_ms.items() if name not in skip)
+            if skip and kept and all_stages:
+                elapsed_ms = elapsed_ms * all_stages / kept
+            self.total_ms = self._ewma(self.total_ms, elapsed_ms)
+            for name, ms in timings.items():
+                self.stage_ms[name] = self._ewma(self.stage_ms.get(name), float(ms))
+
+    def _call(self, fn, text: str, skip: frozenset):
+        start = time.perf_counter()
+        try:
+            result = fn(text, skip)
+        finally:
+            with self._lock:
+                self.inflight -= 1
+        self._observe(result, (time.perf_counter() - start) * 1000, skip)
+        return result
+
+    def run(self, fn, text: str, skip=frozenset()):
+        """Return ``fn(text, skip)`` or raise :class:`DeadlineExceeded`.
+
+        An analysis that already started keeps running after the deadline so
+        its timing still feeds the averages, but the caller stops waiting for
+        it; one still queued is cancelled so stale work does not delay the
+        next requests. :class:`Overloaded` is raised without queueing when
+        ``max_queue`` analyses are already waiting.
+        """
+        if not self.enabled:
+            return fn(text, skip)
+        pool = self._pool()
+        if pool is None:
+            logger.warning(
+                "Fila de analise cheia (politica: fail-%s)", self.fail_policy
+            )
+            raise Overloaded(self.deadline_ms)
+        future = pool.submit(self._call, fn, text, skip)
+        try:
+            return future.result(timeout=self.deadline_ms / 1000.0)
+        except FutureTimeout:
+            cancelled = future.cancel()
+            with self._lock:
+                self.timeouts += 1
+                if cancelled:
+                    # ``_call`` never runs to release the slot
+                    self.inflight -= 1
+                    self.cancelled += 1
+            logger.warning(
+                "Analise excedeu o prazo de %.0f ms (politica: fail-%s)",
+                self.deadline_ms,
+                self.fail_policy,
+            )
+            raise DeadlineExceeded(self.deadline_ms)
+
+    def stats(self) -> dict:
+        """Return the controller state exported by ``/api/metrics``."""
+        with self._lock:
+            return {
+                "deadline_ms": self.deadline_ms,
+                "fail_policy": self.fail_policy,
+                "inflight": self.inflight,
+                "waiting": self._waiting(),
+                "avg_ms": round(self.total_ms, 2) if self.total_ms is not None else None,
+                "stage_avg_ms": {k: round(v, 2) for k, v in self.stage_ms.items()},
+                "levels": {str(k): v for k, v in sorted(self.levels.items())},
+                "timeouts": self.timeouts,
+                "cancelled": self.cancelled,
+                "rejected": self.rejected,
+            }
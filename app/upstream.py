@@ -0,0 +1,476 @@
+"""Process-wide pooled HTTP clients used to forward requests to the backends.
+
+One ``httpx.Client`` per backend keeps connections alive between requests
+instead of opening a new connection (and event loop) per request. The
+number of concurrent requests to each backend is bounded by
+``UPSTREAM_MAX_CONNECTIONS``; the time spent waiting for a free connection
+is reported by :meth:`UpstreamClient.stats`.
+
+:class:`UpstreamPool` spreads requests over the backends of ``BACKEND_URLS``
+(least connections or EWMA latency), skips backends failing the active
+health check or whose circuit breaker is open, and retries idempotent
+requests on another backend within a retry budget.
+"""
+import os
+import threading
+import time
+import logging
+
+import httpx
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+
+def _h2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE", "TRACE"}
+# Responses meaning the backend itself is unavailable
+RETRY_STATUSES = {502, 503, 504}
+
+
+class NoUpstreamAvailable(Exception):
+    """Raised when every backend is unhealthy or has its breaker open."""
+
+
+class CircuitBreaker:
+    """Per-backend circuit breaker.
+
+    After ``failures`` consecutive failures the breaker opens and the backend
+    gets no traffic for ``reset`` seconds. Then a single probe request is let
+    through (half-open): its success closes the breaker, a failure opens it
+    again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    # Returned by :meth:`allow` to the caller that took the half-open probe
+    PROBE = "probe"
+
+    def __init__(self, failures: int = None, reset: float = None):
+        self.failures = max(1, config.CIRCUIT_FAILURES if failures is None else int(failures))
+        self.reset = config.CIRCUIT_RESET if reset is None else float(reset)
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self.consecutive = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self.trips = 0
+
+    def available(self) -> bool:
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset:
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self.state == self.HALF_OPEN:
+                return not self._probing
+            return self.state == self.CLOSED
+
+    def allow(self):
+        """Return whether a request may be sent, taking the half-open probe.
+
+        The result is False, True, or :attr:`PROBE` when this call took the
+        probe; only that caller may :meth:`release` it.
+        """
+        if not self.available():
+            return False
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    return False
+                self._probing = True
+                return self.PROBE
+            return True
+
+    def release(self) -> None:
+        """Give back the half-open probe taken by the caller.
+
+        A no-op once its outcome was recorded. Requests let through while
+        the breaker was closed must not call it: they would free the probe of
+        another request.
+        """
+        with self._lock:
+            self._probing = False
+
+    def record(self, ok: bool) -> None:
+        with self._lock:
+            if ok:
+                self.consecutive = 0
+                self.state = self.CLOSED
+                self._probing = False
+                return
+            self.consecutive += 1
+            if self.state == self.HALF_OPEN or self.consecutive >= self.failures:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._probing = False
+
+
+class RetryBudget:
+    """Allow retries for at most ``ratio`` of the requests.
+
+    Each request deposits ``ratio`` tokens (up to ``cap``) and each retry
+    withdraws one, so a failing backend cannot multiply the load.
+    """
+
+    def __init__(self, ratio: float = None, cap: float = 10.0):
+        self.ratio = config.RETRY_BUDGET if ratio is None else float(ratio)
+        self.cap = cap
+        self._lock = threading.Lock()
+        self.tokens = 0.0
+        self.retries = 0
+        self.exhausted = 0
+
+    def deposit(self) -> None:
+        with self._lock:
+            self.tokens = min(self.cap, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                self.retries += 1
+                return True
+            self.exhausted += 1
+            return False
+
+
+class StreamedResponse:
+    """Iterable over the raw (still encoded) body of an upstream response.
+
+    It can be given directly to a WSGI response: the server calls
+    :meth:`close` when done, which returns the connection to the pool.
+    """
+
+    def __init__(self, response: httpx.Response, on_close, chunk_size: int = None):
+        self.response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.chunk_size = config.STREAM_CHUNK_SIZE if chunk_size is None else chunk_size
+        self._on_close = on_close
+
+    def __iter__(self):
+        return self.response.iter_raw(self.chunk_size)
+
+    def read(self) -> bytes:
+        try:
+            return b"".join(self)
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            self.response.close()
+            on_close()
+
+
+class UpstreamClient:
+    """Thread-safe pooled client for one backend base URL."""
+
+    def __init__(
+        self,
+        base_url: str = None,
+        max_connections: int = None,
+        max_keepalive: int = None,
+        keepalive_expiry: float = None,
+        http2: bool = None,
+        timeout: float = None,
+    ):
+        self.base_url = (base_url or config.BACKEND_URL).rstrip("/")
+        self.max_connections = max(
+            1, config.UPSTREAM_MAX_CONNECTIONS if max_connections is None else int(max_connections)
+        )
+        self.max_keepalive = (
+            config.UPSTREAM_MAX_KEEPALIVE if max_keepalive is None else int(max_keepalive)
+        )
+        self.keepalive_expiry = (
+            config.UPSTREAM_KEEPALIVE_EXPIRY if keepalive_expiry is None else float(keepalive_expiry)
+        )
+        self.timeout = config.UPSTREAM_TIMEOUT if timeout is None else float(timeout)
+        http2 = config.UPSTREAM_HTTP2 if http2 is None else http2
+        if http2 and not _h2_available():
+            logger.warning("Pacote h2 ausente; usando HTTP/1.1 para o backend")
+            http2 = False
+        self.http2 = bool(http2)
+        self._lock = threading.Lock()
+        self._client = None
+        self._slots = None
+        self._pid = None
+        self.in_use = 0
+        self.requests = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.latency_ms = None
+        self.healthy = True
+        self.breaker = CircuitBreaker()
+
+    def _ensure(self):
+        # Sockets must not be shared with processes forked after the first
+        # request; each process opens its own pool.
+        if self._pid == os.getpid():
+            return self._client, self._slots
+        with self._lock:
+            if self._pid != os.getpid():
+                self._client = httpx.Client(
+                    http2=self.http2,
+                    limits=httpx.Limits(
+                        max_connections=self.max_connections,
+                        max_keepalive_connections=self.max_keepalive,
+                        keepalive_expiry=self.keepalive_expiry,
+                    ),
+                    timeout=httpx.Timeout(self.timeout, pool=None),
+                    follow_redirects=False,
+                )
+                self._slots = threading.BoundedSemaphore(self.max_connections)
+                self.in_use = 0
+                self._pid = os.getpid()
+            return self._client, self._slots
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}/{path}" if path else self.base_url
+
+    def begin(self, waited: float = 0.0) -> None:
+        """Count a request sent to this backend (also used by ``app.asgi``)."""
+        with self._lock:
+            self.in_use += 1
+            self.requests += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+    def end(self) -> None:
+        with self._lock:
+            self.in_use -= 1
+
+    def observe(self, ok: bool, latency_ms: float = None, alpha: float = 0.3) -> None:
+        """Record the outcome of a request for the balancer and the breaker."""
+        with self._lock:
+            if ok and latency_ms is not None:
+                if self.latency_ms is None:
+                    self.latency_ms = latency_ms
+                else:
+                    self.latency_ms += alpha * (latency_ms - self.latency_ms)
+        self.breaker.record(ok)
+
+    def _acquire(self):
+        client, slots = self._ensure()
+        start = time.perf_counter()
+        slots.acquire()
+        self.begin(time.perf_counter() - start)
+        return client, slots
+
+    def _release(self, slots) -> None:
+        self.end()
+        slots.release()
+
+    def count_error(self) -> None:
+        with self._lock:
+            self.errors += 1
+
+    def request(self, method: str, path: str, headers=None, params=None, content=None) -> httpx.Response:
+        """Send a request and return the response with its body read."""
+        client, slots = self._acquire()
+        try:
+            return client.request(
+                method, self.url(path), headers=headers, params=params, content=content
+            )
+        except httpx.HTTPError:
+            self.count_error()
+            raise
+        finally:
+            self._release(slots)
+
+    def stream(self, method: str, path: str, headers=None, params=None, content=None):
+        """Send a request and return a :class:`StreamedResponse`.
+
+        ``content`` may be an iterator of bytes, sent as it is consumed. The
+        connection stays in use until the returned response is closed.
+        """
+        client, slots = self._acquire()
+        try:
+            request = client.build_request(
+                method, self.url(path), headers=headers, params=params, content=content
+            )
+            response = client.send(request, stream=True)
+        except Exception as exc:
+            if isinstance(exc, httpx.HTTPError):
+                self.count_error()
+            self._release(slots)
+            raise
+        return StreamedResponse(response, lambda: self._release(slots))
+
+    def close(self) -> None:
+        with self._lock:
+            if self._client is not None and self._pid == os.getpid():
+                self._client.close()
+            self._client = None
+            self._pid = None
+
+    def stats(self) -> dict:
+        """Return pool usage and the time requests waited for a connection."""
+        with self._lock:
+            return {
+                "base_url": self.base_url,
+                "http2": self.http2,
+                "max_connections": self.max_connections,
+                "in_use": self.in_use,
+                "requests": self.requests,
+                "errors": self.errors,
+                "avg_wait_ms": (
+                    round(self.wait_total * 1000 / self.requests, 3) if self.requests else 0.0
+                ),
+                "max_wait_ms": round(self.wait_max * 1000, 3),
+                "latency_ms": round(self.latency_ms, 2) if self.latency_ms is not None else None,
+                "healthy": self.healthy,
+                "breaker": self.breaker.state,
+            }
+
+
+class UpstreamPool:
+    """Balance requests over several :class:`UpstreamClient` backends."""
+
+    def __init__(
+        self,
+        urls: list = None,
+        balancer: str = None,
+        retries: int = None,
+        health_interval: float = None,
+        health_path: str = None,
+    ):
+        urls = urls or config.BACKEND_URLS
+        self.members = [UpstreamClient(url) for url in urls]
+        self.balancer = config.UPSTREAM_BALANCER if balancer is None else balancer
+        self.retries = config.RETRY_ATTEMPTS if retries is None else int(retries)
+        self.health_interval = (
+            config.HEALTH_CHECK_INTERVAL if health_interval is None else float(health_interval)
+        )
+        self.health_path = config.HEALTH_CHECK_PATH if health_path is None else health_path
+        self.budget = RetryBudget()
+        self._lock = threading.Lock()
+        self._health_pid = None
+
+    def _score(self, member: UpstreamClient):
+        if self.balancer == "ewma":
+            # Unknown latency counts as fast so new backends get traffic
+            return ((member.latency_ms or 0.0) * (member.in_use + 1), member.in_use)
+        return (member.in_use, member.latency_ms or 0.0)
+
+    def select(self, exclude=()):
+        """Return ``(member, probe)``: the best available backend not in
+        ``exclude`` and whether the request took its half-open probe.
+        """
+        self._ensure_health_checks()
+        candidates = [
+            m
+            for m in self.members
+            if m not in exclude and m.healthy and m.breaker.available()
+        ]
+        for member in sorted(candidates, key=self._score):
+            allowed = member.breaker.allow()
+            if allowed:
+                return member, allowed == CircuitBreaker.PROBE
+        raise NoUpstreamAvailable("nenhum backend disponivel")
+
+    def can_retry(self, method: str, content) -> bool:
+        """Idempotent requests with a buffered body may go to another backend."""
+        return (
+            self.retries > 0
+            and len(self.members) > 1
+            and method.upper() in IDEMPOTENT_METHODS
+            and (content is None or isinstance(content, (bytes, str)))
+        )
+
+    def stream(self, method: str, path: str, headers=None, params=None, content=None):
+        """Send a request to the selected backend, retrying if allowed."""
+        self.budget.deposit()
+        retryable = self.can_retry(method, content)
+        tried = []
+        while True:
+            member, probe = self.select(tried)
+            tried.append(member)
+            start = time.perf_counter()
+            try:
+                try:
+                    response = member.stream(
+                        method, path, headers=headers, params=params, content=content
+                    )
+                except httpx.TransportError:
+                    member.observe(False)
+                    if self.should_retry(retryable, tried):
+                        continue
+                    raise
+                failed = response.status_code in RETRY_STATUSES
+                if failed:
+                    member.count_error()
+                member.observe(not failed, (time.perf_counter() - start) * 1000)
+            finally:
+                # Any other exception records no outcome; the breaker must not
+                # stay half-open waiting for this probe
+                if probe:
+                    member.breaker.release()
+            if failed and self.should_retry(retryable, tried):
+                response.close()
+                continue
+            return response
+
+    def should_retry(self, retryable: bool, tried: list) -> bool:
+        """Return True if a failed attempt may go to another backend."""
+        return (
+            retryable
+            and len(tried) <= self.retries
+            and len(tried) < len(self.members)
+            and self.budget.withdraw()
+        )
+
+    def _ensure_health_checks(self) -> None:
+        if self.health_interval <= 0 or self._health_pid == os.getpid():
+            return
+        with self._lock:
+            if self._health_pid != os.getpid():
+                self._health_pid = os.getpid()
+                threading.Thread(
+                    target=self._health_loop, name="upstream-health", daemon=True
+                ).start()
+
+    def check_health(self) -> None:
+        """Run one active health check against every backend."""
+        for member in self.members:
+            try:
+                response = member.request("GET", self.health_path.lstrip("/"))
+                healthy = response.status_code < 500
+            except httpx.HTTPError:
+                healthy = False
+            if healthy != member.healthy:
+                logger.warning(
+                    "Backend %s %s", member.base_url, "recuperado" if healthy else "indisponivel"
+                )
+            member.healthy = healthy
+
+    def _health_loop(self) -> None:
+        pid = os.getpid()
+        while self._health_pid == pid:
+            time.sleep(self.health_interval)
+            self.check_health()
+
+    def close(self) -> None:
+        for member in self.members:
+            member.close()
+
+    def stats(self) -> dict:
+        return {
+            "balancer": self.balancer,
+            "retries": self.budget.retries,
+            "retry_budget_exhausted": self.budget.exhausted,
+            "backends": [member.stats() for member in self.members],
+        }
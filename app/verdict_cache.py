@@ -0,0 +1,235 @@
+import copy
+import hashlib
+import re
+import threading
+import time
+import logging
+from collections import OrderedDict
+
+from . import config
+
+logger = logging.getLogger(__name__)
+
+# Masks applied in order; the more specific patterns must run before the
+# generic number pattern so their digits are not replaced first.
+_MASKS = [
+    (
+        re.compile(
+            r"\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b"
+        ),
+        "<uuid>",
+    ),
+    (
+        re.compile(
+            r"\b\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?)?\b"
+        ),
+        "<ts>",
+    ),
+    # Only values that look like opaque tokens are masked: a value carrying
+    # anything else (quotes, brackets, spaces...) stays in the key, so an
+    # attack never shares the key of a benign value.
+    (
+        re.compile(
+            r"(?i)(?<![\w-])((?:php|j|asp\.net_)?sess(?:ion)?(?:_?id)?|sid|"
+            r"(?:access_|auth_?)?token|csrf(?:_?token)?|xsrf(?:_?token)?|auth)="
+            r"[A-Za-z0-9_\-]{16,}={0,2}(?=[&\s;]|$)"
+        ),
+        r"\1=<token>",
+    ),
+    (re.compile(r"\b[0-9a-fA-F]{16,}\b"), "<hex>"),
+    (re.compile(r"\b[A-Za-z0-9_\-]{32,}\b"), "<token>"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "<n>"),
+]
+
+
+def normalize_request(text: str) -> str:
+    """Return ``text`` with volatile values masked to build the cache key."""
+    for pattern, repl in _MASKS:
+        text = pattern.sub(repl, text)
+    return text
+
+
+def model_fingerprint() -> tuple:
+    """Return the configuration values that influence a verdict."""
+    return (
+        config.SEMANTIC_MODEL,
+        config.SEVERITY_MODEL,
+        config.ANOMALY_MODEL,
+        tuple(config.NIDS_MODELS),
+        config.NIDS_MODEL,
+        config.NIDS_BASE_MODEL,
+        config.SEMANTIC_THRESHOLD,
+        config.ENSEMBLE_W_ROBERTA,
+        config.ENSEMBLE_W_ATTACK,
+        config.ENSEMBLE_THRESHOLD,
+        config.ENSEMBLE_OVERRIDE_ANOMALY,
+        config.CASCADE_MODE,
+        config.CASCADE_LOW,
+        config.DEVICE,
+        config.INPUT_MAX_CHARS,
+        config.INPUT_HEAD_RATIO,
+        tuple(sorted(config.INFERENCE_BACKENDS.items())),
+    )
+
+
+def _mark_cached(result: dict) -> dict:
+    if isinstance(result.get("pipeline"), dict):
+        result["pipeline"]["cached"] = True
+    return result
+
+
+class _InFlight:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class VerdictCache:
+    """Bounded LRU+TTL cache of detector verdicts keyed by normalized text.
+
+    Concurrent requests with the same key wait for a single analysis instead
+    of running the models again. Entries are dropped whenever
+    :func:`model_fingerprint` changes. With a ``shared`` table the verdicts
+    are also stored in shared memory and found by the other workers.
+    """
+
+    def __init__(self, detector, maxsize: int = None, ttl: float = None, shared=None):
+        self.detector = detector
+        self.shared = shared
+        self.maxsize = config.VERDICT_CACHE_SIZE if maxsize is None else int(maxsize)
+        self.ttl = config.VERDICT_CACHE_TTL if ttl is None else float(ttl)
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._fingerprint = model_fingerprint()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.shared_hits = 0
+
+    def _shared_key(self, key: str) -> str:
+        # The fingerprint is part of the key: another configuration never
+        # reads these entries
+        return hashlib.sha1(f"{self._fingerprint!r}\n{key}".encode()).hexdigest()
+
+    def _shared_get(self, key: str):
+        if self.shared is None:
+            return None
+        from .inference_server import decode_results
+
+        value = self.shared.get(self._shared_key(key))
+        if value is None:
+            return None
+        self.shared_hits += 1
+        return decode_results(value)[0]
+
+    def _shared_put(self, key: str, result: dict) -> None:
+        if self.shared is not None:
+            from .inference_server import encode_results
+
+            self.shared.put(self._shared_key(key), encode_results([result]), self.ttl)
+
+    def _check_fingerprint(self) -> None:
+        current = model_fingerprint()
+        if current != self._fingerprint:
+            self._fingerprint = current
+            self._entries.clear()
+            self.invalidations += 1
+            logger.info("Configuracao de modelos alterada; cache de vereditos limpo")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def analyze(self, text: str, skip=frozenset()) -> dict:
+        if skip:
+            # Degraded verdicts are neither served from nor stored in the
+            # cache; a full verdict already cached is still the better answer.
+            return self._analyze_degraded(text, frozenset(skip))
+        key = normalize_request(text)
+        now = time.monotonic()
+        with self._lock:
+            self._check_fingerprint()
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, result = entry
+                if expires > now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return _mark_cached(copy.deepcopy(result))
+                del self._entries[key]
+            result = self._shared_get(key)
+            if result is not None:
+                self.hits += 1
+                return _mark_cached(result)
+            inflight = self._inflight.get(key)
+            owner = inflight is None
+            if owner:
+                inflight = self._inflight[key] = _InFlight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            inflight.event.wait()
+            if inflight.error is not None:
+                raise inflight.error
+            return _mark_cached(copy.deepcopy(inflight.result))
+
+        fingerprint = self._fingerprint
+        try:
+            result = self.detector.analyze(text)
+            inflight.result = copy.deepcopy(result)
+        except Exception as exc:
+            inflight.error = exc
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+                if inflight.error is None and fingerprint == self._fingerprint:
+                    self._entries[key] = (now + self.ttl, inflight.result)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.maxsize:
+                        self._entries.popitem(last=False)
+                        self.evictions += 1
+                    self._shared_put(key, inflight.result)
+            inflight.event.set()
+        return result
+
+    def _analyze_degraded(self, text: str, skip: frozenset) -> dict:
+        key = normalize_request(text)
+        now = time.monotonic()
+        with self._lock:
+            self._check_fingerprint()
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return _mark_cached(copy.deepcopy(entry[1]))
+            result = self._shared_get(key)
+            if result is not None:
+                self.hits += 1
+                return _mark_cached(result)
+            self.misses += 1
+        return self.detector.analyze(text, skip=skip)
+
+    def analyze_batch(self, texts: list, skip=frozenset()) -> list:
+        return [self.analyze(text, skip) for text in texts]
+
+    def stats(self) -> dict:
+        """Return hit/miss/eviction counters of the cache."""
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "shared_hits": self.shared_hits,
+        }
@@ -4,13 +4,11 @@ from flask import (
     jsonify,
     request,
     Response,
+    g,
     stream_with_context,
 )
-import httpx
-import asyncio
 import json
 import time
-from collections import defaultdict, deque
 import logging
 
 from .logging_setup import configure_logging
@@ -19,12 +17,45 @@ configure_logging()
 logger = logging.getLogger(__name__)
 
 from . import db, firewall, config, events, es
-from .detection import Detector
-from . import detection
+from .shaping import shape_input
+from .batching import BatchScheduler
+from .verdict_cache import VerdictCache
+from .inference_server import RemoteDetector
+from .slo import FAIL_CLOSED, DeadlineExceeded, Overloaded, SLOController
+from .background import AnalysisQueue, Speculation
+from .upstream import NoUpstreamAvailable, UpstreamPool
+from .response_cache import CachedResponse, ResponseCache
+from .blocklist import blocklist
+from .ratelimit import IP, RateLimiter
+from .shm import open_table
+from .intensity import calculate_intensity
 
 BACKEND_URL = config.BACKEND_URL
-
-detector = Detector()
+# Keep-alive connection pools to the backends shared by every request of
+# this process
+upstream = UpstreamPool(config.BACKEND_URLS)
+
+scheduler = None
+if config.INFERENCE_SOCKET:
+    # Models live in the inference daemon (``python -m app.inference_server``)
+    detector = RemoteDetector(config.INFERENCE_SOCKET)
+else:
+    # Only imported here: it loads torch, transformers and tensorflow, which
+    # workers served by the inference daemon never need
+    from .detection import Detector
+
+    detector = Detector()
+    if config.BATCH_INFERENCE:
+        scheduler = detector = BatchScheduler(detector)
+verdict_cache = None
+if config.VERDICT_CACHE_SIZE > 0:
+    verdict_cache = detector = VerdictCache(
+        detector,
+        shared=open_table(
+            "verdicts", config.SHARED_VERDICT_SLOTS, config.SHARED_VERDICT_SLOT_SIZE
+        ),
+    )
+slo = SLOController()
 
 app = Flask(__name__)
 
@@ -33,21 +64,46 @@ app = Flask(__name__)
 SKIP_NON_ANOMALY_PATHS: set[str] = set()
 
 db.init_db()
-
-
-def _sync_initial_blocked() -> None:
-    """Ensure database reflects current UFW state on startup."""
-    firewall.sync_blocked_ips_with_ufw()
-
-
-# ``before_first_request`` was removed in Flask 3.x. Call the function once
-# during startup instead of registering it as a hook.
-_sync_initial_blocked()
-
-# Streaming listeners and DoS tracking
-REQUEST_COUNTS = defaultdict(deque)
-REQUEST_WINDOW = 10  # seconds
-DOS_THRESHOLD = 20
+blocklist.load()
+
+# The firewall rules are compared with ``blocked_ips`` by a background
+# thread; the panel only reads the reconciled table.
+firewall.start_reconciler()
+
+# Requests on detect-only routes are analyzed by this queue after being
+# forwarded (see ``ASYNC_ANALYSIS_PREFIXES``/``ASYNC_ANALYSIS_METHODS``).
+analysis_queue = AnalysisQueue(lambda *args: evaluate_request(*args))
+
+# Request bodies are streamed: the analysis reads the first bytes before
+# forwarding and the last ones before the end of the body is sent
+BODY_PREFIX_KEY = "nginx_unit_ia.body_prefix"
+HOP_BY_HOP = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+}
+
+# Responses to benign GET requests (``RESPONSE_CACHE_BYTES=0`` disables it)
+response_cache = None
+if config.RESPONSE_CACHE_BYTES > 0:
+    response_cache = ResponseCache(excluded=HOP_BY_HOP)
+
+# Safe requests forwarded while their analysis runs (``SPECULATIVE_PREFIXES``)
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+speculation = Speculation()
+
+# Request floods are cut off before the analysis (``RATE_LIMIT_*``); the
+# ipinfo lookup and the OpenSearch document of a flood block are done by
+# ``flood_queue`` off the request thread.
+rate_limiter = RateLimiter(
+    shared=open_table("ratelimit", config.SHARED_RATE_LIMIT_SLOTS)
+)
+flood_queue = AnalysisQueue(lambda *args: _index_flood_block(*args), workers=1)
 
 
 def _is_attack(label: str) -> bool:
@@ -63,38 +119,309 @@ def _analyze():
         or request.path.startswith("/stream/")
     ):
         return
-    result = analyze_request()
+    if blocklist.check(request.remote_addr):
+        # Already blocked: no ipinfo lookup, model run or log entry
+        return Response("Bloqueado", status=403)
+    limited = rate_limiter.check(request.remote_addr, request.path)
+    if limited:
+        status = flood_status(request.remote_addr, limited)
+        if status == 403:
+            return Response("Bloqueado", status=403)
+        if status == 429:
+            return Response("Muitas requisições", status=429)
+    if _is_async_route(request.method, request.path):
+        # Detect-only: forward at once and analyze after the fact; an
+        # offender is cut off by the firewall on its following requests.
+        # A body over the analysis limit is analyzed once, head and tail,
+        # after it was streamed.
+        if len(_body_prefix()) >= config.ANALYSIS_BODY_LIMIT:
+            return
+        analysis_queue.submit(
+            request.method,
+            request.path,
+            request.full_path,
+            _body_text(),
+            request.remote_addr,
+            True,
+        )
+        return
+    pending = _speculate()
+    try:
+        result = analyze_request()
+    except BaseException:
+        # Never leave the upstream response (and its connection) behind
+        if pending is not None:
+            speculation.discard(pending)
+        raise
     if isinstance(result, dict) and result.get("blocked"):
+        if pending is not None:
+            speculation.discard(pending)
         return Response("Bloqueado", status=403)
+    # Compared with the verdict on the end of a long body
+    g.analysis = result
+    if pending is not None:
+        # Allowed: release the upstream response instead of calling the view
+        return speculation.release(pending)
+    # Only responses to requests judged benign go into the response cache
+    g.verdict_benign = isinstance(result, dict) and result.get("is_attack") is False
+
+
+def flood_status(ip: str, limited: str):
+    """Return 403, 429 or None (go on) for a request over a rate limit.
+
+    ``limited`` is the scope reported by :meth:`RateLimiter.check`. A client
+    over its own limit is blocked as ``dos`` (whitelisted clients are let
+    through); the subnet and path limits only refuse the request.
+    """
+    if limited == IP:
+        if block_flood(ip):
+            return 403
+        return None if firewall.is_whitelisted(ip) else 429
+    return 429
+
+
+def block_flood(ip: str) -> bool:
+    """Block ``ip`` for exceeding its request rate; return True if blocked.
+
+    The block is recorded at once without ``ip_info``; :data:`flood_queue`
+    looks it up, stores it and indexes the block afterwards.
+    """
+    if not firewall.schedule_block(ip):
+        return False
+    logger.warning("IP %s blocked due to DoS detection", ip)
+    blocked_at = time.strftime("%Y-%m-%d %H:%M:%S")
+    db.save_blocked_ip(ip, "dos")
+    events.notify_blocked(
+        {
+            "ip": ip,
+            "reason": "dos",
+            "status": "blocked",
+            "blocked_at": blocked_at,
+            "ip_info": None,
+        }
+    )
+    flood_queue.submit(ip, blocked_at)
+    return True
 
 
-def analyze_request() -> dict:
-    """Analyze the current HTTP request using the ML models."""
-    payload = request.get_data(as_text=True) or ""
-    full_text = f"{request.method} {request.full_path}\n{payload}"
-    ip = request.remote_addr
-    logger.info("Analyzing request from %s", ip or "unknown")
-    ip_info = None
-    if ip:
-        from .ipinfo import fetch_ip_info
+def _index_flood_block(ip: str, blocked_at: str) -> None:
+    from .ipinfo import fetch_ip_info
 
-        ip_info = fetch_ip_info(ip)
-    result = detector.analyze(full_text)
+    ip_info = fetch_ip_info(ip)
+    db.set_blocked_ip_info(ip, ip_info)
+    es.index_blocked_ip(
+        {
+            "ip": ip,
+            "reason": "dos",
+            "status": "blocked",
+            "blocked_at": blocked_at,
+            "ip_info": ip_info,
+        }
+    )
+
+
+def _speculate():
+    """Start the upstream call of a safe request before its verdict.
+
+    Only GET/HEAD/OPTIONS requests without a body that would reach
+    ``catch_all`` on a path listed in ``SPECULATIVE_PREFIXES`` are forwarded
+    early; the response is held until the analysis finishes.
+    """
+    if (
+        request.method not in SAFE_METHODS
+        or request.endpoint != "catch_all"
+        or _has_body()
+        or not any(request.path.startswith(p) for p in config.SPECULATIVE_PREFIXES)
+    ):
+        return None
+    args = _upstream_args(request.view_args.get("path", ""), stream=False)
+    return speculation.start(lambda: _forward_request(*args))
+
+
+def _is_async_route(method: str, path: str) -> bool:
+    """Return True if requests to ``path`` are analyzed in the background."""
+    return method.upper() in config.ASYNC_ANALYSIS_METHODS or any(
+        path.startswith(prefix) for prefix in config.ASYNC_ANALYSIS_PREFIXES
+    )
+
+
+def _run_analysis(text: str, skip: frozenset) -> dict:
+    if skip:
+        return detector.analyze(text, skip=skip)
+    return detector.analyze(text)
+
+
+def _log_timeout(full_text: str, ip: str, ip_info, reason: str = "timeout"):
+    """Record a request whose analysis missed the deadline; return the log id.
+
+    No stage produced a verdict, so every result is ``skipped`` (with zero
+    anomaly probabilities, as the panel derives the intensity from them);
+    the ``pipeline`` field tells why (``timeout`` or ``overload``) and which
+    fail policy was applied.
+    """
+    skipped = {"label": "skipped", "score": []}
+    anomaly = {"label": "skipped", "score": [0.0, 0.0]}
+    pipeline = {"degraded": reason, "fail_policy": slo.fail_policy}
+    saved = db.save_log(
+        "unit",
+        full_text,
+        skipped,
+        anomaly,
+        skipped,
+        {},
+        ip=ip,
+        ip_info=ip_info,
+        is_attack=False,
+        pipeline=pipeline,
+    )
+    if saved is None:
+        return None
+    log_id, created_at = saved
+    if hasattr(created_at, "strftime"):
+        created_at = created_at.strftime("%Y-%m-%d %H:%M:%S")
+    entry = {
+        "id": log_id,
+        "created_at": str(created_at),
+        "iface": "unit",
+        "log": full_text,
+        "ip": ip,
+        "ip_info": ip_info,
+        "severity": skipped,
+        "anomaly": anomaly,
+        "nids": skipped,
+        "category": "skipped",
+        "is_attack": False,
+        "semantic": {},
+        "intensity": 0.0,
+        "pipeline": pipeline,
+    }
+    events.notify_log(entry)
+    es.index_log(entry)
+    return log_id
+
+
+def _judge(result: dict) -> bool:
+    """Set and return ``result["is_attack"]`` from the model outputs.
+
+    An attack the anomaly model missed is marked as an anomaly with the
+    ensemble score, and its intensity recomputed.
+    """
     category = result["nids"].get("majority", result["nids"]["label"])
     ensemble_label = str(result.get("ensemble", {}).get("label", "normal")).lower()
     is_attack_ensemble = ensemble_label != "normal"
     sev_label = str(result["severity"]["label"]).lower()
     is_attack = (is_attack_ensemble or _is_attack(category)) and sev_label != "error"
+    result["is_attack"] = is_attack
 
     if is_attack and str(result["anomaly"]["label"]).lower() in ("normal", "none"):
         score = result.get("ensemble", {}).get("score", 1.0)
         result["anomaly"]["label"] = "anomaly"
         result["anomaly"]["score"] = [1 - score, score]
-        result["intensity"] = detection.calculate_intensity(
+        result["intensity"] = calculate_intensity(
             result["severity"]["label"],
             result["anomaly"]["score"],
             result.get("semantic", {}).get("similarity", 1.0),
         )
+    return is_attack
+
+
+def _should_block(result: dict) -> bool:
+    sev = str(result["severity"]["label"]).lower()
+    anom = str(result["anomaly"]["label"]).lower()
+    anom_score = max(result["anomaly"]["score"]) if result["anomaly"]["score"] else 0.0
+    sem_outlier = bool(result.get("semantic", {}).get("outlier"))
+    block_by_sev = sev in config.BLOCK_SEVERITY_LEVELS
+    block_by_anom = (
+        anom not in ("normal", "none")
+        and sem_outlier
+        and anom_score >= config.BLOCK_ANOMALY_THRESHOLD
+    )
+    return block_by_sev or block_by_anom
+
+
+def _block(ip: str, result: dict, ip_info) -> bool:
+    """Block ``ip`` for the verdict ``result``; return True if it was blocked."""
+    if not firewall.schedule_block(ip):
+        return False
+    reason = f"{result['anomaly']['label']} / {result['severity']['label']}"
+    logger.warning("IP %s blocked: %s", ip, reason)
+    db.save_blocked_ip(ip, reason, ip_info=ip_info)
+    events.notify_blocked(
+        {
+            "ip": ip,
+            "reason": reason,
+            "status": "blocked",
+            "blocked_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "ip_info": ip_info,
+        }
+    )
+    es.index_blocked_ip(
+        {
+            "ip": ip,
+            "reason": reason,
+            "status": "blocked",
+            "blocked_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "ip_info": ip_info,
+        }
+    )
+    return True
+
+
+def analyze_request() -> dict:
+    """Analyze the current HTTP request using the ML models."""
+    return evaluate_request(
+        request.method,
+        request.path,
+        request.full_path,
+        _body_text(),
+        request.remote_addr,
+    )
+
+
+def evaluate_request(
+    method: str, path: str, full_path: str, payload: str, ip: str, background: bool = False
+) -> dict:
+    """Analyze a request, store its log and block the client if needed.
+
+    It does not depend on the Flask request context so the background
+    analysis queue can call it after the request was forwarded. In that case
+    the latency objective does not apply and the ``blocked`` flag of the
+    result only reflects the firewall action. The result also carries the
+    ``log_id`` and ``ip_info`` reused by :func:`recheck_body`.
+    """
+    full_text = f"{method} {full_path}\n{payload}"
+    logger.info("Analyzing request from %s", ip or "unknown")
+    ip_info = None
+    if ip:
+        from .ipinfo import fetch_ip_info
+
+        ip_info = fetch_ip_info(ip)
+    # The full text is logged, but the models (and the verdict cache key or
+    # the inference daemon payload) only get the bounded version.
+    if background:
+        result = _run_analysis(shape_input(full_text), frozenset())
+        if isinstance(result.get("pipeline"), dict):
+            result["pipeline"]["async"] = True
+    else:
+        level, skip = slo.plan()
+        try:
+            result = slo.run(_run_analysis, shape_input(full_text), skip)
+        except DeadlineExceeded as exc:
+            reason = "overload" if isinstance(exc, Overloaded) else "timeout"
+            log_id = _log_timeout(full_text, ip, ip_info, reason)
+            blocked = slo.fail_policy == FAIL_CLOSED
+            if blocked:
+                logger.warning("Requisicao de %s recusada: analise fora do prazo", ip or "unknown")
+            else:
+                logger.warning(
+                    "Requisicao de %s liberada sem analise (prazo excedido)", ip or "unknown"
+                )
+            return {"blocked": blocked, "degraded": "timeout", "log_id": log_id, "ip_info": ip_info}
+        if slo.enabled and isinstance(result.get("pipeline"), dict):
+            result["pipeline"]["degraded"] = level
+            result["pipeline"]["shed"] = sorted(skip)
+    is_attack = _judge(result)
+    category = result["nids"].get("majority", result["nids"]["label"])
     logger.info(
         "Detection result - severity: %s, anomaly: %s, nids: %s",
         result["severity"]["label"],
@@ -104,8 +431,8 @@ def analyze_request() -> dict:
 
     # Skip storing noisy paths unless an anomaly was detected
     if (
-        request.method == "GET"
-        and request.path in SKIP_NON_ANOMALY_PATHS
+        method == "GET"
+        and path in SKIP_NON_ANOMALY_PATHS
         and str(result["anomaly"]["label"]).lower() in ("normal", "none")
     ):
         saved = None
@@ -120,15 +447,19 @@ def analyze_request() -> dict:
             ip=ip,
             ip_info=ip_info,
             is_attack=is_attack,
+            pipeline=result.get("pipeline"),
         )
     created_at = time.strftime("%Y-%m-%d %H:%M:%S")
     log_id = None
+    result["log_id"] = None
+    result["ip_info"] = ip_info
     if saved is not None:
         log_id, created_at_dt = saved
         if hasattr(created_at_dt, "strftime"):
             created_at = created_at_dt.strftime("%Y-%m-%d %H:%M:%S")
         else:
             created_at = str(created_at_dt)
+        result["log_id"] = log_id
         events.notify_log(
             {
                 "id": log_id,
@@ -145,6 +476,7 @@ def analyze_request() -> dict:
                 "semantic": result["semantic"],
                 "ensemble": result.get("ensemble"),
                 "intensity": result["intensity"],
+                "pipeline": result.get("pipeline"),
             }
         )
         es.index_log(
@@ -163,73 +495,63 @@ def analyze_request() -> dict:
                 "semantic": result["semantic"],
                 "ensemble": result.get("ensemble"),
                 "intensity": result["intensity"],
+                "pipeline": result.get("pipeline"),
             }
         )
-    sev = str(result["severity"]["label"]).lower()
-    anom = str(result["anomaly"]["label"]).lower()
-    anom_score = max(result["anomaly"]["score"]) if result["anomaly"]["score"] else 0.0
-    sem_outlier = bool(result.get("semantic", {}).get("outlier"))
-    if ip:
-        now = time.time()
-        dq = REQUEST_COUNTS[ip]
-        dq.append(now)
-        while dq and dq[0] < now - REQUEST_WINDOW:
-            dq.popleft()
-        if len(dq) > DOS_THRESHOLD:
-            if firewall.block_ip(ip):
-                logger.warning("IP %s blocked due to DoS detection", ip)
-                db.save_blocked_ip(ip, "dos", ip_info=ip_info)
-                events.notify_blocked(
-                    {
-                        "ip": ip,
-                        "reason": "dos",
-                        "status": "blocked",
-                        "blocked_at": time.strftime("%Y-%m-%d %H:%M:%S"),
-                        "ip_info": ip_info,
-                    }
-                )
-                es.index_blocked_ip(
-                    {
-                        "ip": ip,
-                        "reason": "dos",
-                        "status": "blocked",
-                        "blocked_at": time.strftime("%Y-%m-%d %H:%M:%S"),
-                        "ip_info": ip_info,
-                    }
-                )
-                return {"blocked": True}
+    if ip and _should_block(result) and _block(ip, result, ip_info):
+        return {"blocked": True}
+    return result
 
-        block_by_sev = sev in config.BLOCK_SEVERITY_LEVELS
-        block_by_anom = (
-            anom not in ("normal", "none")
-            and sem_outlier
-            and anom_score >= config.BLOCK_ANOMALY_THRESHOLD
+
+def recheck_body(first, method: str, full_path: str, payload: str, ip: str) -> bool:
+    """Analyze the head and tail of a long body; return True if blocked.
+
+    ``first`` is what :func:`evaluate_request` returned for the request.
+    Only the models run again: its ipinfo is reused, and its log row is
+    updated (not duplicated) when the verdict changes.
+    """
+    first = first if isinstance(first, dict) else {}
+    full_text = f"{method} {full_path}\n{payload}"
+    level, skip = slo.plan()
+    try:
+        result = slo.run(_run_analysis, shape_input(full_text), skip)
+    except DeadlineExceeded:
+        return slo.fail_policy == FAIL_CLOSED
+    if isinstance(result.get("pipeline"), dict):
+        result["pipeline"]["tail"] = True
+        if slo.enabled:
+            result["pipeline"]["degraded"] = level
+            result["pipeline"]["shed"] = sorted(skip)
+    is_attack = _judge(result)
+    block = bool(ip) and _should_block(result)
+    if is_attack == bool(first.get("is_attack")) and not block:
+        return False
+    logger.warning("Veredito da requisicao de %s alterado pelo fim do corpo", ip or "unknown")
+    log_id = first.get("log_id")
+    if log_id is None:
+        db.save_log(
+            "unit",
+            full_text,
+            result["severity"],
+            result["anomaly"],
+            result["nids"],
+            result["semantic"],
+            ip=ip,
+            ip_info=first.get("ip_info"),
+            is_attack=is_attack,
+            pipeline=result.get("pipeline"),
         )
-        if block_by_sev or block_by_anom:
-            if firewall.block_ip(ip):
-                reason = f"{result['anomaly']['label']} / {result['severity']['label']}"
-                logger.warning("IP %s blocked: %s", ip, reason)
-                db.save_blocked_ip(ip, reason, ip_info=ip_info)
-                events.notify_blocked(
-                    {
-                        "ip": ip,
-                        "reason": reason,
-                        "status": "blocked",
-                        "blocked_at": time.strftime("%Y-%m-%d %H:%M:%S"),
-                        "ip_info": ip_info,
-                    }
-                )
-                es.index_blocked_ip(
-                    {
-                        "ip": ip,
-                        "reason": reason,
-                        "status": "blocked",
-                        "blocked_at": time.strftime("%Y-%m-%d %H:%M:%S"),
-                        "ip_info": ip_info,
-                    }
-                )
-                return {"blocked": True}
-    return result
+    else:
+        db.update_log(
+            log_id,
+            result["severity"],
+            result["anomaly"],
+            result["nids"],
+            result["semantic"],
+            is_attack=is_attack,
+            pipeline=result.get("pipeline"),
+        )
+    return block and _block(ip, result, first.get("ip_info"))
 
 
 @app.route("/")
@@ -244,7 +566,7 @@ def logs():
     for item in logs:
         item["category"] = item["nids"].get("majority", item["nids"]["label"])
         item["is_attack"] = True
-        item["intensity"] = detection.calculate_intensity(
+        item["intensity"] = calculate_intensity(
             item["severity"]["label"],
             item["anomaly"]["score"],
             item.get("semantic", {}).get("similarity", 1.0),
@@ -267,7 +589,7 @@ def common_logs():
     for item in logs:
         item["category"] = item["nids"].get("majority", item["nids"]["label"])
         item["is_attack"] = False
-        item["intensity"] = detection.calculate_intensity(
+        item["intensity"] = calculate_intensity(
             item["severity"]["label"],
             item["anomaly"]["score"],
             item.get("semantic", {}).get("similarity", 1.0),
@@ -291,7 +613,7 @@ def log_detail(log_id: int):
     log["category"] = log["nids"].get("majority", log["nids"]["label"])
     if "is_attack" not in log:
         log["is_attack"] = _is_attack(log["category"])
-    intensity = detection.calculate_intensity(
+    intensity = calculate_intensity(
         log["severity"]["label"],
         log["anomaly"]["score"],
         log.get("semantic", {}).get("similarity", 1.0),
@@ -310,7 +632,6 @@ def log_detail(log_id: int):
 @app.route("/blocked")
 def blocked():
     page = int(request.args.get("page", "1"))
-    firewall.sync_blocked_ips_with_ufw()
     blocked = db.get_blocked_ips(limit=100, offset=(page - 1) * 100)
     models = {
         "severity": config.SEVERITY_MODEL,
@@ -356,7 +677,7 @@ def blocked_detail(ip: str):
 
 @app.route("/unblock/<ip>", methods=["POST"])
 def unblock_ip_route(ip: str):
-    if firewall.unblock_ip(ip):
+    if firewall.schedule_unblock(ip):
         db.unblock_ip(ip)
         events.notify_blocked(
             {
@@ -379,7 +700,7 @@ def unblock_ip_route(ip: str):
 
 @app.route("/api/unblock/<ip>", methods=["POST"])
 def api_unblock(ip: str):
-    if firewall.unblock_ip(ip):
+    if firewall.schedule_unblock(ip):
         db.unblock_ip(ip)
         events.notify_blocked(
             {
@@ -412,7 +733,7 @@ def api_logs():
         logs = db.get_logs(limit=100, offset=(page - 1) * 100)
     serialized = []
     for log in logs:
-        intensity = detection.calculate_intensity(
+        intensity = calculate_intensity(
             log["severity"]["label"],
             log["anomaly"]["score"],
             log.get("semantic", {}).get("similarity", 1.0),
@@ -433,6 +754,7 @@ def api_logs():
                 "is_attack": log.get("is_attack", _is_attack(category)),
                 "semantic": log.get("semantic"),
                 "intensity": intensity,
+                "pipeline": log.get("pipeline"),
             }
         )
     return jsonify(serialized)
@@ -475,7 +797,6 @@ def stream_blocked():
 @app.route("/api/blocked")
 def api_blocked():
     page = int(request.args.get("page", "1"))
-    firewall.sync_blocked_ips_with_ufw()
     blocked = db.get_blocked_ips(limit=100, offset=(page - 1) * 100)
     serialized = [
         {
@@ -490,28 +811,181 @@ def api_blocked():
     return jsonify(serialized)
 
 
-async def _forward_async(path: str):
-    url = f"{BACKEND_URL}/{path}" if path else BACKEND_URL
+@app.route("/api/metrics")
+def api_metrics():
+    metrics = {}
+    if scheduler is not None:
+        metrics["batching"] = scheduler.stats()
+    if verdict_cache is not None:
+        metrics["verdict_cache"] = verdict_cache.stats()
+    if slo.enabled:
+        metrics["slo"] = slo.stats()
+    if config.ASYNC_ANALYSIS_PREFIXES or config.ASYNC_ANALYSIS_METHODS:
+        metrics["async_analysis"] = analysis_queue.stats()
+    if config.SPECULATIVE_PREFIXES:
+        metrics["speculation"] = speculation.stats()
+    metrics["upstream"] = upstream.stats()
+    metrics["blocklist"] = blocklist.stats()
+    metrics["rate_limit"] = rate_limiter.stats()
+    metrics["flood_blocks"] = flood_queue.stats()
+    metrics["firewall"] = firewall.stats()
+    if response_cache is not None:
+        metrics["response_cache"] = response_cache.stats()
+    return jsonify(metrics)
+
+
+class BodyRejected(Exception):
+    """Raised while streaming a request body whose tail was judged an attack."""
+
+
+def _forward_request(method: str, path: str, headers: dict, params, content):
     try:
-        async with httpx.AsyncClient() as client:
-            resp = await client.request(
-                method=request.method,
-                url=url,
-                headers={k: v for k, v in request.headers if k.lower() != "host"},
-                params=request.args,
-                content=request.get_data(),
-                follow_redirects=False,
-                timeout=5,
-            )
+        resp = upstream.stream(method, path, headers=headers, params=params, content=content)
+    except BodyRejected:
+        return Response("Bloqueado", status=403)
+    except NoUpstreamAvailable:
+        return Response("Nenhum backend disponível", status=503)
     except Exception as exc:
         return Response(f"Erro ao encaminhar: {exc}", status=502)
-    excluded = {"content-encoding", "content-length", "transfer-encoding", "connection"}
-    headers = [(k, v) for k, v in resp.headers.items() if k.lower() not in excluded]
-    return Response(resp.content, resp.status_code, headers)
+    # The body is relayed as received (still compressed, same length), so
+    # only the hop-by-hop headers are dropped.
+    headers = [(k, v) for k, v in resp.headers.multi_items() if k.lower() not in HOP_BY_HOP]
+    return Response(resp, resp.status_code, headers, direct_passthrough=True)
+
+
+def _body_prefix() -> bytes:
+    """Return the first ``ANALYSIS_BODY_LIMIT`` bytes of the request body.
+
+    Only this prefix is read before the verdict; it is kept in the WSGI
+    environ so forwarding sends it ahead of the rest of the stream.
+    """
+    env = request.environ
+    if BODY_PREFIX_KEY not in env:
+        chunks, size = [], 0
+        while size < config.ANALYSIS_BODY_LIMIT:
+            chunk = request.stream.read(config.ANALYSIS_BODY_LIMIT - size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+        env[BODY_PREFIX_KEY] = b"".join(chunks)
+    return env[BODY_PREFIX_KEY]
+
+
+def _body_text() -> str:
+    return _body_prefix().decode("utf-8", "replace")
+
+
+def _body_stream():
+    """Return an iterator over the whole request body.
+
+    A body longer than ``ANALYSIS_BODY_LIMIT`` is checked again by
+    :func:`recheck_body`, head plus its last ``ANALYSIS_BODY_LIMIT`` bytes,
+    while its final chunk is still held back: if the client is blocked
+    :class:`BodyRejected` is raised and the backend never receives a
+    complete request.
+    """
+    prefix = _body_prefix()
+    args = (
+        g.get("analysis"),
+        request.method,
+        request.path,
+        request.full_path,
+        request.remote_addr,
+    )
+    return _stream_with_tail(prefix, request.stream, args)
+
+
+def _stream_with_tail(prefix: bytes, stream, args: tuple):
+    if prefix:
+        yield prefix
+    if len(prefix) < config.ANALYSIS_BODY_LIMIT:
+        # The prefix already holds the whole body
+        return
+    tail = bytearray()
+    held = None
+    while True:
+        chunk = stream.read(config.STREAM_CHUNK_SIZE)
+        if not chunk:
+            break
+        if held is not None:
+            yield held
+        held = chunk
+        tail += chunk
+        del tail[: -config.ANALYSIS_BODY_LIMIT]
+    if held is None:
+        # The body ended at the limit: nothing new to check, but the
+        # analysis of a detect-only request was left for this point
+        if _is_async_route(args[1], args[2]):
+            _analyze_tail(prefix, *args)
+        return
+    _analyze_tail(prefix + bytes(tail), *args)
+    yield held
+
+
+def _analyze_tail(body: bytes, first, method: str, path: str, full_path: str, ip: str) -> None:
+    payload = body.decode("utf-8", "replace")
+    if _is_async_route(method, path):
+        # Not analyzed before the body was complete, see ``_analyze``
+        analysis_queue.submit(method, path, full_path, payload, ip, True)
+        return
+    if recheck_body(first, method, full_path, payload, ip):
+        logger.warning("Corpo da requisicao de %s recusado apos o limite de analise", ip)
+        raise BodyRejected()
+
+
+def _upstream_args(path: str, stream: bool = True) -> tuple:
+    # Everything the upstream call needs, read from the request context.
+    # With ``stream=False`` the body is read up front so the call can also
+    # run outside of the request context. Requests without a body always get
+    # bytes, which lets idempotent ones be retried on another backend.
+    body = _body_stream()
+    if not stream or not _has_body():
+        body = b"".join(body)
+    return (
+        request.method,
+        path,
+        {k: v for k, v in request.headers if k.lower() not in HOP_BY_HOP | {"host"}},
+        request.args.copy(),
+        body,
+    )
+
+
+def _has_body() -> bool:
+    return bool(request.content_length) or "chunked" in request.headers.get(
+        "Transfer-Encoding", ""
+    ).lower()
 
 
 def _forward(path: str):
-    return asyncio.run(_forward_async(path))
+    args = _upstream_args(path)
+    if response_cache is None or request.method not in ("GET", "HEAD"):
+        return _forward_request(*args)
+    method, path, headers, params, content = args
+
+    def send(forward_headers):
+        return upstream.stream(
+            method, path, headers=forward_headers, params=params, content=content
+        )
+
+    try:
+        resp, state = response_cache.fetch(
+            send, method, path, headers, params, g.get("verdict_benign", False)
+        )
+    except BodyRejected:
+        return Response("Bloqueado", status=403)
+    except NoUpstreamAvailable:
+        return Response("Nenhum backend disponível", status=503)
+    except Exception as exc:
+        return Response(f"Erro ao encaminhar: {exc}", status=502)
+    if isinstance(resp, CachedResponse):
+        headers = list(resp.headers) + [("Age", str(int(resp.age())))]
+        response = Response(resp.body, resp.status_code, headers, direct_passthrough=True)
+    else:
+        headers = [(k, v) for k, v in resp.headers.multi_items() if k.lower() not in HOP_BY_HOP]
+        response = Response(resp, resp.status_code, headers, direct_passthrough=True)
+    response.headers["X-Cache"] = state
+    return response
 
 
 @app.route("/<path:path>", methods=["GET", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"])
@@ -35,9 +35,6 @@ def client(monkeypatch):
 
     dummy_mod = types.ModuleType("app.detection")
     dummy_mod.Detector = DummyDetector
-    def calculate_intensity(sev_label, anomaly_score, similarity):
-        return 0.0
-    dummy_mod.calculate_intensity = calculate_intensity
     sys.modules["app.detection"] = dummy_mod
 
     psyco = types.ModuleType("psycopg2")
@@ -62,6 +59,10 @@ def client(monkeypatch):
     fw_mod.sync_blocked_ips_with_ufw = lambda: set()
     fw_mod.block_ip = lambda ip: False
     fw_mod.unblock_ip = lambda ip: False
+    fw_mod.schedule_block = lambda ip: False
+    fw_mod.schedule_unblock = lambda ip: False
+    fw_mod.stats = lambda: {}
+    fw_mod.start_reconciler = lambda: None
     fw_mod.is_ip_blocked = lambda ip: False
     fw_mod.is_whitelisted = lambda ip: False
     fw_mod.get_ufw_blocked_ips = lambda: set()
@@ -77,7 +78,7 @@ def client(monkeypatch):
     logs = []
     blocked = []
 
-    def save_log(interface, data, severity, anomaly, nids, semantic=None, ip=None, ip_info=None, is_attack=False):
+    def save_log(interface, data, severity, anomaly, nids, semantic=None, ip=None, ip_info=None, is_attack=False, pipeline=None):
         entry = {
             "id": len(logs) + 1,
             "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
@@ -89,6 +90,7 @@ def client(monkeypatch):
             "anomaly": anomaly,
             "nids": nids,
             "semantic": semantic,
+            "pipeline": pipeline,
         }
         logs.append(entry)
         return entry["id"], entry["created_at"]
@@ -0,0 +1,115 @@
+"""Proxy ASGI: análise, encaminhamento em blocos e bloqueio."""
+import asyncio
+
+import httpx
+
+
+def _call(application, method, path, body=b"", query=b"", raw_path=None, headers=()):
+    chunks = [body[i:i + 4] for i in range(0, len(body), 4)] or [b""]
+    messages = [
+        {"type": "http.request", "body": c, "more_body": i < len(chunks) - 1}
+        for i, c in enumerate(chunks)
+    ]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "raw_path": raw_path,
+        "query_string": query,
+        "headers": [(b"host", b"proxy"), (b"x-test", b"1"), *headers],
+        "client": ("10.0.0.1", 1234),
+    }
+    asyncio.run(application(scope, receive, send))
+    status = sent[0]["status"]
+    return status, b"".join(m.get("body", b"") for m in sent[1:])
+
+
+def _backend(monkeypatch, asgi):
+    seen = []
+
+    def handler(request):
+        seen.append((request.method, str(request.url), request.content, request.headers.get("x-test")))
+        return httpx.Response(200, stream=httpx.ByteStream(b"ok:" + request.content))
+
+    monkeypatch.setattr(
+        asgi, "_new_client", lambda: httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    )
+    monkeypatch.setattr(asgi, "_client", None)
+    return seen
+
+
+def test_asgi_forwards_and_logs(client, monkeypatch):
+    import app.asgi as asgi
+
+    seen = _backend(monkeypatch, asgi)
+    status, body = _call(asgi.application, "POST", "/form", b"user=admin&x=1", b"a=b")
+    assert status == 200
+    assert body == b"ok:user=admin&x=1"
+    assert seen[0][1].endswith("/form?a=b")
+    assert seen[0][3] == "1"
+    logs = client.get("/api/logs").get_json()
+    assert any(entry["log"] == "POST /form?a=b\nuser=admin&x=1" for entry in logs)
+
+
+def test_asgi_blocks_before_forwarding(client, monkeypatch):
+    import app.asgi as asgi
+
+    seen = _backend(monkeypatch, asgi)
+    monkeypatch.setattr(asgi.wsgi, "evaluate_request", lambda *a: {"blocked": True})
+    status, body = _call(asgi.application, "POST", "/form", b"x")
+    assert status == 403
+    assert seen == []
+
+
+def test_asgi_forwards_and_analyzes_the_raw_path(client, monkeypatch):
+    import app.asgi as asgi
+
+    seen = _backend(monkeypatch, asgi)
+    analyzed = []
+    monkeypatch.setattr(
+        asgi.wsgi, "evaluate_request", lambda *a: analyzed.append(a[2]) or {}
+    )
+    status, _ = _call(asgi.application, "GET", "/a/../b", raw_path=b"/a/%2e%2e/b")
+    assert status == 200
+    assert seen[0][1].endswith("/a/%2e%2e/b")
+    assert analyzed == ["/a/%2e%2e/b?"]
+
+
+def test_asgi_analyzes_the_tail_of_large_bodies(client, monkeypatch):
+    import app.asgi as asgi
+
+    seen = _backend(monkeypatch, asgi)
+    from pentest.test_streaming import verdict
+
+    analyzed = []
+
+    def analyze(text, skip):
+        analyzed.append(text.split("\n", 1)[1])
+        return verdict("<script>" in text)
+
+    monkeypatch.setattr(asgi.config, "ANALYSIS_BODY_LIMIT", 8)
+    monkeypatch.setattr(asgi.wsgi, "_run_analysis", analyze)
+    monkeypatch.setattr(asgi.wsgi, "shape_input", lambda text: text)
+    monkeypatch.setattr(asgi.wsgi.firewall, "schedule_block", lambda ip: True)
+    status, _ = _call(
+        asgi.application,
+        "POST",
+        "/up",
+        b"a" * 100 + b"<script>",
+        headers=[(b"content-length", b"108")],
+    )
+    assert status == 403
+    assert analyzed == ["a" * 8, "a" * 8 + "<script>"]
+    assert seen == []
+    assert all(m.in_use == 0 for m in asgi.wsgi.upstream.members)
+    # Logged once, by the first analysis
+    assert len(client.get("/api/logs").get_json()) == 1
+    asgi.wsgi.blocklist.discard("10.0.0.1")
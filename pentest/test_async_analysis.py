@@ -0,0 +1,48 @@
+"""Rotas somente detecção: encaminhadas na hora e analisadas depois."""
+import threading
+
+from app.background import AnalysisQueue
+
+
+def test_async_route_is_logged_in_background(client, monkeypatch):
+    import app.wsgi
+
+    monkeypatch.setattr(app.wsgi.config, "ASYNC_ANALYSIS_PREFIXES", ["/static/"])
+    resp = client.get("/static/app.js?v=<script>")
+    assert resp.status_code != 403
+    app.wsgi.analysis_queue.join()
+    logs = client.get("/api/logs").get_json()
+    assert any("/static/app.js" in entry.get("log", "") for entry in logs)
+    assert app.wsgi.analysis_queue.stats()["processed"] == 1
+
+
+def test_full_queue_drops_jobs():
+    gate = threading.Event()
+    done = []
+    queue = AnalysisQueue(lambda x: (gate.wait(2), done.append(x)), maxsize=1, workers=1)
+    results = [queue.submit(i) for i in range(4)]
+    gate.set()
+    queue.join()
+    assert results[0] is True
+    assert results.count(False) == queue.stats()["dropped"] >= 1
+    assert len(done) == 4 - queue.stats()["dropped"]
+
+
+def test_counters_add_up_under_concurrent_submits():
+    gate = threading.Event()
+    queue = AnalysisQueue(lambda x: gate.wait(2), maxsize=4, workers=1)
+
+    def submit_many():
+        for i in range(500):
+            queue.submit(i)
+
+    threads = [threading.Thread(target=submit_many) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    gate.set()
+    queue.join()
+    stats = queue.stats()
+    assert stats["submitted"] + stats["dropped"] == 8 * 500
+    assert stats["processed"] == stats["submitted"]
@@ -0,0 +1,28 @@
+"""Cache dos modelos exportados para ONNX."""
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("torch")
+
+from app import backends  # noqa: E402
+
+
+def test_onnx_cache_follows_revision_and_settings(tmp_path, monkeypatch):
+    monkeypatch.setattr(backends.config, "ONNX_CACHE_DIR", str(tmp_path))
+    old = SimpleNamespace(config=SimpleNamespace(_commit_hash="aaa"))
+    new = SimpleNamespace(config=SimpleNamespace(_commit_hash="bbb"))
+    path = backends._cache_dir("org/model", old)
+    assert path.startswith(str(tmp_path / "org--model"))
+    assert backends._cache_dir("org/model", old) == path
+    assert backends._cache_dir("org/model", new) != path
+    monkeypatch.setattr(backends, "ONNX_OPSET", 17)
+    assert backends._cache_dir("org/model", old) != path
+
+
+def test_local_checkpoint_revision_changes_with_its_files(tmp_path):
+    model = SimpleNamespace(config=SimpleNamespace())
+    (tmp_path / "model.safetensors").write_bytes(b"1")
+    first = backends._revision(str(tmp_path), model)
+    (tmp_path / "model.safetensors").write_bytes(b"22")
+    assert backends._revision(str(tmp_path), model) != first
@@ -0,0 +1,82 @@
+import threading
+
+from app.batching import BatchScheduler, group_by_length
+
+
+class RecordingDetector:
+    def __init__(self):
+        self.batches = []
+        self.gate = threading.Event()
+
+    def analyze_batch(self, texts):
+        self.gate.wait(timeout=2)
+        self.batches.append(list(texts))
+        return [{"text": text} for text in texts]
+
+
+def test_group_by_length_limits_padding():
+    groups = group_by_length([10, 200, 12, 180, 11], 1.5)
+    assert groups == [[0, 4, 2], [3, 1]]
+
+
+def test_scheduler_batches_concurrent_requests():
+    detector = RecordingDetector()
+    scheduler = BatchScheduler(detector, max_wait_ms=50, max_batch=8)
+    results = {}
+
+    def worker(i):
+        results[i] = scheduler.analyze(f"req {i}")
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(6)]
+    for t in threads:
+        t.start()
+    detector.gate.set()
+    for t in threads:
+        t.join(timeout=5)
+
+    assert results == {i: {"text": f"req {i}"} for i in range(6)}
+    assert sum(len(b) for b in detector.batches) == 6
+    assert len(detector.batches) < 6
+    assert scheduler.stats()["requests"] == 6
+
+
+def test_scheduler_propagates_errors():
+    class Failing:
+        def analyze_batch(self, texts):
+            raise RuntimeError("boom")
+
+    scheduler = BatchScheduler(Failing(), max_wait_ms=1, max_batch=4)
+    try:
+        scheduler.analyze("x")
+    except RuntimeError as exc:
+        assert str(exc) == "boom"
+    else:
+        raise AssertionError("erro nao propagado")
+
+
+def test_scheduler_groups_by_skip_mask():
+    class SkipAware:
+        def __init__(self):
+            self.calls = []
+
+        def analyze_batch(self, texts, skip=frozenset()):
+            self.calls.append((list(texts), frozenset(skip)))
+            return [{"text": text, "skip": sorted(skip)} for text in texts]
+
+    detector = SkipAware()
+    scheduler = BatchScheduler(detector, max_wait_ms=1, max_batch=4)
+    scheduler._dispatch(
+        [
+            scheduler_pending("a", ()),
+            scheduler_pending("b", ("semantic",)),
+            scheduler_pending("c", ()),
+        ]
+    )
+    assert (["a", "c"], frozenset()) in detector.calls
+    assert (["b"], frozenset({"semantic"})) in detector.calls
+
+
+def scheduler_pending(text, skip):
+    from app.batching import _Pending
+
+    return _Pending(text, skip)
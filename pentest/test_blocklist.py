@@ -0,0 +1,77 @@
+"""IPs já bloqueados são recusados antes de qualquer análise."""
+import sys
+import types
+
+
+def test_blocked_ip_short_circuits(client, monkeypatch):
+    import app.wsgi
+
+    calls = []
+    monkeypatch.setattr(app.wsgi, "analyze_request", lambda: calls.append(1) or {})
+    blocklist = app.wsgi.blocklist
+    before = blocklist.stats()["short_circuited"]
+    blocklist.add("127.0.0.1")
+    try:
+        assert client.get("/qualquer").status_code == 403
+        assert calls == []
+        assert blocklist.stats()["short_circuited"] == before + 1
+        # The panel stays reachable
+        assert client.get("/api/metrics").status_code == 200
+    finally:
+        blocklist.discard("127.0.0.1")
+
+
+def _import_db(monkeypatch):
+    if "app.db" not in sys.modules:
+        psyco = types.ModuleType("psycopg2")
+        extras = types.ModuleType("psycopg2.extras")
+        extras.RealDictCursor = object
+        extras.Json = lambda val: val
+        psyco.extras = extras
+        monkeypatch.setitem(sys.modules, "psycopg2", psyco)
+        monkeypatch.setitem(sys.modules, "psycopg2.extras", extras)
+    from app import db
+
+    return db
+
+
+def test_db_hooks_update_blocklist(monkeypatch):
+    db = _import_db(monkeypatch)
+    from app.blocklist import blocklist
+
+    monkeypatch.setattr(db, "conn", None)
+    db.save_blocked_ip("10.9.9.9", "teste")
+    assert "10.9.9.9" in blocklist
+    db.unblock_ip("10.9.9.9")
+    assert "10.9.9.9" not in blocklist
+
+
+def test_shared_reload_keeps_recent_blocks(tmp_path, monkeypatch):
+    from app.blocklist import Blocklist
+    from app.shm import SharedTable
+
+    db = _import_db(monkeypatch)
+    snapshot = []
+
+    def get_active_blocked_ips():
+        ips = list(snapshot)
+        # Another worker blocks an IP while the snapshot is being read
+        other.add("10.0.0.2")
+        return ips
+
+    monkeypatch.setattr(db, "get_active_blocked_ips", get_active_blocked_ips)
+    path = str(tmp_path / "b")
+    one = Blocklist(refresh=60, shared=SharedTable(path, 64, evict=False))
+    other = Blocklist(refresh=60, shared=SharedTable(path, 64, evict=False))
+    one.add("10.0.0.1")
+    snapshot.append("10.0.0.3")
+    one.check("10.0.0.9")
+    assert "10.0.0.1" not in one  # unblocked in the database
+    assert "10.0.0.2" in one and "10.0.0.3" in one
+    assert len(one) == 2
+
+    # The other worker does not reload within the same refresh period
+    calls = []
+    monkeypatch.setattr(db, "get_active_blocked_ips", lambda: calls.append(1) or [])
+    other.check("10.0.0.9")
+    assert calls == []
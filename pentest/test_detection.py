@@ -0,0 +1,155 @@
+"""Componentes do detector que não dependem dos pesos dos modelos."""
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("peft")
+pytest.importorskip("sentence_transformers")
+
+import copy  # noqa: E402
+from types import SimpleNamespace  # noqa: E402
+
+import torch  # noqa: E402
+
+from app import detection  # noqa: E402
+
+
+def unit(*values):
+    vector = torch.tensor(values, dtype=torch.float32)
+    return vector / vector.norm()
+
+
+class StubTokenizer:
+    """Character tokenizer with the parts of the Transformers API used."""
+
+    model_max_length = 32
+    padding_side = "right"
+    truncation_side = "right"
+    model_input_names = ["input_ids", "attention_mask"]
+
+    def __init__(self, vocab=None):
+        self.vocab = dict(vocab or {"a": 0})
+        self.calls = 0
+
+    def get_vocab(self):
+        return dict(self.vocab)
+
+    def __call__(self, texts, truncation=True, max_length=None):
+        self.calls += 1
+        ids = [[ord(c) % 50 + 1 for c in text][:max_length] for text in texts]
+        return {"input_ids": ids, "attention_mask": [[1] * len(row) for row in ids]}
+
+    def pad(self, features, return_tensors=None, **kwargs):
+        width = max(len(row) for row in features["input_ids"])
+        return {
+            key: torch.tensor([row + [0] * (width - len(row)) for row in rows])
+            for key, rows in features.items()
+        }
+
+
+class StubModel:
+    def __init__(self, *labels):
+        self.config = SimpleNamespace(id2label=dict(enumerate(labels)))
+
+    def __call__(self, input_ids, attention_mask):
+        total = (input_ids * attention_mask).sum(dim=1).float()
+        return SimpleNamespace(logits=torch.stack([total % 7, total % 5], dim=1))
+
+
+class StubEncoder:
+    def encode(self, texts, convert_to_tensor=True):
+        return torch.tensor([[float(len(t)), float(sum(map(ord, t)) % 13 + 1)] for t in texts])
+
+
+def stub_detector(parallel: bool, tokenizers=None):
+    """Return a :class:`Detector` wired to the stub models, without loading any."""
+    det = detection.Detector.__new__(detection.Detector)
+    det.device = torch.device("cpu")
+    det._executor = det._new_executor() if parallel else None
+    det._tokenizers = {}
+    tok = StubTokenizer()
+    severity_tok, anomaly_tok, primary_tok, secondary_tok = tokenizers or (tok,) * 4
+    det.severity_tokenizer = severity_tok
+    det.severity_model = StubModel("low", "high")
+    det.anomaly_tokenizer = anomaly_tok
+    det.anomaly_model = StubModel("normal", "anomaly")
+    det.primary_name = "primary"
+    det.primary_tok = primary_tok
+    det.primary = StubModel("normal", "attack")
+    det.nids_models = [("secondary", secondary_tok, StubModel("benign", "attack"))]
+    det._lora_model = None
+    det.semantic_model = StubEncoder()
+    det.semantic_window = detection.SemanticWindow(8, 2, det.device)
+    det.semantic_threshold = 0.5
+    return det
+
+
+def test_adapter_key_is_a_valid_module_name():
+    assert detection.adapter_key("org/nids-v1.2") == "org_nids_v1_2"
+    assert detection.adapter_key("org/nids_v1.2", {"org_nids_v1_2"}) == "org_nids_v1_2_2"
+
+
+def test_semantic_window_wraps_around():
+    window = detection.SemanticWindow(3, 2, "cpu")
+    # Nothing to compare with yet
+    assert window.observe(unit(1, 0)) == 1.0
+    assert window.observe(unit(0, 1)) == pytest.approx(0.0)
+    assert window.observe(unit(1, 1)) == pytest.approx(2 ** -0.5)
+    # The fourth embedding overwrites the first row
+    assert window.observe(unit(-1, 0)) == pytest.approx(0.0)
+    assert len(window) == 3 and window.index == 1
+    # (1, 0) left the window: its best match is now (1, 1)
+    assert window.observe(unit(1, 0)) == pytest.approx(2 ** -0.5)
+    assert window.observe(unit(1, 0)) == pytest.approx(1.0)
+
+
+@pytest.mark.parametrize("cascade", [False, True])
+def test_parallel_stages_match_sequential(monkeypatch, cascade):
+    monkeypatch.setattr(detection.config, "CASCADE_MODE", cascade)
+    monkeypatch.setattr(detection.config, "LENGTH_BUCKETS", [])
+    texts = ["GET /", "POST /login\nuser=admin' OR 1=1--", "GET /a/../../etc/passwd"]
+
+    def results(parallel):
+        det = stub_detector(parallel)
+        try:
+            out = det.analyze_batch(texts) + det.analyze_batch(texts[::-1])
+        finally:
+            if det._executor is not None:
+                det._executor.shutdown(wait=True)
+        out = copy.deepcopy(out)
+        for result in out:
+            # Wall times differ between runs
+            del result["pipeline"]["timings"]
+        return out
+
+    assert results(True) == results(False)
+
+
+def test_identical_tokenizers_are_loaded_once(monkeypatch):
+    vocabs = {"a": {"x": 0}, "b": {"x": 0}, "c": {"y": 0}}
+    monkeypatch.setattr(
+        detection,
+        "AutoTokenizer",
+        SimpleNamespace(from_pretrained=lambda name, **kwargs: StubTokenizer(vocabs[name])),
+    )
+    det = stub_detector(False)
+    first = det._load_tokenizer("a")
+    assert det._load_tokenizer("b") is first
+    assert det._load_tokenizer("c") is not first
+    assert len(det._tokenizers) == 2
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_one_tokenizer_call_per_distinct_tokenizer(monkeypatch, parallel):
+    monkeypatch.setattr(detection.config, "CASCADE_MODE", False)
+    monkeypatch.setattr(detection.config, "LENGTH_BUCKETS", [])
+    shared, other = StubTokenizer(), StubTokenizer({"b": 0})
+    det = stub_detector(parallel, (shared, shared, shared, other))
+    try:
+        det.analyze_batch(["GET /", "POST /login\nuser=x"])
+    finally:
+        if det._executor is not None:
+            det._executor.shutdown(wait=True)
+    # Severity, anomaly and primary NIDS share one encoding of the batch
+    assert shared.calls == 1
+    assert other.calls == 1
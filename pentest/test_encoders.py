@@ -0,0 +1,25 @@
+"""Encoders de sentenças compartilhados entre componentes."""
+import pytest
+
+pytest.importorskip("sentence_transformers")
+
+from app import encoders  # noqa: E402
+
+
+def test_one_encoder_per_name_and_device(monkeypatch):
+    created = []
+
+    class Encoder:
+        def __init__(self, name, device=None):
+            created.append((name, device))
+
+    monkeypatch.setattr(encoders, "SentenceTransformer", Encoder)
+    monkeypatch.setattr(encoders, "_encoders", {})
+    first = encoders.get_sentence_encoder("model", "cpu")
+    assert encoders.get_sentence_encoder("model", "cpu") is first
+    assert encoders.get_sentence_encoder("model", "cuda") is not first
+    assert encoders.get_sentence_encoder("other", "cpu") is not first
+    assert encoders.get_sentence_encoder("other", "cpu") is encoders.get_sentence_encoder(
+        "other", "cpu"
+    )
+    assert created == [("model", "cpu"), ("model", "cuda"), ("other", "cpu")]
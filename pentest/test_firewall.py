@@ -64,3 +64,172 @@ def test_block_and_unblock_ip(monkeypatch):
         "port",
         "9999",
     ]
+
+
+def test_nftables_batch_is_one_transaction(monkeypatch):
+    firewall = _import_firewall()
+    scripts = []
+
+    def fake_run(cmd, **kwargs):
+        scripts.append((cmd, kwargs.get("input")))
+        class Result:
+            stdout = ""
+        return Result()
+
+    monkeypatch.setattr(subprocess, "run", fake_run)
+    monkeypatch.setattr(firewall.config, "UNIT_BACKEND_PORT", 9999)
+    backend = firewall.NftablesBackend("t")
+    assert backend.block(["1.2.3.4", "5.6.7.8", "2001:db8::1"]) is True
+    assert len(scripts) == 2  # table setup, then the batch
+    assert "tcp dport 9999 ip saddr @blocked4 drop" in scripts[0][1]
+    cmd, script = scripts[1]
+    assert cmd == ["sudo", "nft", "-f", "-"]
+    assert "add element inet t blocked4 { 1.2.3.4, 5.6.7.8 }" in script
+    assert "add element inet t blocked6 { 2001:db8::1 }" in script
+
+
+def test_queue_applies_last_operation_per_ip():
+    firewall = _import_firewall()
+
+    class Backend:
+        name = "fake"
+        def __init__(self):
+            self.calls = []
+        def block(self, ips):
+            self.calls.append(("block", sorted(ips)))
+            return True
+        def unblock(self, ips):
+            self.calls.append(("unblock", sorted(ips)))
+            return True
+
+    backend = Backend()
+    queue = firewall.FirewallQueue(backend, interval=60)
+    queue._pid = firewall.os.getpid()  # no worker thread: flushed by hand
+    queue.schedule("1.1.1.1", True)
+    queue.schedule("2.2.2.2", True)
+    queue.schedule("3.3.3.3", False)
+    queue.schedule("2.2.2.2", False)
+    queue.flush()
+    assert backend.calls == [("block", ["1.1.1.1"]), ("unblock", ["2.2.2.2", "3.3.3.3"])]
+    assert queue.stats()["batches"] == 1
+
+
+def test_unblock_is_queued_for_ips_blocked_elsewhere(monkeypatch):
+    firewall = _import_firewall()
+
+    class Backend:
+        name = "fake"
+        rules = {"1.1.1.1"}
+        def blocked(self):
+            return set(self.rules)
+
+    queue = firewall.FirewallQueue(Backend(), interval=60)
+    queue._pid = firewall.os.getpid()  # no worker thread: flushed by hand
+    monkeypatch.setattr(firewall, "batcher", queue)
+    monkeypatch.setattr(firewall, "get_backend", lambda: queue.backend)
+    monkeypatch.setattr(firewall.db, "get_blocked_ip", lambda ip: None)
+    # Blocked by another worker: only the firewall has the rule
+    assert "1.1.1.1" not in firewall.blocklist
+    assert firewall.schedule_unblock("1.1.1.1")
+    # Unknown everywhere: still queued, but reported as not found
+    assert not firewall.schedule_unblock("2.2.2.2")
+    assert queue.pending() == {"1.1.1.1", "2.2.2.2"}
+
+
+def test_queue_retries_failed_batches_with_backoff(monkeypatch):
+    firewall = _import_firewall()
+    now = [100.0]
+    monkeypatch.setattr(firewall.time, "monotonic", lambda: now[0])
+
+    class Backend(firewall.FirewallBackend):
+        name = "fake"
+        def __init__(self):
+            self.calls = []
+            self.failures = 2
+        def block(self, ips):
+            self.calls.append(sorted(ips))
+            self.failures -= 1
+            return self.failures < 0
+        def unblock(self, ips):
+            return True
+        def blocked(self):
+            return set()
+
+    backend = Backend()
+    queue = firewall.FirewallQueue(backend, interval=60, max_retries=2)
+    queue._pid = firewall.os.getpid()
+    queue.schedule("1.1.1.1", True)
+    queue.flush()
+    assert queue.pending() == {"1.1.1.1"}
+    queue.flush()  # not due yet
+    assert len(backend.calls) == 1
+    now[0] += 1
+    queue.flush()
+    assert len(backend.calls) == 2 and queue.pending() == {"1.1.1.1"}
+    now[0] += 2
+    queue.flush()
+    assert len(backend.calls) == 3 and queue.pending() == set()
+    stats = queue.stats()
+    assert stats["errors"] == 2 and stats["retried"] == 2 and stats["failed"] == 0
+
+    backend.failures = 5
+    queue.schedule("2.2.2.2", True)
+    for _ in range(3):
+        queue.flush()
+        now[0] += 10
+    assert queue.pending() == set() and queue.stats()["failed"] == 1
+
+
+def test_reconciler_syncs_only_when_rules_change(monkeypatch):
+    firewall = _import_firewall()
+    rules = {"1.1.1.1"}
+    synced = []
+    monkeypatch.setattr(firewall, "get_ufw_blocked_ips", lambda: set(rules))
+    monkeypatch.setattr(
+        firewall, "sync_blocked_ips_with_ufw", lambda ips, conn=None: synced.append(ips)
+    )
+
+    reconciler = firewall.Reconciler(interval=60)
+    assert reconciler.run_once() is True
+    assert reconciler.run_once() is False
+    rules.add("2.2.2.2")
+    assert reconciler.run_once() is True
+    assert synced == [{"1.1.1.1"}, {"1.1.1.1", "2.2.2.2"}]
+    assert reconciler.stats()["runs"] == 3
+
+
+def test_reconciler_syncs_when_blocked_ips_change(monkeypatch):
+    firewall = _import_firewall()
+    state = [(1, "t1", 0)]
+    synced = []
+    monkeypatch.setattr(firewall, "get_ufw_blocked_ips", lambda: {"1.1.1.1"})
+    monkeypatch.setattr(
+        firewall, "sync_blocked_ips_with_ufw", lambda ips, conn=None: synced.append(ips)
+    )
+    monkeypatch.setattr(firewall.Reconciler, "_table_state", staticmethod(lambda conn: state[0]))
+
+    reconciler = firewall.Reconciler(interval=60)
+    assert reconciler.run_once() is True
+    assert reconciler.run_once() is False
+    # A row deleted or unblocked behind the reconciler's back
+    state[0] = (0, "t2", 0)
+    assert reconciler.run_once() is True
+    # Rows inside the grace period are compared again on the next pass
+    state[0] = (1, "t3", 1)
+    assert reconciler.run_once() is True
+    assert reconciler.run_once() is True
+    assert len(synced) == 4
+
+
+def test_only_one_reconciler_per_host(tmp_path):
+    firewall = _import_firewall()
+    path = str(tmp_path / "reconcile.lock")
+    first = firewall.Reconciler(interval=60, lock_path=path)
+    second = firewall.Reconciler(interval=60, lock_path=path)
+    assert first.leader() and first.leader()
+    assert not second.leader()
+    assert first.stats()["leader"] and not second.stats()["leader"]
+    # The lock is released when the leader goes away
+    first._forget_lock()
+    assert second.leader()
+    second._forget_lock()
@@ -0,0 +1,90 @@
+import threading
+
+from app.inference_server import (
+    InferenceServer,
+    RemoteDetector,
+    decode_request,
+    decode_results,
+    decode_texts,
+    encode_request,
+    encode_results,
+    encode_texts,
+)
+
+
+class EchoDetector:
+    def analyze_batch(self, texts):
+        if any(text == "boom" for text in texts):
+            raise ValueError("falha simulada")
+        return [
+            {
+                "anomaly": {"label": "normal", "score": [0.9, 0.1]},
+                "semantic": {"embedding": [0.5, -0.25], "similarity": 1.0},
+                "text": text,
+            }
+            for text in texts
+        ]
+
+
+def test_protocol_roundtrip():
+    texts = ["GET /\n", "POST /x\nção"]
+    assert decode_texts(encode_texts(texts)) == texts
+    assert decode_request(encode_request(texts, {"semantic"})) == (texts, {"semantic"})
+    results = EchoDetector().analyze_batch(texts)
+    assert decode_results(encode_results(results)) == results
+
+
+def test_remote_detector_over_socket(tmp_path):
+    path = str(tmp_path / "inference.sock")
+    server = InferenceServer(path, EchoDetector())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        client = RemoteDetector(path, timeout=5)
+        result = client.analyze("GET /a\n")
+        assert result["text"] == "GET /a\n"
+        assert result["semantic"]["embedding"] == [0.5, -0.25]
+        assert [r["text"] for r in client.analyze_batch(["a", "b"])] == ["a", "b"]
+        try:
+            client.analyze("boom")
+        except RuntimeError as exc:
+            assert "falha simulada" in str(exc)
+        else:
+            raise AssertionError("erro remoto nao propagado")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_request_not_resent_after_receive_timeout(tmp_path):
+    import socket
+
+    path = str(tmp_path / "slow.sock")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(4)
+    accepted = []
+
+    def accept():
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                return
+            # Accept the request and never answer it
+            accepted.append(conn)
+
+    threading.Thread(target=accept, daemon=True).start()
+    try:
+        client = RemoteDetector(path, timeout=0.2)
+        try:
+            client.analyze("GET /lento\n")
+        except OSError:
+            pass
+        else:
+            raise AssertionError("timeout nao propagado")
+        assert len(accepted) == 1
+    finally:
+        listener.close()
+        for conn in accepted:
+            conn.close()
@@ -0,0 +1,91 @@
+"""Limite de requisições aplicado antes da análise."""
+from app.ratelimit import IP, PATH, SUBNET, RateLimiter, subnet
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_bucket_refills_over_window():
+    clock = Clock()
+    limiter = RateLimiter(window=10, per_ip=5, per_subnet=0, paths={}, clock=clock)
+    assert [limiter.check("10.0.0.1") for _ in range(5)] == [None] * 5
+    assert limiter.check("10.0.0.1") == IP
+    assert limiter.check("10.0.0.2") is None
+    clock.now = 2.0  # one token every 2 s
+    assert limiter.check("10.0.0.1") is None
+    assert limiter.check("10.0.0.1") == IP
+
+
+def test_subnet_and_path_keys():
+    limiter = RateLimiter(
+        window=10, per_ip=0, per_subnet=2, paths={"/login": 2}, clock=Clock()
+    )
+    assert subnet("10.0.0.7", 24, 64) == "10.0.0.0/24"
+    assert subnet("2001:db8::1", 24, 64) == "2001:db8::/64"
+    assert limiter.check("10.0.0.1", "/") is None
+    assert limiter.check("10.0.0.2", "/") is None
+    assert limiter.check("10.0.0.3", "/") == SUBNET
+    assert limiter.check("10.0.1.1", "/login") is None
+    assert limiter.check("10.0.2.1", "/login/x") is None
+    assert limiter.check("10.0.3.1", "/login") == PATH
+    assert limiter.stats()["limited"] == {IP: 0, SUBNET: 1, PATH: 1}
+
+
+def test_idle_keys_are_evicted():
+    limiter = RateLimiter(window=10, per_ip=1, per_subnet=0, paths={}, max_keys=2, clock=Clock())
+    limiter.check("10.0.0.1")
+    limiter.check("10.0.0.2")
+    limiter.check("10.0.0.3")
+    stats = limiter.stats()
+    assert stats["keys"] == 2 and stats["evictions"] == 1
+    # The evicted key starts again with a full bucket
+    assert limiter.check("10.0.0.1") is None
+
+
+def test_flood_blocked_before_analysis(client, monkeypatch):
+    import app.wsgi
+
+    calls = []
+    blocked = []
+    monkeypatch.setattr(app.wsgi, "analyze_request", lambda: calls.append(1) or {})
+    monkeypatch.setattr(
+        app.wsgi.firewall, "schedule_block", lambda ip: blocked.append(ip) or True
+    )
+    monkeypatch.setattr(
+        app.wsgi, "rate_limiter", RateLimiter(window=10, per_ip=2, per_subnet=0, paths={})
+    )
+    monkeypatch.setattr(app.wsgi, "_forward", lambda path: ("ok", 200))
+    assert client.get("/a").status_code == 200
+    assert client.get("/a").status_code == 200
+    assert client.get("/a").status_code == 403
+    assert len(calls) == 2
+    assert blocked == ["127.0.0.1"]
+    app.wsgi.blocklist.discard("127.0.0.1")
+
+
+def test_flood_block_is_enriched_in_background(client, monkeypatch):
+    import sys
+    import threading
+
+    import app.wsgi
+
+    gate = threading.Event()
+    indexed = []
+    monkeypatch.setattr(app.wsgi.firewall, "schedule_block", lambda ip: True)
+    monkeypatch.setattr(
+        sys.modules["app.ipinfo"], "fetch_ip_info", lambda ip: gate.wait(2) and {"ip": ip}
+    )
+    monkeypatch.setattr(app.wsgi.es, "index_blocked_ip", indexed.append)
+    assert app.wsgi.block_flood("10.9.9.9")
+    # Recorded before the slow ipinfo lookup finished
+    assert [b["ip"] for b in client.get("/api/blocked").get_json()] == ["10.9.9.9"]
+    assert indexed == []
+    gate.set()
+    app.wsgi.flood_queue.join()
+    assert indexed[0]["ip_info"] == {"ip": "10.9.9.9"}
+    app.wsgi.blocklist.discard("10.9.9.9")
@@ -0,0 +1,92 @@
+import httpx
+
+from app.response_cache import BYPASS, HIT, MISS, REVALIDATED, ResponseCache, freshness
+
+
+class FakeResponse:
+    def __init__(self, status, headers, body=b""):
+        self.status_code = status
+        self.headers = httpx.Headers(headers)
+        self.body = body
+        self.closed = False
+
+    def read(self):
+        return self.body
+
+    def close(self):
+        self.closed = True
+
+
+class Backend:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def __call__(self, headers):
+        self.requests.append(dict(headers))
+        return self.responses.pop(0)
+
+
+def ok(body=b"hello", **headers):
+    headers.setdefault("Content-Length", str(len(body)))
+    return FakeResponse(200, {k.replace("_", "-"): v for k, v in headers.items()}, body)
+
+
+def test_fresh_hit_and_query_order():
+    cache = ResponseCache(max_bytes=10000, max_entry=1000)
+    backend = Backend(ok(Cache_Control="max-age=60"))
+    resp, state = cache.fetch(backend, "GET", "/a", {}, [("b", "2"), ("a", "1")], True)
+    assert state == MISS and resp.body == b"hello"
+    resp, state = cache.fetch(backend, "GET", "/a", {}, [("a", "1"), ("b", "2")], True)
+    assert state == HIT and resp.body == b"hello"
+    assert len(backend.requests) == 1
+
+
+def test_only_benign_and_cacheable_responses_are_stored():
+    cache = ResponseCache(max_bytes=10000, max_entry=1000)
+    backend = Backend(
+        ok(Cache_Control="max-age=60"),
+        ok(Cache_Control="private, max-age=60"),
+        ok(Cache_Control="max-age=60", Set_Cookie="s=1"),
+        ok(Cache_Control="max-age=60"),
+    )
+    for benign in (False, True, True):
+        assert cache.fetch(backend, "GET", "/a", {}, [], benign)[1] == MISS
+    _, state = cache.fetch(backend, "POST", "/a", {}, [], True)
+    assert state == BYPASS
+    assert cache.stats()["stored"] == 0
+
+
+def test_revalidation_with_etag():
+    cache = ResponseCache(max_bytes=10000, max_entry=1000)
+    backend = Backend(
+        ok(ETag='"v1"', Cache_Control="no-cache"),
+        FakeResponse(304, {"ETag": '"v1"', "Cache-Control": "max-age=30"}),
+    )
+    cache.fetch(backend, "GET", "/s", {}, [], True)
+    resp, state = cache.fetch(backend, "GET", "/s", {}, [], True)
+    assert state == REVALIDATED and resp.body == b"hello"
+    assert backend.requests[1]["If-None-Match"] == '"v1"'
+    assert cache.fetch(backend, "GET", "/s", {}, [], True)[1] == HIT
+
+
+def test_vary_and_size_bound():
+    cache = ResponseCache(max_bytes=200, max_entry=100)
+    backend = Backend(
+        ok(b"gz" * 10, Cache_Control="max-age=60", Vary="Accept-Encoding"),
+        ok(b"id" * 10, Cache_Control="max-age=60", Vary="Accept-Encoding"),
+        ok(b"x" * 90, Cache_Control="max-age=60"),
+    )
+    cache.fetch(backend, "GET", "/v", {"Accept-Encoding": "gzip"}, [], True)
+    cache.fetch(backend, "GET", "/v", {"Accept-Encoding": "identity"}, [], True)
+    resp, state = cache.fetch(backend, "GET", "/v", {"Accept-Encoding": "gzip"}, [], True)
+    assert state == HIT and resp.body == b"gz" * 10
+    cache.fetch(backend, "GET", "/big", {}, [], True)
+    stats = cache.stats()
+    assert stats["bytes"] <= 200 and stats["evictions"] == 2
+
+
+def test_no_cache_wins_over_max_age():
+    assert freshness(httpx.Headers({"Cache-Control": "no-cache, max-age=60"})) == 0.0
+    assert freshness(httpx.Headers({"Cache-Control": "max-age=60, private"})) == 0.0
+    assert freshness(httpx.Headers({"Cache-Control": "public, max-age=60"})) == 60.0
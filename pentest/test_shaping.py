@@ -0,0 +1,28 @@
+from app.shaping import GAP_MARKER, bucket_length, shape_input
+
+
+def test_short_text_is_unchanged():
+    text = "GET /index.html?x=1\nuser=a&pass=b"
+    assert shape_input(text, max_chars=4096) == text
+
+
+def test_long_body_keeps_head_and_tail():
+    body = "a=1&" + "".join(f"k{i}=v{i}&" for i in range(5000)) + "q=<script>alert(1)</script>"
+    text = "POST /upload\n" + body
+    shaped = shape_input(text, max_chars=512, head_ratio=0.5)
+    assert len(shaped) <= 512
+    assert shaped.startswith("POST /upload\na=1&")
+    assert shaped.endswith("<script>alert(1)</script>")
+    assert GAP_MARKER in shaped
+
+
+def test_repeated_filler_is_collapsed():
+    shaped = shape_input("GET /?data=" + "A" * 5000 + "\n" + "%00" * 300, max_chars=4096)
+    assert "A" * 5000 not in shaped
+    assert len(shaped) < 100
+
+
+def test_bucket_length():
+    assert bucket_length(10, [64, 128]) == 64
+    assert bucket_length(100, [64, 128]) == 128
+    assert bucket_length(300, [64, 128]) == 300
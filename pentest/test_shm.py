@@ -0,0 +1,105 @@
+"""Estado compartilhado entre processos em memória mapeada."""
+import os
+import struct
+
+from app.blocklist import Blocklist
+from app.ratelimit import IP, RateLimiter
+from app.shm import SharedTable
+
+
+def test_put_get_delete_and_ttl(tmp_path, monkeypatch):
+    table = SharedTable(str(tmp_path / "t"), slots=64, slot_size=128, stripes=4)
+    assert table.put("a", b"1")
+    assert table.get("a") == b"1"
+    assert "b" not in table
+    assert not table.put("big", b"x" * 1000)
+    assert table.put("x" * 200, b"long key")
+    assert table.get("x" * 200) == b"long key"
+    assert table.delete("a") and table.get("a") is None
+
+    now = [1000.0]
+    monkeypatch.setattr("app.shm.time.time", lambda: now[0])
+    table.put("tmp", b"v", ttl=5)
+    assert table.get("tmp") == b"v"
+    now[0] += 6
+    assert table.get("tmp") is None
+
+
+def test_full_window_evicts_least_recently_touched(tmp_path):
+    table = SharedTable(str(tmp_path / "t"), slots=4, slot_size=128, stripes=1, window=4)
+    for key in "abcd":
+        table.put(key, key.encode())
+    table.get("a")
+    table.put("e", b"e")
+    assert table.evictions == 1
+    assert sorted(table.keys()) == ["a", "c", "d", "e"]
+
+
+def test_tables_are_shared_between_processes(tmp_path):
+    path = str(tmp_path / "t")
+    table = SharedTable(path, slots=64, stripes=4)
+    counter = struct.Struct("<q")
+
+    def incr(old):
+        return counter.pack((counter.unpack(old)[0] if old else 0) + 1)
+
+    pid = os.fork()
+    if pid == 0:
+        child = SharedTable(path, slots=64, stripes=4)
+        for _ in range(100):
+            child.update("n", incr)
+        os._exit(0)
+    for _ in range(100):
+        table.update("n", incr)
+    os.waitpid(pid, 0)
+    assert counter.unpack(table.get("n"))[0] == 200
+
+
+def test_workers_share_limits_and_blocks(tmp_path):
+    path = str(tmp_path / "t")
+    first = RateLimiter(window=10, per_ip=2, per_subnet=0, paths={}, shared=SharedTable(path, 64))
+    second = RateLimiter(window=10, per_ip=2, per_subnet=0, paths={}, shared=SharedTable(path, 64))
+    assert first.check("10.0.0.1") is None
+    assert second.check("10.0.0.1") is None
+    assert first.check("10.0.0.1") == IP
+
+    blocked = str(tmp_path / "b")
+    one = Blocklist(refresh=0, shared=SharedTable(blocked, 64))
+    other = Blocklist(refresh=0, shared=SharedTable(blocked, 64))
+    one.add("10.0.0.9")
+    assert "10.0.0.9" in other
+    other.discard("10.0.0.9")
+    assert "10.0.0.9" not in one
+
+
+def test_other_layout_is_refused_not_cleared(tmp_path, monkeypatch):
+    from app import config
+    from app.shm import LayoutMismatch, open_table
+
+    path = str(tmp_path / "t")
+    table = SharedTable(path, slots=64, stripes=4)
+    table.put("a", b"1")
+    try:
+        SharedTable(path, slots=128, stripes=4)
+    except LayoutMismatch:
+        pass
+    else:
+        raise AssertionError("layout diferente aceito")
+    assert table.get("a") == b"1"
+
+    monkeypatch.setattr(config, "SHARED_STATE", True)
+    monkeypatch.setattr(config, "SHARED_STATE_PATH", str(tmp_path / "s"))
+    monkeypatch.setattr(config, "SHARED_LOCK_STRIPES", 4)
+    assert open_table("x", 64) is not None
+    assert open_table("x", 32) is None
+
+
+def test_table_without_eviction_refuses_puts(tmp_path):
+    table = SharedTable(
+        str(tmp_path / "t"), slots=4, slot_size=128, stripes=1, window=4, evict=False
+    )
+    for key in "abcd":
+        assert table.put(key, b"")
+    assert not table.put("e", b"")
+    assert sorted(table.keys()) == ["a", "b", "c", "d"]
+    assert table.stats()["full"] == 1 and table.evictions == 0
@@ -0,0 +1,101 @@
+import threading
+
+import pytest
+
+from app.slo import DeadlineExceeded, Overloaded, SLOController
+
+
+def timed_result(**timings):
+    return {"pipeline": {"timings": timings}}
+
+
+def test_disabled_controller_runs_inline():
+    slo = SLOController(deadline_ms=0)
+    assert slo.plan() == (0, frozenset())
+    assert slo.run(lambda text, skip: text.upper(), "get") == "GET"
+
+
+def test_plan_sheds_stages_in_order():
+    order = ["nids_secondary", "semantic", "severity"]
+    slo = SLOController(deadline_ms=100, shed_order=order, target_ratio=1.0)
+    slo.total_ms = 150.0
+    slo.stage_ms = {
+        "nids_secondary": 40.0,
+        "semantic": 20.0,
+        "severity": 30.0,
+        "nids_primary": 10.0,
+    }
+    level, skip = slo.plan()
+    assert level == 1
+    assert skip == {"nids_secondary"}
+
+    slo.total_ms = 300.0
+    level, skip = slo.plan()
+    assert level == 3
+    assert skip == set(order)
+    assert slo.stats()["levels"] == {"1": 1, "3": 1}
+
+
+def test_run_observes_timings():
+    slo = SLOController(deadline_ms=1000)
+    slo.run(lambda text, skip: timed_result(semantic=5.0, nids_primary=3.0), "x")
+    stats = slo.stats()
+    assert stats["avg_ms"] is not None
+    assert stats["stage_avg_ms"] == {"semantic": 5.0, "nids_primary": 3.0}
+    slo.run(lambda text, skip: {"pipeline": {"cached": True, "timings": {"semantic": 99}}}, "x")
+    assert slo.stats()["stage_avg_ms"]["semantic"] == 5.0
+
+
+def test_deadline_exceeded():
+    gate = threading.Event()
+    slo = SLOController(deadline_ms=20, fail_policy="closed")
+
+    with pytest.raises(DeadlineExceeded):
+        slo.run(lambda text, skip: gate.wait(2), "slow")
+    gate.set()
+    assert slo.stats()["timeouts"] == 1
+    assert slo.fail_policy == "closed"
+
+
+def test_queued_analyses_are_cancelled_and_queue_is_bounded():
+    gate = threading.Event()
+    started = []
+    slo = SLOController(deadline_ms=20, concurrency=1, max_queue=1)
+
+    def slow(text, skip):
+        started.append(text)
+        gate.wait(2)
+        return {}
+
+    # The first analysis holds the only slot, the second waits and is
+    # cancelled when its deadline expires
+    for text in ("a", "b"):
+        with pytest.raises(DeadlineExceeded):
+            slo.run(slow, text)
+    assert slo.stats()["cancelled"] == 1
+    assert slo.inflight == 1
+
+    # With the slot busy and the queue full a new request is not queued
+    slo.max_queue = 0
+    with pytest.raises(Overloaded):
+        slo.run(slow, "c")
+    assert slo.stats()["rejected"] == 1
+
+    gate.set()
+    slo._executor.shutdown(wait=True)
+    assert started == ["a"]
+    assert slo.inflight == 0
+
+
+def test_timed_out_request_is_logged(client, monkeypatch):
+    import app.wsgi
+
+    gate = threading.Event()
+    slo = SLOController(deadline_ms=20, fail_policy="closed")
+    monkeypatch.setattr(app.wsgi, "slo", slo)
+    monkeypatch.setattr(app.wsgi, "_run_analysis", lambda text, skip: gate.wait(2))
+    assert client.get("/lento").status_code == 403
+    gate.set()
+    logs = client.get("/api/logs").get_json()
+    entry = next(e for e in logs if "/lento" in e["log"])
+    assert entry["pipeline"] == {"degraded": "timeout", "fail_policy": "closed"}
@@ -0,0 +1,61 @@
+"""Encaminhamento especulativo de métodos seguros."""
+
+
+def _setup(monkeypatch):
+    import app.wsgi
+    from flask import Response
+
+    calls = []
+
+    def fake_forward(method, path, headers, params, content):
+        calls.append((method, path))
+        return Response("upstream", status=200)
+
+    monkeypatch.setattr(app.wsgi.config, "SPECULATIVE_PREFIXES", ["/spec"])
+    monkeypatch.setattr(app.wsgi, "_forward_request", fake_forward)
+    return app.wsgi, calls
+
+
+def test_allowed_request_releases_response(client, monkeypatch):
+    wsgi, calls = _setup(monkeypatch)
+    resp = client.get("/spec/page?q=1")
+    assert resp.status_code == 200
+    assert resp.get_data(as_text=True) == "upstream"
+    assert calls == [("GET", "spec/page")]
+    assert wsgi.speculation.stats()["released"] >= 1
+
+
+def test_blocked_request_discards_response(client, monkeypatch):
+    wsgi, calls = _setup(monkeypatch)
+    monkeypatch.setattr(wsgi, "analyze_request", lambda: {"blocked": True})
+    discarded = wsgi.speculation.stats()["discarded"]
+    resp = client.get("/spec/page")
+    assert resp.status_code == 403
+    assert wsgi.speculation.stats()["discarded"] == discarded + 1
+
+
+def test_unsafe_methods_are_not_speculated(client, monkeypatch):
+    wsgi, calls = _setup(monkeypatch)
+    started = wsgi.speculation.stats()["started"]
+    monkeypatch.setattr(wsgi, "analyze_request", lambda: {"blocked": True})
+    resp = client.post("/spec/form", data="x=1")
+    assert resp.status_code == 403
+    assert calls == []
+    assert wsgi.speculation.stats()["started"] == started
+
+
+def test_failed_analysis_discards_response(client, monkeypatch):
+    wsgi, calls = _setup(monkeypatch)
+
+    def fail():
+        raise RuntimeError("falha simulada")
+
+    monkeypatch.setattr(wsgi, "analyze_request", fail)
+    discarded = wsgi.speculation.stats()["discarded"]
+    try:
+        resp = client.get("/spec/page")
+    except RuntimeError:
+        pass
+    else:
+        assert resp.status_code == 500
+    assert wsgi.speculation.stats()["discarded"] == discarded + 1
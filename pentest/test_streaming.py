@@ -0,0 +1,108 @@
+"""Corpos transmitidos em blocos entre cliente, proxy e backend."""
+import gzip
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from app.upstream import UpstreamClient
+
+
+class _Backend(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        size = int(self.headers.get("Content-Length", "0"))
+        received = self.rfile.read(size)
+        body = gzip.compress(f"{len(received)}:{received[-3:].decode()}".encode())
+        self.send_response(200)
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_body_streams_both_ways(client, monkeypatch):
+    import app.wsgi
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Backend)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        monkeypatch.setattr(app.wsgi.config, "ANALYSIS_BODY_LIMIT", 16)
+        monkeypatch.setattr(
+            app.wsgi, "upstream", UpstreamClient(f"http://127.0.0.1:{server.server_port}")
+        )
+        body = b"a" * 100000 + b"end"
+        resp = client.post("/upload", data=body)
+        assert resp.status_code == 200
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(resp.get_data()) == b"100003:end"
+        resp.close()
+        assert app.wsgi.upstream.stats()["in_use"] == 0
+        logs = client.get("/api/logs").get_json()
+        assert any(entry["log"].endswith("\n" + "a" * 16) for entry in logs)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def verdict(attack: bool) -> dict:
+    label = "attack" if attack else "normal"
+    return {
+        "anomaly": {"label": "normal", "score": [1.0, 0.0]},
+        "severity": {"label": "high" if attack else "low", "score": []},
+        "nids": {"label": label, "majority": label},
+        "semantic": {"similarity": 1.0, "outlier": False},
+        "intensity": 0.0,
+    }
+
+
+def test_payload_after_the_limit_is_analyzed(client, monkeypatch):
+    import app.wsgi
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Backend)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    analyzed = []
+    updated = []
+
+    def analyze(text, skip):
+        analyzed.append(text.split("\n", 1)[1])
+        return verdict("<script>" in text)
+
+    try:
+        monkeypatch.setattr(app.wsgi.config, "ANALYSIS_BODY_LIMIT", 16)
+        monkeypatch.setattr(app.wsgi.config, "STREAM_CHUNK_SIZE", 1024)
+        monkeypatch.setattr(app.wsgi, "_run_analysis", analyze)
+        monkeypatch.setattr(app.wsgi, "shape_input", lambda text: text)
+        monkeypatch.setattr(app.wsgi.firewall, "schedule_block", lambda ip: True)
+        monkeypatch.setattr(
+            app.wsgi.db, "update_log", lambda log_id, *a, **k: updated.append((log_id, k))
+        )
+        monkeypatch.setattr(
+            app.wsgi, "upstream", UpstreamClient(f"http://127.0.0.1:{server.server_port}")
+        )
+        resp = client.post("/upload", data=b"a" * 10000 + b"<script>")
+        assert resp.status_code == 403
+        assert analyzed == ["a" * 16, "a" * 24 + "<script>"]
+        assert app.wsgi.upstream.stats()["in_use"] == 0
+        # The log of the first analysis now holds the attack verdict
+        logs = client.get("/api/logs").get_json()
+        assert len(logs) == 1
+        assert updated == [(logs[0]["id"], updated[0][1])] and updated[0][1]["is_attack"]
+        app.wsgi.blocklist.discard("127.0.0.1")
+
+        analyzed.clear()
+        updated.clear()
+        resp = client.post("/upload", data=b"b" * 10000)
+        assert resp.status_code == 200
+        assert len(analyzed) == 2
+        resp.close()
+        # One log row for the request, left as it was
+        assert len(client.get("/api/logs").get_json()) == 2
+        assert updated == []
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,161 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app.upstream import UpstreamClient
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        body = f"{self.path}|{self.client_address[1]}".encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_connections_are_reused():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        client = UpstreamClient(f"http://127.0.0.1:{server.server_port}", max_connections=2)
+        first = client.request("GET", "a", params={"x": "1"}).text
+        second = client.request("GET", "b").text
+        assert first.split("|")[0] == "/a?x=1"
+        assert second.split("|")[0] == "/b"
+        # Same client port: the keep-alive connection was reused
+        assert first.split("|")[1] == second.split("|")[1]
+        stats = client.stats()
+        assert stats["requests"] == 2 and stats["in_use"] == 0
+        client.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_http2_falls_back_without_h2(monkeypatch):
+    from app import upstream
+
+    monkeypatch.setattr(upstream, "_h2_available", lambda: False)
+    assert UpstreamClient("http://localhost", http2=True).http2 is False
+
+
+class _Failing(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.send_response(503)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def test_pool_retries_idempotent_requests_and_opens_breaker():
+    from app.upstream import UpstreamPool
+
+    bad, bad_url = _serve(_Failing)
+    good, good_url = _serve(_Handler)
+    try:
+        pool = UpstreamPool([bad_url, good_url], retries=1, health_interval=0)
+        pool.budget.tokens = 10
+        for member in pool.members:
+            member.breaker.failures = 2
+        for _ in range(4):
+            # The failing backend is tried first while it looks idle
+            pool.members[0].latency_ms = 0
+            pool.members[1].latency_ms = 100
+            resp = pool.stream("GET", "x", content=b"")
+            assert resp.status_code == 200
+            resp.close()
+        bad_stats, good_stats = pool.stats()["backends"]
+        assert bad_stats["breaker"] == "open"
+        assert bad_stats["requests"] == 2
+        assert good_stats["requests"] == 4
+        # Non idempotent requests are never retried
+        pool.members[0].breaker.record(True)
+        resp = pool.stream("POST", "x", content=b"data")
+        assert resp.status_code == 503
+        resp.close()
+    finally:
+        for server in (bad, good):
+            server.shutdown()
+            server.server_close()
+
+
+def test_circuit_breaker_half_open_probe(monkeypatch):
+    from app import upstream
+
+    now = [100.0]
+    monkeypatch.setattr(upstream.time, "monotonic", lambda: now[0])
+    breaker = upstream.CircuitBreaker(failures=1, reset=5)
+    breaker.record(False)
+    assert breaker.state == "open" and not breaker.allow()
+    now[0] += 5
+    assert breaker.allow() == breaker.PROBE
+    assert not breaker.allow()
+    breaker.record(True)
+    assert breaker.state == "closed" and breaker.allow()
+
+
+def test_probe_released_after_unexpected_error(monkeypatch):
+    from app import upstream
+
+    now = [100.0]
+    monkeypatch.setattr(upstream.time, "monotonic", lambda: now[0])
+    pool = upstream.UpstreamPool(["http://127.0.0.1:9"])
+    member = pool.members[0]
+    member.breaker.failures = 1
+    member.breaker.record(False)
+    now[0] += member.breaker.reset
+
+    def fail(*args, **kwargs):
+        raise ValueError("corpo recusado")
+
+    monkeypatch.setattr(member, "stream", fail)
+    with pytest.raises(ValueError):
+        pool.stream("POST", "/", content=iter([b"x"]))
+    assert member.breaker.state == "half_open"
+    assert member.breaker.allow()
+
+
+def test_request_from_closed_state_keeps_the_probe(monkeypatch):
+    from app import upstream
+
+    now = [100.0]
+    monkeypatch.setattr(upstream.time, "monotonic", lambda: now[0])
+    pool = upstream.UpstreamPool(["http://127.0.0.1:9"])
+    member = pool.members[0]
+    member.breaker.failures = 1
+    probes = []
+
+    def stream(*args, **kwargs):
+        # While this request runs the breaker opens, then goes half-open and
+        # another request takes the probe
+        member.breaker.record(False)
+        now[0] += member.breaker.reset
+        probes.append(pool.select())
+        raise ValueError("corpo recusado")
+
+    monkeypatch.setattr(member, "stream", stream)
+    with pytest.raises(ValueError):
+        pool.stream("POST", "/", content=iter([b"x"]))
+    assert probes == [(member, True)]
+    # The probe still belongs to the second request
+    assert not member.breaker.allow()
@@ -0,0 +1,122 @@
+import threading
+import time
+
+from app import verdict_cache
+from app.verdict_cache import VerdictCache, normalize_request
+
+
+class CountingDetector:
+    def __init__(self, delay=0.0):
+        self.calls = 0
+        self.delay = delay
+
+    def analyze(self, text):
+        self.calls += 1
+        time.sleep(self.delay)
+        return {"anomaly": {"label": "normal"}, "text": text}
+
+
+def test_normalize_masks_volatile_values():
+    a = normalize_request(
+        "GET /item/42?sid=abc123def456ghi7&ts=2024-05-01T10:00:00Z\n"
+        "id=550e8400-e29b-41d4-a716-446655440000"
+    )
+    b = normalize_request(
+        "GET /item/7?sid=zzz999yyy888xxx7&ts=2025-01-09T23:59:59Z\n"
+        "id=123e4567-e89b-12d3-a456-426614174000"
+    )
+    assert a == b
+    assert "<uuid>" in a and "<ts>" in a and "sid=<token>" in a
+
+
+def test_attack_values_keep_their_own_key():
+    benign = normalize_request("GET /a?token=abc\n")
+    attack = normalize_request("GET /a?token=' OR 1=1--\n")
+    assert benign != attack
+    assert normalize_request("GET /a?author=bob\n") != normalize_request(
+        "GET /a?author=<script>alert(1)</script>\n"
+    )
+    assert "author=<token>" not in normalize_request("GET /a?author=" + "b" * 20 + "\n")
+    # A token-like prefix does not hide what follows it
+    padded = normalize_request("GET /a?token=" + "a" * 20 + "'--\n")
+    assert "<token>" not in padded
+
+
+def test_hits_misses_and_copies():
+    det = CountingDetector()
+    cache = VerdictCache(det, maxsize=10, ttl=60)
+    first = cache.analyze("GET /a?id=1\n")
+    first["anomaly"]["label"] = "anomaly"
+    second = cache.analyze("GET /a?id=2\n")
+    assert det.calls == 1
+    assert second["anomaly"]["label"] == "normal"
+    stats = cache.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1
+
+
+def test_ttl_and_eviction():
+    det = CountingDetector()
+    cache = VerdictCache(det, maxsize=2, ttl=0.05)
+    cache.analyze("GET /a\n")
+    cache.analyze("GET /b\n")
+    cache.analyze("GET /c\n")
+    assert cache.stats()["evictions"] == 1
+    time.sleep(0.06)
+    cache.analyze("GET /c\n")
+    assert det.calls == 4
+
+
+def test_concurrent_requests_share_analysis():
+    det = CountingDetector(delay=0.1)
+    cache = VerdictCache(det, maxsize=10, ttl=60)
+    threads = [
+        threading.Thread(target=cache.analyze, args=("GET /slow\n",))
+        for _ in range(5)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(timeout=5)
+    assert det.calls == 1
+    assert cache.stats()["coalesced"] == 4
+
+
+def test_model_change_invalidates(monkeypatch):
+    det = CountingDetector()
+    cache = VerdictCache(det, maxsize=10, ttl=60)
+    cache.analyze("GET /a\n")
+    monkeypatch.setattr(verdict_cache.config, "DEVICE", "cuda-test")
+    cache.analyze("GET /a\n")
+    assert det.calls == 2
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_degraded_results_are_not_stored():
+    class SkipDetector(CountingDetector):
+        def analyze(self, text, skip=frozenset()):
+            result = super().analyze(text)
+            result["pipeline"] = {"shed": sorted(skip)}
+            return result
+
+    det = SkipDetector()
+    cache = VerdictCache(det, maxsize=10, ttl=60)
+    assert cache.analyze("GET /b\n", skip={"semantic"})["pipeline"]["shed"] == ["semantic"]
+    cache.analyze("GET /b\n")
+    assert det.calls == 2
+    hit = cache.analyze("GET /b\n", skip={"semantic"})
+    assert det.calls == 2
+    assert hit["pipeline"]["cached"] is True
+
+
+def test_shared_table_serves_other_workers(tmp_path):
+    from app.shm import SharedTable
+
+    path = str(tmp_path / "verdicts")
+    first_det, second_det = CountingDetector(), CountingDetector()
+    first = VerdictCache(first_det, maxsize=10, ttl=60, shared=SharedTable(path, 16, 4096))
+    second = VerdictCache(second_det, maxsize=10, ttl=60, shared=SharedTable(path, 16, 4096))
+    first.analyze("GET /b?id=1\n")
+    result = second.analyze("GET /b?id=2\n")
+    assert second_det.calls == 0
+    assert result["text"] == "GET /b?id=1\n"
+    assert second.stats()["shared_hits"] == 1
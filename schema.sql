@@ -12,6 +12,9 @@ CREATE TABLE IF NOT EXISTS logs (
     is_attack BOOLEAN NOT NULL
 );
 
+-- Stages executed by the detector for each log (cascade mode)
+ALTER TABLE logs ADD COLUMN IF NOT EXISTS pipeline JSONB;
+
 CREATE TABLE IF NOT EXISTS blocked_ips (
     id SERIAL PRIMARY KEY,
     ip TEXT NOT NULL,
@@ -21,6 +24,10 @@ CREATE TABLE IF NOT EXISTS blocked_ips (
     blocked_at TIMESTAMPTZ DEFAULT NOW()
 );
 
+-- Last block or unblock of the row; the firewall reconciler leaves recent
+-- changes alone while their rules may still be queued
+ALTER TABLE blocked_ips ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ DEFAULT NOW();
+
 CREATE TABLE IF NOT EXISTS whitelist_ips (
     id SERIAL PRIMARY KEY,
     ip TEXT NOT NULL UNIQUE,